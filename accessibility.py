@@ -0,0 +1,103 @@
+import os
+import time
+import threading
+import collections
+import xmltodict
+import stations
+
+ACCESS_FILE = "access.xml"
+# How often, in seconds, to check whether access.xml has changed on disk.
+CHECK_INTERVAL = 5
+
+# A single elevator or escalator. equipment_type is "EL" for elevators and
+# "ES" for escalators, and lines is the tuple of trains it serves.
+Equipment = collections.namedtuple(
+    "Equipment", [
+        "station", "borough", "lines", "equipment_no", "equipment_type",
+        "serving", "ada"
+    ]
+)
+
+# Everything known about accessibility, built from one version of the file.
+# by_name and by_stop_id map to tuples of Equipment, while ada_names and
+# ada_stop_ids are the sets used for filtering.
+AccessIndex = collections.namedtuple(
+    "AccessIndex", [
+        "by_name", "by_stop_id", "ada_names", "ada_stop_ids", "mtime"
+    ]
+)
+
+_index = None
+_checked = 0
+_index_lock = threading.Lock()
+
+
+# Parses access.xml and builds an AccessIndex from it. Like the old ada_list,
+# any station with any form of ada accessible equipment counts as accessible.
+def build_index(path=ACCESS_FILE):
+    mtime = os.stat(path).st_mtime
+    with open(path) as f:
+        equipment = xmltodict.parse(f.read())["NYCEquipments"]["equipment"]
+    # A file with a single piece of equipment doesn't come back as a list.
+    if isinstance(equipment, dict):
+        equipment = [equipment]
+    by_name = collections.defaultdict(list)
+    for item in equipment:
+        by_name[item["station"]].append(Equipment(
+            item["station"], item["borough"],
+            tuple((item["trainno"] or "").split("/")),
+            item["equipmentno"], item["equipmenttype"],
+            item["serving"], item["ADA"] == "Y"
+        ))
+    ada_names = {
+        name for name, items in by_name.items()
+        if any(item.ada for item in items)
+    }
+    # The file only has station names, so match them up with stations.csv to
+    # get GTFS Stop IDs.
+    by_stop_id = {}
+    ada_stop_ids = set()
+    for station in stations.get_index().items:
+        if station.name in by_name:
+            by_stop_id[station.stop_id] = tuple(by_name[station.name])
+        if station.name in ada_names:
+            ada_stop_ids.add(station.stop_id)
+    return AccessIndex(
+        {name: tuple(items) for name, items in by_name.items()},
+        by_stop_id, frozenset(ada_names), frozenset(ada_stop_ids), mtime
+    )
+
+
+# Returns the current AccessIndex. The file is parsed the first time, then
+# only again if its modification time changes. A new index is built fully
+# before it replaces the old one, so readers never see half of one.
+def get_index():
+    global _index, _checked
+    now = time.time()
+    if _index is not None and now - _checked < CHECK_INTERVAL:
+        return _index
+    with _index_lock:
+        if _index is None or now - _checked >= CHECK_INTERVAL:
+            _checked = now
+            if _index is None:
+                _index = build_index()
+            elif os.stat(ACCESS_FILE).st_mtime != _index.mtime:
+                # Keep serving the old index if the new file can't be read,
+                # say because it's only half written.
+                try:
+                    _index = build_index()
+                except Exception:
+                    pass
+    return _index
+
+
+# Whether a Station record is ada accessible. Can be given straight to
+# nearest_subway as a predicate.
+def is_ada_station(station):
+    return station.stop_id in get_index().ada_stop_ids
+
+
+# Returns the tuple of Equipment at a station, by name or GTFS Stop ID.
+def equipment(station):
+    index = get_index()
+    return index.by_stop_id.get(station, index.by_name.get(station, ()))
@@ -1,29 +1,52 @@
-import requests
-import xmltodict
 import statistics
 import json
 import time
 import csv
 import collections
-import vincenty
+import concurrent.futures
+import stations
+import accessibility
+import geocache
+import mtafeeds
+import sharedarrivals
+import upstream
+import bikes
+import routecache
+import arrivals
+import metrics
+import desertgrid
+import deadline
 from datetime import datetime
 from dateutil import relativedelta
 import dateutil.parser
 from math import cos, asin, sqrt
-from google.transit import gtfs_realtime_pb2
-from protobuf_to_dict import protobuf_to_dict
-
-# This is a list of every feed_id attached to MTA subway line
-FEED_ID = {
-    "1": "1", "2": "1", "3": "1", "4": "1", "5": "1", "6": "1",
-    "A": "26", "C": "26", "E": "26", "H": "26",
-    "N": "16", "Q": "16", "R": "16", "W": "16",
-    "B": "21", "D": "21", "F": "21", "M": "21",
-    "L": "2",
-    "G": "31",
-    "J": "36", "Z": "36",
-    "7": "51",
-}
+
+# The feed_id of every MTA subway line, kept in mtafeeds so the poller can
+# use them without importing this.
+FEED_ID = mtafeeds.FEED_ID
+
+# Where decoded feeds come from: this process's own feed manager, or feeds
+# another process publishes. See sharedarrivals.py.
+realtime = sharedarrivals.source(set(FEED_ID.values()))
+
+# Whether get_directions runs independent upstream calls at the same time.
+# Turning it off runs everything one after another, which is easier to debug.
+PARALLEL = True
+# Threads shared by every request for making upstream calls.
+upstream_pool = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+
+
+# Starts fn(*args) on the upstream pool and returns its future. If parallel is
+# off, it's run right away instead, and the future comes back already done.
+def submit(fn, *args, parallel=True):
+    if parallel:
+        return upstream_pool.submit(fn, *args)
+    future = concurrent.futures.Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
 
 
 # This function does coord_time-time_now. Returns a relativedelta. Not used.
@@ -46,48 +69,103 @@ def time_from_now(time_):
 
 
 # Puts together the trip object, with directions, and realtime, and calculates
-# any changes.
-def get_directions(origin, destination, radius, preferences, user_id):
+# any changes. Upstream calls that don't depend on each other are made at the
+# same time unless parallel is off. writer is what saves the trip, and takes
+# the same arguments as statistics.write_trip, which is the default. With
+# with_real_time off the trip comes back without waiting for the MTA, and the
+# real time can be streamed afterwards with stream_real_time. budget is the
+# seconds the search may take, a deadline.Deadline, or False for no deadline.
+def get_directions(
+    origin, destination, radius, preferences, user_id, parallel=None,
+    writer=None, with_real_time=True, budget=None
+):
+    if parallel is None:
+        parallel = PARALLEL
+    # Every upstream stage that can do without its answer only gets its share
+    # of the budget. Whatever runs over is skipped or served stale, and
+    # flagged in changes. Geocoding and Coord can't be skipped, so they're
+    # waited for as long as upstream.py lets them take. Only upstream calls
+    # running in parallel can be cut short.
+    budget = budget if isinstance(budget, deadline.Deadline) else \
+        deadline.Deadline(budget)
     # Dictionary to store the changes made to trip.
     changes = collections.defaultdict(lambda: 0)
-    origin_latitude, origin_longitude = \
-        get_location_coordinates(origin)
-    destination_latitude, destination_longitude = \
-        get_location_coordinates(destination)
+    # Geocode both ends at once. There's nothing to do without them.
+    with metrics.stage("geocode"):
+        geocoded = [
+            future.result() for future in [
+                submit(get_location_coordinates, origin, parallel=parallel),
+                submit(
+                    get_location_coordinates, destination, parallel=parallel
+                )
+            ]
+        ]
+    origin_latitude, origin_longitude = geocoded[0]
+    destination_latitude, destination_longitude = geocoded[1]
     if (not (destination_latitude and origin_latitude)):
         return (False, False)
-    # Nearest subways.
-    origin_subway = nearest_subway(origin_latitude, origin_longitude)
-    destination_subway = \
-        nearest_subway(destination_latitude, destination_longitude)
     # The final identifier means the latitude and longitude that will be
     # given to Coord. The rest will be filled in (by rideshares).
     final_origin_latitude = origin_latitude
     final_origin_longitude = origin_longitude
     final_destination_latitude = destination_latitude
     final_destination_longitude = destination_longitude
-    # Checks for nearby bikes and subways.
-    if (not is_transit_near(
-            origin_latitude, origin_longitude, radius, origin_subway
-    )):
-        # Start at subways instead and designate transit_desert.
-        final_origin_latitude = origin_subway[0]["GTFS Latitude"]
-        final_origin_longitude = origin_subway[0]["GTFS Longitude"]
-        changes["transit_desert"] = 1
-    if (not is_transit_near(
-        destination_latitude, destination_longitude, radius, destination_subway
-    )):
-        final_destination_latitude = destination_subway[0]["GTFS Latitude"]
-        final_destination_longitude = destination_subway[0]["GTFS Longitude"]
-        changes["transit_desert"] = 1
+    # Checks for nearby bikes and subways, both ends at once. Most of the time
+    # the desert grid answers this without looking anything up.
+    with metrics.stage("transit_near"):
+        (origin_finished, origin_near), \
+            (destination_finished, destination_near) = budget.wait([
+                submit(
+                    is_transit_near, origin_latitude, origin_longitude,
+                    radius, parallel=parallel
+                ),
+                submit(
+                    is_transit_near, destination_latitude,
+                    destination_longitude, radius, parallel=parallel
+                )
+            ], "transit_near")
+    # If the bike check is too slow, whether a bike is near is unknown, so
+    # only the subways count.
+    if not origin_finished:
+        origin_near = is_subway_near(
+            nearest_subway(origin_latitude, origin_longitude), radius
+        )
+        changes["bike_unknown"] = 1
+    if not destination_finished:
+        destination_near = is_subway_near(
+            nearest_subway(destination_latitude, destination_longitude),
+            radius
+        )
+        changes["bike_unknown"] = 1
+    # Start deserts at their nearest subway instead and designate
+    # transit_desert.
+    with metrics.stage("nearest_subway"):
+        if not origin_near:
+            origin_subway = nearest_subway(origin_latitude, origin_longitude)
+            final_origin_latitude = origin_subway[0].latitude
+            final_origin_longitude = origin_subway[0].longitude
+            changes["transit_desert"] = 1
+        if not destination_near:
+            destination_subway = \
+                nearest_subway(destination_latitude, destination_longitude)
+            final_destination_latitude = destination_subway[0].latitude
+            final_destination_longitude = destination_subway[0].longitude
+            changes["transit_desert"] = 1
     if preferences["ada"]:
-        origin_subway = ada_list(origin_subway)
-        destination_subway = ada_list(destination_subway)
+        with metrics.stage("ada"):
+            origin_subway = nearest_subway(
+                origin_latitude, origin_longitude,
+                predicate=accessibility.is_ada_station
+            )
+            destination_subway = nearest_subway(
+                destination_latitude, destination_longitude,
+                predicate=accessibility.is_ada_station
+            )
         # Start at subways instead.
-        final_origin_latitude = origin_subway[0]["GTFS Latitude"]
-        final_origin_longitude = origin_subway[0]["GTFS Longitude"]
-        final_destination_latitude = destination_subway[0]["GTFS Latitude"]
-        final_destination_longitude = destination_subway[0]["GTFS Longitude"]
+        final_origin_latitude = origin_subway[0].latitude
+        final_origin_longitude = origin_subway[0].longitude
+        final_destination_latitude = destination_subway[0].latitude
+        final_destination_longitude = destination_subway[0].longitude
         changes["ada"] = 1
         if (
             (not is_subway_near(origin_subway, radius)) or
@@ -95,22 +173,44 @@ def get_directions(origin, destination, radius, preferences, user_id):
         ):
             changes["ada_desert"] = 1
         # Send final coordinates to Coord.
-    trip = get_coord_directions(
+    # If Coord is too slow, an older route between the same places will do.
+    # Without one, Coord is waited for after all.
+    coord_arguments = (
         final_origin_latitude, final_origin_longitude,
         final_destination_latitude, final_destination_longitude,
         preferences["ada"]
     )
+    with metrics.stage("coord"):
+        coord = submit(
+            get_coord_directions, *coord_arguments, parallel=parallel
+        )
+        (finished, trip), = budget.wait([coord], "coord")
+        if not finished:
+            trip = get_stale_coord_directions(*coord_arguments)
+            if trip is None:
+                trip = coord.result()
+            else:
+                changes["stale_route"] = 1
+    # The lines and stations are known now, so start getting the real time
+    # while the rest of the trip is put together. They're read out before
+    # add_ride_share starts changing the legs. Even when the real time isn't
+    # waited for, this gets the feeds warm for when it's streamed.
+    if with_real_time or parallel:
+        real_time = submit(
+            find_station, *metro_stops(trip), parallel=parallel
+        )
     # If there's been a change, a rideshare needs to be added.
-    if (
-        (final_origin_latitude != origin_latitude) or
-        (final_origin_longitude != origin_longitude)
-    ):
-        add_ride_share(trip)
-    if (
-        (final_destination_latitude != destination_latitude) or
-        (final_destination_longitude != destination_longitude)
-    ):
-        add_ride_share(trip, True)
+    with metrics.stage("rideshare"):
+        if (
+            (final_origin_latitude != origin_latitude) or
+            (final_origin_longitude != origin_longitude)
+        ):
+            add_ride_share(trip)
+        if (
+            (final_destination_latitude != destination_latitude) or
+            (final_destination_longitude != destination_longitude)
+        ):
+            add_ride_share(trip, True)
     # Align preferences with trip changes.
     for preference, value in preferences.items():
         if preference == "ada":
@@ -125,26 +225,55 @@ def get_directions(origin, destination, radius, preferences, user_id):
                 changes["senior"] = 1
     time_now = time.asctime()
     # Write trip to database.
-    statistics.write_trip(
-        origin_latitude, origin_longitude, destination_latitude,
-        destination_longitude, trip,
-        changes, time_now, user_id, origin, destination
-    )
-    # Add subway real time to trip.
+    with metrics.stage("write_trip"):
+        (writer or statistics.write_trip)(
+            origin_latitude, origin_longitude, destination_latitude,
+            destination_longitude, trip,
+            changes, time_now, user_id, origin, destination
+        )
+    if not with_real_time:
+        count_degraded(changes)
+        return (trip, changes)
+    # Add subway real time to trip, if it's ready in time.
     try:
-        add_real_time(trip)
+        with metrics.stage("real_time"):
+            (finished, found), = budget.wait([real_time], "real_time")
+        if finished:
+            add_real_time(trip, found)
+        else:
+            changes["degraded_real_time"] = 1
     # Specifically a network error, or error accessing a dictionary.
     # Implement when possible.
     except:
-        pass
+        changes["degraded_real_time"] = 1
+    count_degraded(changes)
     return (trip, changes)
 
 
-# Checks if there is transit like a bike or bus within the radius.
-# Accepts a list of subway stations, as returned by nearest_subway.
-def is_transit_near(lat, lon, radius, nearSubway):
-    bikeNear = is_bike_near(lat, lon, radius)
+# Counts the ways a search was degraded, from its changes.
+def count_degraded(changes):
+    for change in ("bike_unknown", "stale_route", "degraded_real_time"):
+        if changes.get(change):
+            metrics.count("save_degraded_total", stage=change)
+
+
+# Checks if there is transit like a bike or bus within the radius. The desert
+# grid is asked first, and only if it can't be sure are the nearest subway and
+# bikes checked. A list of subway stations, as returned by nearest_subway, can
+# be passed in as nearSubway. If whether a bike is near is already known it
+# can be passed in as bikeNear, and the bike check is skipped when a subway is
+# near anyway.
+def is_transit_near(lat, lon, radius, nearSubway=None, bikeNear=None):
+    near = desertgrid.is_transit_near(lat, lon, radius)
+    if near is not None:
+        return near
+    if nearSubway is None:
+        nearSubway = nearest_subway(lat, lon)
     subwayNear = is_subway_near(nearSubway, radius)
+    if subwayNear:
+        return subwayNear
+    if bikeNear is None:
+        bikeNear = is_bike_near(lat, lon, radius)
     return (bikeNear or subwayNear)
 
 
@@ -191,13 +320,15 @@ def add_ride_share(d, back=False):
             obj["legs"] = [newLeg] + obj["legs"]
 
 
-# Uses Nominatum to get coordinates based on address.
+# Uses Nominatum to get coordinates based on address. Addresses are looked up
+# in the geocode cache first, and only go to the network if they aren't there.
 def get_location_coordinates(address):
-    with open("secret.json") as f:
-        nomkey = json.load(f)["mapquest"]
+    cached = geocache.get(address)
+    if cached is not None:
+        return cached
     nomload = {}
-    nomUrl = "http://open.mapquestapi.com/nominatim/v1/search.php?"
-    nomload["key"] = nomkey
+    nomUrl = "/nominatim/v1/search.php"
+    nomload["key"] = upstream.credential("mapquest")
     nomload["format"] = "json"
     nomload["q"] = address
     nomload["addressdetails"] = 0
@@ -206,7 +337,7 @@ def get_location_coordinates(address):
         'User-Agent': 'User Agent for Transit App',
         'From': 'nathalie.waelbroeck@ibigroup.com'
     }
-    nomr = requests.get(nomUrl, params=nomload)
+    nomr = upstream.get("mapquest", nomUrl, params=nomload)
     if nomr:
         res = nomr.json()
         if res and (len(res) > 0):
@@ -214,20 +345,57 @@ def get_location_coordinates(address):
             lat = res["lat"]
             lon = res["lon"]
             # time.sleep(1)
+            geocache.put(address, lat, lon)
             return (lat, lon)
+        # The search worked but found nothing, so remember that too.
+        geocache.put(address, False, False)
     return (False, False)
 
 
-# Uses coord to get trip routing instructions.
+# Uses coord to get trip routing instructions. Routes are cached for a few
+# minutes, and what comes back is always a copy that's safe to change.
 def get_coord_directions(
         origin_latitude, origin_longitude, destination_latitude,
         destination_longitude, accessible
 ):
-    coordkey = ""
-    with open("secret.json") as f:
-        coordkey = json.load(f)["coord"]
-    coordload = {"access_key": coordkey}
-    coordUrl = "https://api.coord.co/v1/routing/route?"
+    modes = "metro" if accessible else "metro,bike"
+    key = routecache.make_key(
+        origin_latitude, origin_longitude, destination_latitude,
+        destination_longitude, modes
+    )
+    trip = routecache.get(key)
+    if trip is not None:
+        return trip
+    trip = get_coord_directions_live(
+        origin_latitude, origin_longitude, destination_latitude,
+        destination_longitude, accessible
+    )
+    # Only cache real answers, not errors.
+    if trip.get("trips"):
+        routecache.put(key, trip)
+    return trip
+
+
+# Returns the last route Coord gave between the same places, however old, or
+# None. Used when Coord is too slow to answer in time.
+def get_stale_coord_directions(
+        origin_latitude, origin_longitude, destination_latitude,
+        destination_longitude, accessible
+):
+    modes = "metro" if accessible else "metro,bike"
+    return routecache.latest(routecache.make_key(
+        origin_latitude, origin_longitude, destination_latitude,
+        destination_longitude, modes
+    ))
+
+
+# Asks coord for trip routing instructions, skipping the cache.
+def get_coord_directions_live(
+        origin_latitude, origin_longitude, destination_latitude,
+        destination_longitude, accessible
+):
+    coordload = {"access_key": upstream.credential("coord")}
+    coordUrl = "/v1/routing/route"
     coordload["origin_latitude"] = origin_latitude
     coordload["origin_longitude"] = origin_longitude
     coordload["destination_latitude"] = destination_latitude
@@ -236,7 +404,7 @@ def get_coord_directions(
     # Bikes only if not ada.
     if (not accessible):
         coordload["modes"] += ",bike"
-    coordr = requests.get(coordUrl, params=coordload)
+    coordr = upstream.get("coord", coordUrl, params=coordload)
     return coordr.json()
 
 
@@ -250,56 +418,43 @@ def remove_geometry(d):
         # obj["statistics"]["duration_s"]/=60
 
 
+# Checks whether there's a bike station within km, using the desert grid or
+# the local snapshot of bike stations. If there's no snapshot, Coord is asked
+# instead.
+def is_bike_near(lat, lon, km):
+    near = desertgrid.is_near("bike", lat, lon, km)
+    if near is not None:
+        return near
+    near = bikes.is_near(lat, lon, km)
+    if near is None:
+        return is_bike_near_live(lat, lon, km)
+    return near
+
+
 # Uses coord to check how far the nearest bike station is. Coord accepts a
 # radius, so it's easy.
-def is_bike_near(lat, lon, km):
-    coordkey = ""
-    with open("secret.json") as f:
-        coordkey = json.load(f)["coord"]
-    coordload = {"access_key": coordkey}
-    coordUrl = "https://api.coord.co/v1/bike/location?"
+def is_bike_near_live(lat, lon, km):
+    coordload = {"access_key": upstream.credential("coord")}
+    coordUrl = "/v1/bike/location"
     coordload["latitude"] = lat
     coordload["longitude"] = lon
     coordload["radius_km"] = km
-    coordr = requests.get(coordUrl, params=coordload)
+    coordr = upstream.get("coord", coordUrl, params=coordload)
     d = coordr.json()
     return d["features"] is not None
 
 
 # Accepts list of subways as given by nearest_subway.
 def is_subway_near(L, dist):
-    ret = [item for item in L if item["dist"] <= dist]
+    ret = [item for item in L if item.dist <= dist]
     return ret
 
 
-# Uses the vincenty formula to find the distance between given point and all
-# subway stations. Returns a list of subway stations sorted by distance.
-def nearest_subway(lat, lon):
-    L = []
-    index = 0
-    ref = False
-    with open("stations.csv") as f:
-        # Hasty implementation of csv.DictReader. Will save some lines if
-        # switched, and will be cleaner.
-        text = csv.reader(f, delimiter=',', quotechar='"')
-        for line in text:
-            if (not ref):
-                ref = line
-                continue
-            L.append({})
-            for i, val in enumerate(line):
-                L[-1][ref[i]] = val
-            L[-1]["dist"] = vincenty.vincenty(
-                (
-                    float(L[-1]["GTFS Latitude"]),
-                    float(L[-1]["GTFS Longitude"])
-                ),
-                (float(lat), float(lon))
-            )
-
-    ref.append("dist")
-    L = sorted(L, key=lambda item: item["dist"])
-    return L
+# Uses the station index to find the k nearest subway stations to the given
+# point, as Station records sorted by distance. k=None returns all of them.
+# predicate can be given to only consider some stations.
+def nearest_subway(lat, lon, k=1, predicate=None):
+    return stations.nearest(lat, lon, k, predicate)
 
 
 # Returns dictionary of station information. Currently not used.
@@ -322,102 +477,119 @@ def station_info():
 
 
 # Returns list of "ada accessible" stations. That's quoted because there are a
-# lot of specifics in the file. The function assumes that any station that has
-# any form of ada accessible anything is entirely ada accessible.
+# lot of specifics in the file. The accessibility index assumes that any
+# station that has any form of ada accessible anything is entirely ada
+# accessible.
 def ada_list(L):
-    with open("access.xml") as f:
-        aL = xmltodict.parse(f.read())["NYCEquipments"]["equipment"]
-    d = collections.defaultdict(lambda: False)
-    for station in aL:
-        if not d[station["station"]]:
-            d[station["station"]] = (station["ADA"] == "Y")
-    L = [item for item in L if d[item['Stop Name']]]
+    ada_stop_ids = accessibility.get_index().ada_stop_ids
+    L = [item for item in L if item.stop_id in ada_stop_ids]
     return L
 
 
-# Adds real time to 'metro' forms of transit, more specifically subway.
-def add_real_time(trip):
+# Returns the stations and lines of every 'metro' leg in the trip.
+def metro_stops(trip):
     lines = set()
-    stations = set()
-    trips = trip["trips"]
-    for obj in trips:
+    station_ids = set()
+    for obj in trip["trips"]:
         for obj2 in obj["legs"]:
             if obj2["mode"] == "metro":
                 # To avoid making extra network requests, just get the lines
                 # and stations needed.
                 lines.add(obj2["transit_route"])
-                stations.add(obj2["station_start"]["id"])
-    # Get the real_time dictionary, in the format dict[line][station].
-    real_time = find_station(stations, lines)
-    for obj in trips:
-        for obj2 in obj["legs"]:
-            if obj2["mode"] == "metro":
-                obj2["real_time"] = real_time[
-                    obj2["transit_route"]][obj2["station_start"]["id"]]
-                start_time = dateutil.parser.parse(
-                    obj2["statistics"]["start_time"]
-                ).replace(tzinfo=None)
-                time_now = datetime.now()
-                # Filter the real time list so that each arrival/departure time
-                # appears only once, and is no earlier than the time of user's
-                # estimated arrival at the station. Change the real time into
-                # the minutes from now. Sort the new list.
-                obj2["real_time"] = sorted(list({
-                    int(
-                        relativedelta.relativedelta(
-                            datetime.fromtimestamp(train_time), time_now
-                        ).minutes
-                    )
-                    # Something here wasn't working, so forgive the messiness.
-                    for train_time in obj2["real_time"] if (
-                        int(relativedelta.relativedelta(
-                            datetime.fromtimestamp(train_time), time_now
-                        ).minutes) >= int(relativedelta.relativedelta(
-                            start_time, time_now
-                        ).minutes)
-                    )
-                }))
-                print(obj2["real_time"][0], time_now, start_time)
+                station_ids.add(obj2["station_start"]["id"])
+    return (station_ids, lines)
+
+
+# Adds real time to 'metro' forms of transit, more specifically subway. If the
+# real_time dictionary was already fetched it can be passed in.
+def add_real_time(trip, real_time=None):
+    trips = trip["trips"]
+    if real_time is None:
+        # Get the real_time dictionary, in the format dict[line][station].
+        real_time = find_station(*metro_stops(trip))
+    legs = [
+        obj2 for obj in trips for obj2 in obj["legs"]
+        if obj2["mode"] == "metro"
+    ]
+    # Filter the real time lists so that each arrival/departure time appears
+    # only once, and is no earlier than the time of user's estimated arrival
+    # at the station. Change the real time into the minutes from now, sorted.
+    # This is done on epochs for every leg at once.
+    minutes = arrivals.minutes_from_now([
+        (
+            real_time[leg["transit_route"]][leg["station_start"]["id"]],
+            arrivals.to_epoch(leg["statistics"]["start_time"])
+        )
+        for leg in legs
+    ])
+    for leg, leg_minutes in zip(legs, minutes):
+        leg["real_time"] = leg_minutes
+
+
+# Returns what's needed to stream the real time for a trip later, as a list of
+# [trip_index, leg_index, route, station, start_epoch] for every metro leg.
+# It's plain lists so it can be kept in the session.
+def real_time_legs(trip):
+    return [
+        [
+            trip_index, leg_index, leg["transit_route"],
+            leg["station_start"]["id"],
+            arrivals.to_epoch(leg["statistics"]["start_time"])
+        ]
+        for trip_index, obj in enumerate(trip["trips"])
+        for leg_index, leg in enumerate(obj["legs"])
+        if leg["mode"] == "metro"
+    ]
+
+
+# Yields (trip_index, leg_index, minutes) for legs as given by real_time_legs,
+# a feed at a time in whichever order the feeds are ready. Legs whose feed
+# can't be had are yielded with no minutes.
+def stream_real_time(legs):
+    by_feed = collections.defaultdict(list)
+    for leg in legs:
+        by_feed[FEED_ID.get(leg[2])].append(leg)
+    futures = {
+        upstream_pool.submit(
+            find_station, {leg[3] for leg in feed_legs},
+            {leg[2] for leg in feed_legs}
+        ): feed_legs
+        for feed_id, feed_legs in by_feed.items() if feed_id
+    }
+    for leg in by_feed.get(None, []):
+        yield (leg[0], leg[1], [])
+    for future in concurrent.futures.as_completed(futures):
+        feed_legs = futures[future]
+        try:
+            real_time = future.result()
+            minutes = arrivals.minutes_from_now([
+                (real_time[leg[2]][leg[3]], leg[4]) for leg in feed_legs
+            ])
+        except Exception:
+            minutes = [[] for leg in feed_legs]
+            metrics.count("save_degraded_total", stage="degraded_real_time")
+        for leg, leg_minutes in zip(feed_legs, minutes):
+            yield (leg[0], leg[1], leg_minutes)
 
 
 # Given an iterable of stations and of trains return the real time dictionary
-# of the format dict[line][station].
+# of the format dict[line][station]. The feeds come already decoded from the
+# shared feed manager, which keeps them fresh in the background, so this is
+# just a lookup per line and station.
 def find_station(station_ids, trains):
-    feed = gtfs_realtime_pb2.FeedMessage()
-    with open("secret.json") as f:
-        key = json.load(f)["mta"]
     final_times = {}
     # Get a set of the appropriate MTA feed_id. This saves a ton of time in
     # terms of network requests.
     feeds = {FEED_ID[line] for line in trains}
-    for feed_id in feeds:
-        response = requests.get(
-            f"http://datamine.mta.info/mta_esi.php?key={key}&feed_id={feed_id}"
-        )
-        feed.ParseFromString(response.content)
-        # Turn feed into a regular dictionary.
-        d = protobuf_to_dict(feed)
-        times = collections.defaultdict(
-            lambda: collections.defaultdict(lambda: [])
-        )
-        for i, val in enumerate(d["entity"]):
-            if "trip_update" in val:
-                for item in val["trip_update"]["stop_time_update"]:
-                    # Only looking for specific stations.
-                    if (item["stop_id"] in station_ids):
-                        if ("arrival" in item):
-                            times[
-                                val["trip_update"]["trip"]["route_id"]
-                            ][item["stop_id"]].append(item["arrival"]["time"])
-                        if ("departure" in item):
-                            times[
-                                val["trip_update"]["trip"]["route_id"]
-                            ][item["stop_id"]].append(
-                                item["departure"]["time"]
-                            )
-        # The times dictionary might be edited again, so update the final_times
-        # dictionary now.
-        final_times.update(times)
+    snapshots = realtime.get(feeds)
+    for line in trains:
+        feed = snapshots[FEED_ID[line]].data
+        times = collections.defaultdict(lambda: [])
+        for station in station_ids:
+            found = feed.times(line, station)
+            if found:
+                times[station] = list(found)
+        final_times[line] = times
     return final_times
 
 
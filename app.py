@@ -1,14 +1,24 @@
 from flask import (
     Flask, render_template, jsonify, session, request, Response, redirect,
-    url_for
+    url_for, stream_with_context, g
 )
 import api
+import time
+import batch
+import upstream
+import metrics
+import database
+import geocache
+import routecache
+import desertgrid
 from multidict import MultiDict
 import users
 import businessdata
 import json
 import collections
 import statistics
+import export
+import clusters
 from flask_wtf import FlaskForm
 from wtforms import (
     widgets, StringField, BooleanField, PasswordField,
@@ -33,6 +43,11 @@ login_manager.init_app(app)
 login_manager.login_view = "login"
 
 app.secret_key = "Very big secret"
+# Render directions as soon as Coord answers, and stream the real time in
+# afterwards, instead of waiting for the MTA feeds before rendering.
+app.config.setdefault("PROGRESSIVE_DIRECTIONS", True)
+# Bring every database's schema up to date before the first request.
+database.setup()
 
 
 class User(UserMixin):
@@ -190,12 +205,66 @@ def load_user(userid):
     return User(userid, business=True)
 
 
+# Starts timing every request, along with the stages of any search in it.
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+    metrics.start_request()
+
+
+# Records how long the route took, and adds its stages as a Server-Timing
+# header. Streamed responses are timed up to their first byte.
+@app.after_request
+def stop_timer(response):
+    if "start" not in g:
+        return response
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.observe(
+        "save_request_seconds", time.perf_counter() - g.start,
+        route=route, method=request.method
+    )
+    metrics.count(
+        "save_requests_total", route=route, method=request.method,
+        status=response.status_code
+    )
+    timing = metrics.server_timing()
+    if timing:
+        response.headers["Server-Timing"] = timing
+    return response
+
+
+# Prometheus metrics: stage, route and upstream timings, upstream status
+# codes, cache hit rates and feed ages.
+@app.route("/metrics")
+def load_metrics():
+    gauges = []
+    counters = []
+    for name, cache in (("geocode", geocache), ("route", routecache)):
+        stats = cache.get_counters()
+        for result in ("hits", "misses"):
+            counters.append((
+                "save_cache_lookups_total",
+                {"cache": name, "result": result}, stats.get(result, 0)
+            ))
+        gauges.append(
+            ("save_cache_hit_ratio", {"cache": name}, stats["hit_rate"])
+        )
+    for feed_id, age in sorted(api.realtime.ages().items()):
+        gauges.append(("save_feed_age_seconds", {"feed": feed_id}, age))
+    gauges.append(("save_trip_queue_length", {}, len(statistics.trip_queue)))
+    for feed_id, errors in sorted(api.realtime.errors.items()):
+        counters.append(("save_feed_errors_total", {"feed": feed_id}, errors))
+    return Response(
+        metrics.render(gauges, counters),
+        mimetype="text/plain; version=0.0.4"
+    )
+
+
 # This is obviously not secure, and is so javascript can make ajax requests.
 @app.route("/secret")
 def secret_loader():
-    with open("secret.json") as f:
-        # Return as JSON.
-        return jsonify(json.load(f))
+    # Return as JSON.
+    return jsonify(upstream.secrets())
 
 
 # Route for logging in.
@@ -332,15 +401,27 @@ def directions():
         # Getting the directions as direct, and any special modifiers
         # as subsz.
         # Function get_directions should be further explained in its file.
+        progressive = app.config["PROGRESSIVE_DIRECTIONS"]
         direct, subsz = api.get_directions(
             origin, dest, radius,
-            session["preferences"], session["user_id"]
+            session["preferences"], session["user_id"],
+            with_real_time=not progressive
         )
         # print(json.dumps(direct["trips"], indent=4))
         # If you somehow didn't receive directions.
-        if ((not direct) or (not direct["trips"])):
+        if ((not direct) or (not direct.get("trips"))):
             return ("There was a problem with your addresses!")
-        return render_template("directions.html", obj=direct, subsz=subsz)
+        real_time_url = None
+        if progressive:
+            # Remember which legs need real time, for the stream to find.
+            session["real_time"] = {
+                "id": direct["id"], "legs": api.real_time_legs(direct)
+            }
+            real_time_url = url_for("real_time", trip_id=direct["id"])
+        return render_template(
+            "directions.html", obj=direct, subsz=subsz,
+            real_time_url=real_time_url
+        )
     # Display businesses which request to be displayed.
     locations = [
         dict(location) for location in businessdata.get_displayed_locations()
@@ -348,6 +429,56 @@ def directions():
     return render_template("address.html", form=form, locations=locations)
 
 
+# Batch trip planning. Takes JSON like {"pairs": [{"origin": ...,
+# "destination": ...}, ...], "radius": 0.8}, and streams back one JSON result
+# per line as each pair finishes. Up to batch.MAX_PAIRS pairs at a time.
+@app.route("/batch", methods=["POST"])
+@login_required
+def batch_directions():
+    body = request.get_json(force=True)
+    try:
+        if not isinstance(body, dict):
+            raise ValueError("body must be a JSON object")
+        pairs = batch.check_pairs(body.get("pairs"))
+        radius = float(body.get("radius", batch.DEFAULT_RADIUS))
+        workers = min(int(body.get("workers", batch.WORKERS)), batch.WORKERS)
+    except (TypeError, ValueError) as error:
+        return jsonify({"error": str(error)}), 400
+    results = batch.plan(
+        pairs,
+        radius=radius,
+        user_id=session.get("user_id", 0),
+        workers=max(workers, 1),
+        full=bool(body.get("full"))
+    )
+    return Response(
+        stream_with_context(
+            json.dumps(result) + "\n" for result in results
+        ),
+        mimetype="application/x-ndjson"
+    )
+
+
+# Streams the real time for the trip the user just searched for, as server-sent
+# events. There's one event per metro leg, then a "done" event.
+@app.route("/realtime/<int:trip_id>")
+@login_required
+def real_time(trip_id):
+    pending = session.get("real_time")
+    legs = pending["legs"] if pending and pending["id"] == trip_id else []
+
+    def events():
+        for trip_index, leg_index, minutes in api.stream_real_time(legs):
+            yield "data: {}\n\n".format(json.dumps({
+                "trip": trip_index, "leg": leg_index, "real_time": minutes
+            }))
+        yield "event: done\ndata: {}\n\n"
+    return Response(
+        stream_with_context(events()), mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+
 # Government analytics page.
 @app.route("/statistics", methods=["POST", "GET"])
 def load_statistics():
@@ -362,33 +493,178 @@ def load_statistics():
     ]
     form.filters.choices = choice_list
     filtered_totals = {"Total results": 0, "Number of chosen trips": 0}
-    if form.validate_on_submit():
-        # If you'd like to map everything.
-        if (form.map_all.data):
-            locations = statistics.get_all_latitude_longitude()
-        # Otherwise, map just the filtered results.
-        else:
-            data_load = (form.filters.data, form.and_or.data)
-            filtered_totals["Total results"], \
-                filtered_totals["Number of chosen trips"] = \
-                statistics.get_statistic(*data_load)
-            locations = (
-                statistics.get_filtered_latitude_longitude(*data_load)
-            )
-    else:
-        # Map all if there was no form submitted.
-        locations = statistics.get_all_latitude_longitude()
-    # In any event, run through and make dictionaries out of the sqlite rows.
-    locations = [
-        dict(location) for location in locations
-    ]
+    # The map fetches clusters of these trips itself, as it's moved.
+    cluster_filters = {}
+    if form.validate_on_submit() and not form.map_all.data:
+        # Map just the filtered results, unless you'd like to map everything.
+        data_load = (form.filters.data, form.and_or.data)
+        filtered_totals["Total results"], \
+            filtered_totals["Number of chosen trips"] = \
+            statistics.get_statistic(*data_load)
+        cluster_filters = {
+            "filters": ",".join(form.filters.data), "type": form.and_or.data
+        }
     return render_template(
         "statistics.html", result=trip_statistics, users=user_statistics,
         totals=totals, form=form, filtered_totals=filtered_totals,
-        locations=locations
+        cluster_filters=cluster_filters
+    )
+
+
+# Reads the zoom and bbox, which is south,west,north,east, a map asks for
+# clusters with.
+def cluster_area():
+    bbox = [float(value) for value in request.args["bbox"].split(",")]
+    if len(bbox) != 4:
+        raise ValueError("bbox must be south,west,north,east")
+    return request.args.get("zoom", type=int, default=12), bbox
+
+
+# Clusters of trip origins and destinations, for the statistics map. Takes
+# zoom, bbox, and the filters (comma separated) and type (AND or OR) of the
+# statistics page's form.
+@app.route("/statistics/clusters.json")
+def trip_clusters():
+    try:
+        zoom, bbox = cluster_area()
+    except (KeyError, ValueError) as error:
+        return jsonify({"error": str(error)}), 400
+    filters = request.args.get("filters")
+    return jsonify(clusters.trip_clusters(
+        zoom, bbox, filters.split(",") if filters else (),
+        request.args.get("type", "AND")
+    ))
+
+
+# Clusters of businesses, for the business data map. Takes zoom, bbox, and
+# the filters, type and categories (comma separated) of its form.
+@app.route("/businessdata/clusters.json")
+def business_clusters():
+    try:
+        zoom, bbox = cluster_area()
+    except (KeyError, ValueError) as error:
+        return jsonify({"error": str(error)}), 400
+    filters = request.args.get("filters")
+    categories = request.args.get("categories")
+    return jsonify({"businesses": clusters.business_clusters(
+        zoom, bbox, filters.split(",") if filters else (),
+        request.args.get("type", "AND"),
+        categories.split(",") if categories else ()
+    )})
+
+
+# How far back trends go when no start is given, in seconds, by bucket.
+TREND_SPANS = {
+    "hour": 2 * 24 * 60 * 60, "day": 30 * 24 * 60 * 60,
+    "week": 26 * 7 * 24 * 60 * 60,
+}
+
+
+# Turns a YYYY-MM-DD date into local seconds since the epoch.
+def parse_date(date):
+    return int(time.mktime(time.strptime(date, "%Y-%m-%d")))
+
+
+# Trip counts over time for the statistics page to chart. Takes bucket (hour,
+# day or week), start and end dates, both included, and flags, comma
+# separated.
+@app.route("/statistics/trends.json")
+def trip_trends():
+    bucket = request.args.get("bucket", "day")
+    if bucket not in statistics.TREND_BUCKETS:
+        return jsonify({"error": "bucket must be hour, day or week"}), 400
+    try:
+        end = (
+            statistics.local_day(parse_date(request.args["end"]), 1)
+            if request.args.get("end") else int(time.time())
+        )
+        start = (
+            parse_date(request.args["start"]) if request.args.get("start")
+            else end - TREND_SPANS[bucket]
+        )
+        flags = request.args.get("flags")
+        trends = statistics.get_trends(
+            bucket, start, end,
+            flags.split(",") if flags else statistics.TRIP_FLAGS
+        )
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    return jsonify({
+        "bucket": bucket, "start": start, "end": end, "trends": trends
+    })
+
+
+# Streams the trips table, for loading into pandas or DuckDB. format is arrow
+# (an Arrow IPC stream) or csv (gzipped). after_batch and after_row carry on
+# after the last trip a previous export got, which is the batch and row_id
+# columns of its last row, and limit stops after that many trips. Who searched
+# and the addresses they typed in are left out.
+@app.route("/statistics/export")
+@login_required
+def export_trips():
+    format_ = request.args.get("format", "arrow" if export.pyarrow else "csv")
+    if format_ not in ("arrow", "csv") or (
+        format_ == "arrow" and not export.pyarrow
+    ):
+        return jsonify({"error": "format must be arrow or csv"}), 400
+    chunks = export.read_chunks(
+        (
+            request.args.get("after_batch", type=int, default=0),
+            request.args.get("after_row", type=int, default=0)
+        ),
+        limit=request.args.get("limit", type=int)
+    )
+    return Response(
+        stream_with_context(export.stream(chunks, format_)),
+        mimetype=(
+            "application/vnd.apache.arrow.stream" if format_ == "arrow"
+            else "application/gzip"
+        ),
+        headers={"Content-Disposition": "attachment; filename=trips{}".format(
+            export.EXTENSIONS[format_]
+        )}
     )
 
 
+# Choices for the desert map, as (value, label).
+DESERT_RADII = [
+    (str(radius), label) for radius, label in zip(
+        desertgrid.RADII, ["1/4 mile", "1/2 mile", "3/4 mile", "1 mile"]
+    )
+]
+DESERT_KINDS = [
+    ("transit", "No subway or bike"), ("subway", "No subway"),
+    ("ada", "No ADA accessible subway")
+]
+
+
+# Government map of transit deserts, from the desert grid.
+@app.route("/deserts")
+def load_deserts():
+    radius = request.args.get("radius", DESERT_RADII[1][0])
+    kind = request.args.get("kind", "transit")
+    return render_template(
+        "deserts.html", radii=DESERT_RADII, kinds=DESERT_KINDS,
+        radius=radius, kind=kind, ready=desertgrid.get_grid() is not None
+    )
+
+
+# The desert cells for the map, as JSON. step merges that many cells each way
+# into one, for a lighter map.
+@app.route("/deserts.json")
+def desert_cells():
+    grid = desertgrid.get_grid()
+    kind = request.args.get("kind", "transit")
+    if grid is None or kind not in dict(DESERT_KINDS):
+        return jsonify({"cells": []})
+    radius = request.args.get("radius", type=float, default=0.8)
+    step = request.args.get("step", type=int, default=2)
+    return jsonify({
+        "radius": radius, "kind": kind,
+        "cells": grid.desert_cells(radius, kind, step)
+    })
+
+
 # Government analytics for businesses.
 @app.route("/businessdata", methods=["POST", "GET"])
 def load_business_statistics():
@@ -416,38 +692,30 @@ def load_business_statistics():
         "Businesses with Discounts": 0,
         "Businesses on Consumer Map": 0
     }
-    if form.validate_on_submit():
-        # If you'd like to map everything.
-        if (form.map_all.data):
-            business_locations = businessdata.get_all_locations()
-        # Otherwise, map just the filtered results.
-        else:
-            data_load = (
-                form.filters.data,
-                form.and_or.data,
-                form.categories.data
-            )
-            filtered_statistics = businessdata.get_filtered_data(*data_load)
-            filtered_totals["Businesses Registered"] = \
-                filtered_statistics["registered"]
-            filtered_totals["Businesses with Promotions"] = \
-                filtered_statistics["promotion"]
-            filtered_totals["Businesses with Discounts"] = \
-                filtered_statistics["discounted"]
-            filtered_totals["Businesses on Consumer Map"] = \
-                filtered_statistics["displayed"]
-            business_locations = (
-                businessdata.get_filtered_locations(*data_load)
-            )
-    else:
-        # Map all if there was no form submitted.
-        business_locations = businessdata.get_all_locations()
-    # In any event, run through and make dictionaries out of the sqlite rows.
-    business_locations = [
-        dict(location) for location in business_locations
-    ]
+    # The map fetches clusters of these businesses itself, as it's moved.
+    cluster_filters = {}
+    if form.validate_on_submit() and not form.map_all.data:
+        # Map just the filtered results, unless you'd like to map everything.
+        data_load = (
+            form.filters.data,
+            form.and_or.data,
+            form.categories.data
+        )
+        filtered_statistics = businessdata.get_filtered_data(*data_load)
+        filtered_totals["Businesses Registered"] = \
+            filtered_statistics["registered"]
+        filtered_totals["Businesses with Promotions"] = \
+            filtered_statistics["promotion"]
+        filtered_totals["Businesses with Discounts"] = \
+            filtered_statistics["discounted"]
+        filtered_totals["Businesses on Consumer Map"] = \
+            filtered_statistics["displayed"]
+        cluster_filters = {
+            "filters": ",".join(form.filters.data), "type": form.and_or.data,
+            "categories": ",".join(form.categories.data)
+        }
     return render_template(
         "businessdata.html", result=business_statistics,
         totals=totals, form=form, filtered_totals=filtered_totals,
-        locations=business_locations, categories=categories
+        cluster_filters=cluster_filters, categories=categories
     )
@@ -0,0 +1,38 @@
+import time
+import bisect
+import dateutil.parser
+
+
+# Turns one of Coord's ISO 8601 times into an integer epoch.
+def to_epoch(iso_time):
+    return int(dateutil.parser.parse(iso_time).timestamp())
+
+
+# Turns sorted train epochs into sorted, unique whole minutes from now. Since
+# the epochs are sorted the minutes come out sorted too, so duplicates are
+# always next to each other.
+def to_minutes(times, now):
+    minutes = []
+    for train_time in times:
+        minute = (train_time - now) // 60
+        if not minutes or minutes[-1] != minute:
+            minutes.append(minute)
+    return minutes
+
+
+# Works out the real time for many legs at once. legs is a list of
+# (train_times, start_epoch) pairs, and for each leg a list of minutes from now
+# is returned. Each list has every train once, sorted, and only the trains no
+# earlier than the minute the user is estimated to reach the station. Legs
+# that share the same train_times list only convert it once.
+def minutes_from_now(legs, now=None):
+    now = int(time.time()) if now is None else int(now)
+    converted = {}
+    results = []
+    for train_times, start in legs:
+        if id(train_times) not in converted:
+            converted[id(train_times)] = to_minutes(sorted(train_times), now)
+        minutes = converted[id(train_times)]
+        earliest = (start - now) // 60
+        results.append(minutes[bisect.bisect_left(minutes, earliest):])
+    return results
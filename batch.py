@@ -0,0 +1,180 @@
+import sys
+import csv
+import json
+import argparse
+import collections
+import concurrent.futures
+import api
+import statistics
+
+# Used for any pair that doesn't give its own.
+DEFAULT_RADIUS = 0.8
+DEFAULT_PREFERENCES = {"ada": 0, "student": 0, "senior": 0, "income": 0}
+# How many pairs are planned at once, and how many trips are written per
+# transaction.
+WORKERS = 8
+COMMIT_EVERY = 200
+# The most pairs one request to /batch may plan.
+MAX_PAIRS = 1000
+
+
+# Writes trips through statistics.write_trip on a queue of its own, written
+# commit_every trips at a time, and all of them by close. An instance can be
+# passed to get_directions as its writer.
+class BulkWriter:
+
+    def __init__(
+        self, path=statistics.STATISTICS_FILE, commit_every=COMMIT_EVERY
+    ):
+        self.queue = statistics.TripQueue(path, batch_size=commit_every)
+
+    def __call__(self, *args):
+        return statistics.write_trip(*args, queue=self.queue)
+
+    def close(self):
+        self.queue.close()
+
+
+# Reads pairs from a CSV with origin and destination columns, and optionally
+# radius, ada, student, senior and income.
+def read_pairs(f):
+    return list(csv.DictReader(f))
+
+
+# Checks pairs are a list of dictionaries with an origin and a destination,
+# and no more than most of them. Raises ValueError if they aren't.
+def check_pairs(pairs, most=MAX_PAIRS):
+    if not isinstance(pairs, list):
+        raise ValueError("pairs must be a list")
+    if len(pairs) > most:
+        raise ValueError("at most {} pairs at a time".format(most))
+    for index, pair in enumerate(pairs):
+        if not isinstance(pair, dict) or \
+                not pair.get("origin") or not pair.get("destination"):
+            raise ValueError(
+                "pair {} needs an origin and a destination".format(index)
+            )
+    return pairs
+
+
+# Fills in the radius and preferences for a pair, from its own values if it
+# has them. Pairs can come from a CSV, where everything is a string.
+def prepare(pair, radius):
+    preferences = dict(DEFAULT_PREFERENCES)
+    for key in preferences:
+        value = pair.get(key)
+        if value not in (None, ""):
+            preferences[key] = float(value) if key == "income" else \
+                int(str(value).lower() in ("1", "true", "yes", "y"))
+    pair_radius = pair.get("radius")
+    return (
+        float(pair_radius) if pair_radius not in (None, "") else radius,
+        preferences
+    )
+
+
+# Cuts a trip object down to what's useful in a batch result.
+def summarize(trip):
+    return [
+        {
+            "id": option.get("id"),
+            "duration_s": option["statistics"].get("duration_s"),
+            "distance_km": option["statistics"].get("distance_km"),
+            "modes": [leg["mode"] for leg in option["legs"]],
+        }
+        for option in trip["trips"]
+    ]
+
+
+# Plans one pair, returning its result dictionary. Errors are reported in the
+# result rather than stopping the batch. Nobody is waiting on a batch, so
+# there's no deadline, and no real time, since it'd be stale by the time the
+# results are read.
+def plan_pair(index, pair, radius, user_id, writer, full):
+    result = {
+        "index": index,
+        "origin": pair["origin"],
+        "destination": pair["destination"],
+    }
+    try:
+        pair_radius, preferences = prepare(pair, radius)
+        trip, changes = api.get_directions(
+            pair["origin"], pair["destination"], pair_radius, preferences,
+            user_id, writer=writer, with_real_time=False, budget=False
+        )
+    except Exception as e:
+        result["ok"] = False
+        result["error"] = repr(e)
+        return result
+    if not trip or not trip.get("trips"):
+        result["ok"] = False
+        result["error"] = "No directions found"
+        return result
+    result["ok"] = True
+    result["trip_id"] = trip.get("id")
+    result["changes"] = dict(changes)
+    result["trips"] = trip if full else summarize(trip)
+    return result
+
+
+# Plans every pair, yielding results as they finish, which isn't necessarily
+# the order they were given in. Every distinct address is geocoded once up
+# front, so the pairs themselves only hit the geocode cache. No more than
+# workers pairs are in flight at a time.
+def plan(
+    pairs, radius=DEFAULT_RADIUS, user_id=0, workers=WORKERS,
+    commit_every=COMMIT_EVERY, full=False
+):
+    pairs = list(pairs)
+    writer = BulkWriter(commit_every=commit_every)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            addresses = collections.OrderedDict.fromkeys(
+                address for pair in pairs
+                for address in (pair["origin"], pair["destination"])
+            )
+            # Failures here show up again, per pair, when they're planned.
+            for future in [
+                pool.submit(api.get_location_coordinates, address)
+                for address in addresses
+            ]:
+                future.exception()
+            waiting = collections.deque(enumerate(pairs))
+            running = set()
+            while waiting or running:
+                while waiting and len(running) < workers:
+                    index, pair = waiting.popleft()
+                    running.add(pool.submit(
+                        plan_pair, index, pair, radius, user_id, writer, full
+                    ))
+                done, running = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    yield future.result()
+    finally:
+        writer.close()
+
+
+if __name__ == "__main__":
+    # Like python batch.py pairs.csv > results.jsonl
+    parser = argparse.ArgumentParser(
+        description="Plan trips for every origin/destination pair in a CSV."
+    )
+    parser.add_argument("pairs", help="CSV with origin and destination")
+    parser.add_argument("--radius", type=float, default=DEFAULT_RADIUS)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--user-id", type=int, default=0)
+    parser.add_argument("--commit-every", type=int, default=COMMIT_EVERY)
+    parser.add_argument(
+        "--full", action="store_true", help="include whole trip objects"
+    )
+    args = parser.parse_args()
+    with open(args.pairs) as f:
+        pairs = read_pairs(f)
+    for result in plan(
+        pairs, args.radius, args.user_id, args.workers, args.commit_every,
+        args.full
+    ):
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
@@ -0,0 +1,439 @@
+import os
+import gc
+import sys
+import copy
+import json
+import time
+import random
+import platform
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+import collections
+import vincenty
+import database
+from google.transit import gtfs_realtime_pb2
+import api
+import stations
+import accessibility
+import mtafeeds
+import statistics
+
+# Benchmarks every step of api.get_directions on its own, so slowdowns show up
+# per stage between releases. Like:
+#     python benchmarks.py --output results.json
+#     python benchmarks.py --output new.json --compare results.json
+# The inputs are the same every run. The Coord trip and MTA feeds are made up
+# from stations.csv with a fixed seed, unless recorded ones are given with
+# --trip and --feeds (see SAVE_RECORD_DIR in the README).
+SEED = 2019
+# Searches to look up, spread over the city.
+POINTS = 200
+# Bounds the made up searches are picked from.
+BOUNDS = ((40.57, -74.04), (40.90, -73.75))
+# Made up feeds have this many trains per route, stopping at every station.
+TRAINS_PER_ROUTE = 40
+# Runs per stage. Cold runs start from nothing loaded, warm ones don't.
+WARM_RUNS = 50
+COLD_RUNS = 5
+
+
+# Returns count deterministic coordinates within BOUNDS.
+def make_points(count=POINTS, seed=SEED):
+    generator = random.Random(seed)
+    (south, west), (north, east) = BOUNDS
+    return [
+        (generator.uniform(south, north), generator.uniform(west, east))
+        for _ in range(count)
+    ]
+
+
+# Formats an epoch the way Coord does.
+def iso(epoch):
+    return datetime.datetime.fromtimestamp(
+        epoch, datetime.timezone.utc
+    ).isoformat()
+
+
+# Makes a leg shaped like the ones Coord returns.
+def make_leg(mode, start, end, start_time, end_time, route=None):
+    leg = {
+        "mode": mode,
+        "geometry": {"coordinates": [
+            [start.longitude, start.latitude], [end.longitude, end.latitude]
+        ]},
+        "statistics": {
+            "start_time": iso(start_time), "end_time": iso(end_time),
+            "duration_s": end_time - start_time,
+            "distance_km": round(vincenty.vincenty(
+                (start.latitude, start.longitude),
+                (end.latitude, end.longitude)
+            ) or 0, 3),
+        },
+    }
+    if mode == "metro":
+        leg["transit_route"] = route
+        leg["station_start"] = {"id": start.stop_id + "N", "name": start.name}
+        leg["station_end"] = {"id": end.stop_id + "N", "name": end.name}
+    return leg
+
+
+# Makes a Coord style trip with options trip options, each a walk, two metro
+# legs with a transfer, and a walk. now is when the trip starts.
+def make_trip(now, options=3, seed=SEED):
+    generator = random.Random(seed)
+    by_route = collections.defaultdict(list)
+    for station in stations.load_stations():
+        for route in station.routes:
+            if route in api.FEED_ID:
+                by_route[route].append(station)
+    routes = sorted(by_route)
+    trips = []
+    for option in range(options):
+        first, second = generator.sample(routes, 2)
+        board, transfer = generator.sample(by_route[first], 2)
+        alight = generator.choice(by_route[second])
+        times = [now + option * 120 + step * 600 for step in range(5)]
+        legs = [
+            make_leg("walk", board, board, times[0], times[1]),
+            make_leg("metro", board, transfer, times[1], times[2], first),
+            make_leg("metro", transfer, alight, times[2], times[3], second),
+            make_leg("walk", alight, alight, times[3], times[4]),
+        ]
+        trips.append({
+            "legs": legs,
+            "statistics": {
+                "start_time": iso(times[0]), "end_time": iso(times[4]),
+                "duration_s": times[4] - times[0],
+                "distance_km": sum(
+                    leg["statistics"]["distance_km"] for leg in legs
+                ),
+            },
+        })
+    return {"trips": trips}
+
+
+# Makes serialized GTFS realtime feeds, as {feed_id: bytes}. Every train on a
+# route stops at each of its stations in both directions, a couple of minutes
+# apart, like the real feeds.
+def make_feeds(now, seed=SEED):
+    generator = random.Random(seed)
+    by_route = collections.defaultdict(list)
+    for station in stations.load_stations():
+        for route in station.routes:
+            if route in api.FEED_ID:
+                by_route[route].append(station.stop_id)
+    feeds = {}
+    for route in sorted(by_route):
+        feed_id = api.FEED_ID[route]
+        if feed_id not in feeds:
+            feeds[feed_id] = gtfs_realtime_pb2.FeedMessage()
+            feeds[feed_id].header.gtfs_realtime_version = "1.0"
+            feeds[feed_id].header.timestamp = now
+        feed = feeds[feed_id]
+        for train in range(TRAINS_PER_ROUTE):
+            for direction in "NS":
+                entity = feed.entity.add()
+                entity.id = "{}{}{}".format(route, train, direction)
+                entity.trip_update.trip.route_id = route
+                departure = now + train * 300 + generator.randint(0, 120)
+                for stop_id in by_route[route]:
+                    update = entity.trip_update.stop_time_update.add()
+                    update.stop_id = stop_id + direction
+                    update.arrival.time = departure
+                    update.departure.time = departure + 30
+                    departure += 90
+    return {
+        feed_id: feed.SerializeToString() for feed_id, feed in feeds.items()
+    }
+
+
+# Loads feeds recorded by upstream.get, named like feed_1.bin.
+def load_feeds(directory):
+    return {
+        name[len("feed_"):-len(".bin")]: open(
+            os.path.join(directory, name), "rb"
+        ).read()
+        for name in sorted(os.listdir(directory))
+        if name.startswith("feed_") and name.endswith(".bin")
+    }
+
+
+# Decodes every feed into ArrivalIndexes, the way the feed manager does.
+def decode_feeds(feeds):
+    decoded = {}
+    for feed_id, content in feeds.items():
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(content)
+        decoded[feed_id] = mtafeeds.build_arrivals(feed)
+    return decoded
+
+
+# Stands in for api.realtime, handing out already decoded feeds so
+# api.find_station runs as usual without touching the network. Feeds that
+# weren't given, like ones missing from a recording, have no trains.
+class DecodedFeeds:
+
+    def __init__(self, decoded, now):
+        self.decoded = decoded
+        self.now = now
+        self.empty = mtafeeds.build_arrivals(gtfs_realtime_pb2.FeedMessage())
+
+    def get(self, feed_ids):
+        return {
+            feed_id: mtafeeds.Snapshot(
+                feed_id, self.decoded.get(feed_id, self.empty), self.now,
+                self.now
+            )
+            for feed_id in feed_ids
+        }
+
+
+# Forgets every loaded index, so the next lookup starts cold.
+def reset_indexes():
+    stations._index = None
+    accessibility._index = None
+    accessibility._checked = 0
+
+
+# Runs fn(setup()) runs times, timing only fn. Returns the times in seconds.
+def timed(fn, setup, runs):
+    times = []
+    for _ in range(runs):
+        state = setup()
+        gc.collect()
+        start = time.perf_counter()
+        fn(state)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+# Summarizes times in seconds as milliseconds.
+def summarize(times):
+    times = sorted(times)
+    return {
+        "runs": len(times),
+        "min_ms": times[0] * 1000,
+        "median_ms": times[len(times) // 2] * 1000,
+        "mean_ms": sum(times) / len(times) * 1000,
+        "p95_ms": times[min(int(len(times) * 0.95), len(times) - 1)] * 1000,
+        "max_ms": times[-1] * 1000,
+    }
+
+
+# Measures the memory one call of fn allocates, with tracemalloc. peak is the
+# most it had at once, retained is what's still held afterwards.
+def allocations(fn, setup):
+    state = setup()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    fn(state)
+    current, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(
+        stat.count_diff for stat in after.compare_to(before, "filename")
+        if stat.count_diff > 0
+    )
+    return {
+        "peak_kb": (peak - baseline) / 1024,
+        "retained_kb": (current - baseline) / 1024,
+        "blocks": blocks,
+    }
+
+
+# Benchmarks one stage. cold resets whatever the stage caches before each cold
+# run, and is left out for stages that don't cache anything.
+def bench(fn, setup, warm_runs, cold_runs, cold=None):
+    result = {}
+    if cold:
+        def cold_setup():
+            cold()
+            return setup()
+        result["cold"] = summarize(timed(fn, cold_setup, cold_runs))
+    fn(setup())
+    result["warm"] = summarize(timed(fn, setup, warm_runs))
+    result["memory"] = allocations(fn, setup)
+    return result
+
+
+# Returns the stages to benchmark, as {name: (fn, setup, cold)}. Each fn
+# covers every search in points, or the whole trip.
+def stages(points, trip, feeds, database_file):
+    api.realtime = DecodedFeeds(decode_feeds(feeds), time.time())
+    station_ids, lines = api.metro_stops(trip)
+    real_time = api.find_station(station_ids, lines)
+    nearby = [stations.nearest(lat, lon, k=20) for lat, lon in points]
+
+    def no_setup():
+        return None
+
+    def trip_copy():
+        return copy.deepcopy(trip)
+
+    def nearest_subway(state):
+        for lat, lon in points:
+            api.nearest_subway(lat, lon)
+
+    def nearest_ada_subway(state):
+        for lat, lon in points:
+            api.nearest_subway(
+                lat, lon, predicate=accessibility.is_ada_station
+            )
+
+    def ada_list(state):
+        for found in nearby:
+            api.ada_list(found)
+
+    def add_ride_share(state):
+        api.add_ride_share(state)
+        api.add_ride_share(state, True)
+
+    def decode(state):
+        decode_feeds(feeds)
+
+    def find_station(state):
+        api.find_station(station_ids, lines)
+
+    def add_real_time(state):
+        api.add_real_time(state, real_time)
+
+    # Only flushed when asked, so write_trip times what a search waits for
+    # and flush_trips the database work done behind it.
+    queue = statistics.TripQueue(
+        database_file, batch_size=float("inf"), interval=3600
+    )
+
+    def write_trip(state):
+        statistics.write_trip(
+            40.7, -73.9, 40.8, -73.95, state, {"transit_desert": 1},
+            time.asctime(), 0, "origin", "destination", queue=queue
+        )
+
+    def write_setup():
+        queue.flush()
+        return trip_copy()
+
+    def flush_trips(state):
+        queue.flush()
+
+    def flush_setup():
+        state = write_setup()
+        for _ in range(10):
+            write_trip(copy.deepcopy(state))
+        return state
+
+    def new_database():
+        queue.flush()
+        with database.connect(database_file) as connection:
+            connection.execute("DELETE FROM trips")
+
+    return collections.OrderedDict([
+        ("nearest_subway", (nearest_subway, no_setup, reset_indexes)),
+        ("nearest_ada_subway", (nearest_ada_subway, no_setup, reset_indexes)),
+        ("ada_list", (ada_list, no_setup, reset_indexes)),
+        ("add_ride_share", (add_ride_share, trip_copy, None)),
+        ("find_station_decode", (decode, no_setup, None)),
+        ("find_station_lookup", (find_station, no_setup, None)),
+        ("add_real_time", (add_real_time, trip_copy, None)),
+        ("write_trip", (write_trip, write_setup, new_database)),
+        ("flush_trips", (flush_trips, flush_setup, new_database)),
+    ])
+
+
+# Compares two results files, printing how much slower or faster each stage
+# got. Returns the stages that got slower than threshold times.
+def compare(results, baseline, threshold):
+    slower = []
+    for name, result in results["stages"].items():
+        old = baseline["stages"].get(name)
+        if not old:
+            continue
+        ratio = result["warm"]["median_ms"] / old["warm"]["median_ms"]
+        print("{:22} {:10.3f} ms -> {:10.3f} ms  x{:.2f}".format(
+            name, old["warm"]["median_ms"], result["warm"]["median_ms"],
+            ratio
+        ))
+        if ratio > threshold:
+            slower.append(name)
+    return slower
+
+
+# Runs every stage, or just the ones named, and returns the results.
+def run(
+    trip_file=None, feed_dir=None, only=None, warm_runs=WARM_RUNS,
+    cold_runs=COLD_RUNS
+):
+    # The trip and feeds are made relative to now so the real time is always
+    # in the future, but the same otherwise.
+    now = int(time.time()) // 60 * 60
+    if trip_file:
+        with open(trip_file) as f:
+            trip = json.load(f)
+    else:
+        trip = make_trip(now)
+    feeds = load_feeds(feed_dir) if feed_dir else make_feeds(now)
+    points = make_points()
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "inputs": {
+            "points": len(points),
+            "trip": trip_file or "synthetic",
+            "trip_options": len(trip["trips"]),
+            "feeds": feed_dir or "synthetic",
+            "feed_bytes": sum(len(content) for content in feeds.values()),
+        },
+        "stages": collections.OrderedDict(),
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for name, (fn, setup, cold) in stages(
+            points, trip, feeds, os.path.join(directory, "statistics.db")
+        ).items():
+            if only and name not in only:
+                continue
+            results["stages"][name] = bench(
+                fn, setup, warm_runs, cold_runs, cold
+            )
+            print("{:22} warm {:10.3f} ms".format(
+                name, results["stages"][name]["warm"]["median_ms"]
+            ), file=sys.stderr)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark each stage of planning a trip."
+    )
+    parser.add_argument("--output", help="where to save the results JSON")
+    parser.add_argument("--compare", help="results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="exit with an error if a stage gets this much "
+                        "slower than in --compare")
+    parser.add_argument("--trip", help="a recorded Coord trip JSON")
+    parser.add_argument("--feeds", help="a folder of recorded MTA feeds")
+    parser.add_argument("--stage", action="append",
+                        help="only run this stage, can be given more than "
+                        "once")
+    parser.add_argument("--warm-runs", type=int, default=WARM_RUNS)
+    parser.add_argument("--cold-runs", type=int, default=COLD_RUNS)
+    args = parser.parse_args()
+    results = run(
+        args.trip, args.feeds, args.stage, args.warm_runs, args.cold_runs
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    else:
+        json.dump(results, sys.stdout, indent=4)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
@@ -0,0 +1,158 @@
+import os
+import sys
+import json
+import time
+import threading
+import collections
+import vincenty
+import spatial
+import upstream
+
+# A GeoJSON FeatureCollection of bike stations, in the same format Coord's
+# /bike/location returns. If it's set, stations are read from here instead of
+# from Coord, which is handy for tests and offline runs.
+BIKE_FILE = os.environ.get("SAVE_BIKE_FILE")
+# The snapshot from Coord covers everything within RADIUS_KM of CENTER.
+CENTER = (40.7128, -74.0060)
+RADIUS_KM = 40
+# Seconds between refreshes of the snapshot.
+REFRESH_INTERVAL = 15 * 60
+# Seconds to wait before trying again when there's no snapshot at all and
+# loading one failed.
+RETRY_INTERVAL = 60
+
+# Slim record for a bike-share station. dist works like it does for Station.
+BikeStation = collections.namedtuple(
+    "BikeStation", ["id", "name", "system_id", "latitude", "longitude", "dist"]
+)
+
+_index = None
+_loaded = 0
+_failed = 0
+_refreshing = False
+_index_lock = threading.Lock()
+
+
+# Turns Coord's GeoJSON into a list of BikeStation records.
+def parse_features(d):
+    records = []
+    for feature in d.get("features") or []:
+        longitude, latitude = feature["geometry"]["coordinates"][:2]
+        properties = feature.get("properties") or {}
+        records.append(BikeStation(
+            feature.get("id") or properties.get("location_id"),
+            properties.get("name"), properties.get("system_id"),
+            float(latitude), float(longitude), 0
+        ))
+    return records
+
+
+# Asks Coord for every bike station in the area, as GeoJSON.
+def fetch_features():
+    response = upstream.get("coord", "/v1/bike/location", params={
+        "access_key": upstream.credential("coord"),
+        "latitude": CENTER[0],
+        "longitude": CENTER[1],
+        "radius_km": RADIUS_KM,
+    })
+    response.raise_for_status()
+    return response.json()
+
+
+# Gets every bike station, from BIKE_FILE if it's set, otherwise from Coord.
+def load_bike_stations():
+    if BIKE_FILE:
+        with open(BIKE_FILE) as f:
+            return parse_features(json.load(f))
+    return parse_features(fetch_features())
+
+
+# Builds the index. An empty snapshot is treated as a failed one, since it
+# would say there are no bikes anywhere.
+def build_index():
+    bike_stations = load_bike_stations()
+    if not bike_stations:
+        raise ValueError("No bike stations in snapshot")
+    return spatial.GridIndex(
+        bike_stations, lambda station: (station.latitude, station.longitude)
+    )
+
+
+# Whether the snapshot from Coord covers the coordinate, with room for the
+# radius being asked about.
+def covers(lat, lon, km):
+    if BIKE_FILE:
+        return True
+    return vincenty.vincenty(
+        CENTER, (float(lat), float(lon))
+    ) + float(km) <= RADIUS_KM
+
+
+# Rebuilds the index in the background. The old one keeps being used until
+# the new one is ready, and kept if the refresh fails.
+def _refresh():
+    global _index, _loaded, _refreshing
+    try:
+        index = build_index()
+        with _index_lock:
+            _index, _loaded = index, time.time()
+    except Exception:
+        with _index_lock:
+            # Wait a full interval before trying again.
+            _loaded = time.time()
+    finally:
+        _refreshing = False
+
+
+# Returns the bike station index, or None if there's no snapshot and one
+# couldn't be loaded. The first load happens right away, and after that the
+# snapshot is refreshed in the background when it gets old.
+def get_index():
+    global _index, _loaded, _refreshing, _failed
+    if _index is None:
+        if time.time() - _failed < RETRY_INTERVAL:
+            return None
+        with _index_lock:
+            if _index is None:
+                try:
+                    _index, _loaded = build_index(), time.time()
+                except Exception:
+                    _failed = time.time()
+                    return None
+    if time.time() - _loaded > REFRESH_INTERVAL and not _refreshing:
+        with _index_lock:
+            if _refreshing:
+                return _index
+            _refreshing = True
+        threading.Thread(target=_refresh, daemon=True).start()
+    return _index
+
+
+# Returns whether there's a bike station within km of the coordinate, or None
+# if that can't be answered without asking Coord.
+def is_near(lat, lon, km):
+    if not covers(lat, lon, km):
+        return None
+    index = get_index()
+    if index is None:
+        return None
+    nearest = index.nearest(lat, lon)
+    return bool(nearest) and nearest[0][0] <= float(km)
+
+
+# Returns every bike station within km of the coordinate, closest first.
+def within(lat, lon, km):
+    index = get_index()
+    if index is None:
+        return []
+    return [
+        station._replace(dist=dist)
+        for dist, station in index.within(lat, lon, float(km))
+    ]
+
+
+if __name__ == "__main__":
+    # Saves a snapshot from Coord that can be used as BIKE_FILE later, like
+    # python bikes.py bikes.json
+    with open(sys.argv[1], "w") as f:
+        json.dump(fetch_features(), f)
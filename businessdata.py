@@ -1,10 +1,13 @@
-import sqlite3
+import database
+import rollups
 import csv
 import random
 import api
 
+BUSINESS_FILE = "business.db"
 
-# Creates business table schema. For use everywhere. Takes a cursor/connection.
+
+# Creates business table schema. Run once, as the database's first migration.
 def create_business_table(cursor):
     query = '''CREATE TABLE IF NOT EXISTS businesses(
                     name TEXT DEFAULT NULL,
@@ -21,12 +24,18 @@ def create_business_table(cursor):
     cursor.execute(query)
 
 
+# Adds the rollups. Only generation is kept, a count of changes to the
+# businesses, so anything cached from them knows when it's out of date.
+def add_rollups(connection):
+    rollups.create_table(connection)
+
+
+database.register(BUSINESS_FILE, create_business_table, add_rollups)
+
+
 # Get businesses that choose to display themselves on the map.
 def get_displayed_locations():
-    connection = sqlite3.connect('business.db')
-    connection.row_factory = sqlite3.Row
-    with connection:
-        create_business_table(connection)
+    with database.connect(BUSINESS_FILE, rows=True) as connection:
         locations = connection.execute(
             '''SELECT latitude, longitude,
                         name, address, promotion, discount
@@ -39,9 +48,7 @@ def get_displayed_locations():
 
 # Given business name (username), and password, check that they match.
 def verify_business(name, password):
-    connection = sqlite3.connect('business.db')
-    with connection:
-        create_business_table(connection)
+    with database.connect(BUSINESS_FILE) as connection:
         password_check = connection.execute(
             '''
             SELECT password FROM businesses WHERE name = ?
@@ -54,9 +61,7 @@ def verify_business(name, password):
 
 # Add business given business name and password.
 def add_business(name, password):
-    connection = sqlite3.connect('business.db')
-    with connection:
-        create_business_table(connection)
+    with database.connect(BUSINESS_FILE) as connection:
         if (
             connection.execute(
                 '''
@@ -70,14 +75,13 @@ def add_business(name, password):
             INSERT INTO businesses (name, password) VALUES (?,?)
             ''', (name, password,)
         )
+        rollups.add(connection, {"generation": 1})
     return True
 
 
 # Get business id (user id) given business name (username).
 def get_business_id(name):
-    connection = sqlite3.connect('business.db')
-    with connection:
-        create_business_table(connection)
+    with database.connect(BUSINESS_FILE) as connection:
         return connection.execute(
             '''
             SELECT id FROM businesses WHERE name = ?
@@ -87,9 +91,7 @@ def get_business_id(name):
 
 # Get business settings/preferences given id.
 def get_setting(user_id):
-    connection = sqlite3.connect('business.db')
-    connection.row_factory = sqlite3.Row
-    with connection:
+    with database.connect(BUSINESS_FILE, rows=True) as connection:
         settings = connection.execute(
             '''
             SELECT
@@ -106,12 +108,19 @@ def get_setting(user_id):
 def save_settings(user_id, settings):
     # Combine into a single dictionary for ease.
     business_dict = {**dict(user_id=user_id), **settings}
-    print(business_dict)
-    connection = sqlite3.connect('business.db')
-    with connection:
+    with database.connect(BUSINESS_FILE) as connection:
         if settings["address"]:
-            business_dict["latitude"], business_dict["longitude"] = \
-                api.get_location_coordinates(settings["address"])
+            current = connection.execute(
+                '''SELECT address, latitude, longitude FROM businesses
+                    WHERE id = ?''', (user_id,)
+            ).fetchone()
+            # Only geocode again if the address actually changed.
+            if current and current[1] and current[0] == settings["address"]:
+                business_dict["latitude"], business_dict["longitude"] = \
+                    current[1], current[2]
+            else:
+                business_dict["latitude"], business_dict["longitude"] = \
+                    api.get_location_coordinates(settings["address"])
         connection.execute('''UPDATE businesses SET
                                 category = :category,
                                 address = :address,
@@ -122,15 +131,13 @@ def save_settings(user_id, settings):
                                 discount = :discount
                                 WHERE
                                     id = :user_id''', business_dict)
+        rollups.add(connection, {"generation": 1})
     return True
 
 
 # Get all business locations for display on statistics page.
 def get_all_locations():
-    connection = sqlite3.connect('business.db')
-    connection.row_factory = sqlite3.Row
-    with connection:
-        create_business_table(connection)
+    with database.connect(BUSINESS_FILE, rows=True) as connection:
         locations = connection.execute(
             '''SELECT latitude, longitude,
                         name, address
@@ -142,10 +149,7 @@ def get_all_locations():
 
 # Get all categories, for statistics filtering.
 def get_categories():
-    connection = sqlite3.connect('business.db')
-    connection.row_factory = sqlite3.Row
-    with connection:
-        create_business_table(connection)
+    with database.connect(BUSINESS_FILE, rows=True) as connection:
         categories = connection.execute(
             '''SELECT DISTINCT category FROM businesses'''
         ).fetchall()
@@ -154,10 +158,7 @@ def get_categories():
 
 # Get data totals for statistics.
 def get_data():
-    connection = sqlite3.connect('business.db')
-    connection.row_factory = sqlite3.Row
-    with connection:
-        create_business_table(connection)
+    with database.connect(BUSINESS_FILE, rows=True) as connection:
         count_fetch = connection.execute(
             '''
             SELECT
@@ -177,10 +178,7 @@ def get_data():
 # Get data filtered by category and other filters, as designated on
 # business data page.
 def get_filtered_data(filters, type_, categories):
-    connection = sqlite3.connect('business.db')
-    connection.row_factory = sqlite3.Row
-    with connection:
-        create_business_table(connection)
+    with database.connect(BUSINESS_FILE, rows=True) as connection:
         # Will query like "WHERE filters[0] = 1 type_ filters[1] = 1".
         # type_ will be AND or OR. categories_string will be inserted.
         reference = {
@@ -210,10 +208,7 @@ def get_filtered_data(filters, type_, categories):
 
 
 def get_filtered_locations(filters, type_, categories):
-    connection = sqlite3.connect('business.db')
-    connection.row_factory = sqlite3.Row
-    with connection:
-        create_business_table(connection)
+    with database.connect(BUSINESS_FILE, rows=True) as connection:
         # The names as they're displayed do not match the database keys.
         # This fixes it, sort of.
         reference = {
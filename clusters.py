@@ -0,0 +1,171 @@
+import math
+import threading
+import collections
+import database
+import rollups
+import statistics
+import businessdata
+
+# Groups map points into clusters on the server, so the maps get a few
+# hundred counts and centroids instead of every trip and business. Points are
+# put in grid cells sized for the zoom, and each cell is one cluster, counted
+# in a single grouped query. Results are cached until whatever they count is
+# written to again.
+
+# How wide a cell is on screen, in pixels, at any zoom.
+CELL_PIXELS = 60
+MIN_ZOOM = 0
+MAX_ZOOM = 20
+# Most results kept in the cache.
+CACHE_SIZE = 256
+
+# The columns each kind of point is in, as (latitude, longitude).
+TRIP_POINTS = collections.OrderedDict([
+    ("origins", ("origin_latitude", "origin_longitude")),
+    ("destinations", ("destination_latitude", "destination_longitude")),
+])
+# What the business filters are called on the page, and their columns.
+BUSINESS_FILTERS = {
+    "displayed": "display_on_map", "promotion": "promotion",
+    "discounted": "discount",
+}
+
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+# Degrees a cell is wide at a zoom, from how many pixels wide the whole
+# world is at that zoom.
+def cell_size(zoom):
+    return CELL_PIXELS * 360 / (256 * 2 ** zoom)
+
+
+# Widens a bounding box, (south, west, north, east), out to whole cells, so
+# maps that moved a little share cached results. Returns the box as cells.
+def snap(bbox, size):
+    south, west, north, east = bbox
+    return (
+        math.floor((south + 90) / size), math.floor((west + 180) / size),
+        math.floor((north + 90) / size), math.floor((east + 180) / size),
+    )
+
+
+# Groups the rows from_ and where give into cells, with extra aggregates for
+# each cell as well. Returns a list of clusters, each with its count and
+# centroid.
+def _cluster(connection, latitude, longitude, from_, where, parameters,
+             zoom, bbox, extra=""):
+    size = cell_size(zoom)
+    bottom, left, top, right = snap(bbox, size)
+    query = '''SELECT
+                    CAST(({lat} + 90) / :size AS INTEGER) AS cell_row,
+                    CAST(({lon} + 180) / :size AS INTEGER) AS cell_col,
+                    COUNT(*) AS count,
+                    AVG({lat}) AS latitude,
+                    AVG({lon}) AS longitude{extra}
+                FROM {from_}
+                WHERE {lat} >= :south AND {lat} < :north
+                    AND {lon} >= :west AND {lon} < :east
+                    AND ({where})
+                GROUP BY cell_row, cell_col'''.format(
+        lat="CAST({} AS REAL)".format(latitude),
+        lon="CAST({} AS REAL)".format(longitude),
+        extra=extra, from_=from_, where=where
+    )
+    parameters = dict(
+        parameters, size=size,
+        south=bottom * size - 90, north=(top + 1) * size - 90,
+        west=left * size - 180, east=(right + 1) * size - 180,
+    )
+    clusters = []
+    for row in connection.execute(query, parameters):
+        cluster = dict(row)
+        del cluster["cell_row"], cluster["cell_col"]
+        clusters.append(cluster)
+    return clusters
+
+
+# Returns the cached result for key, or makes it with make and caches it.
+def _cached(key, make):
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    result = make()
+    with _cache_lock:
+        _cache[key] = result
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
+
+
+def _zoom(zoom):
+    return min(max(int(zoom), MIN_ZOOM), MAX_ZOOM)
+
+
+# Clusters trip origins and destinations in bbox, (south, west, north,
+# east), at a map zoom. filters and type_ are like statistics.get_statistic,
+# and all trips are clustered without filters. Returns {"origins": clusters,
+# "destinations": clusters}.
+def trip_clusters(zoom, bbox, filters=(), type_="AND"):
+    zoom = _zoom(zoom)
+    filters = [flag for flag in filters if flag in statistics.TRIP_FLAGS]
+    type_ = "OR" if type_ == "OR" else "AND"
+    where = (" = 1 " + type_ + " ").join(filters) + " = 1" if filters \
+        else "1"
+    with database.connect(statistics.STATISTICS_FILE, rows=True) as \
+            connection:
+        # Every batch of trips written adds to this, so it changes whenever
+        # the clusters could.
+        generation = rollups.read(connection, ("trips",))["trips"]
+        key = (
+            "trips", generation, zoom, snap(bbox, cell_size(zoom)),
+            tuple(filters), type_
+        )
+        return _cached(key, lambda: collections.OrderedDict(
+            (kind, _cluster(
+                connection, latitude, longitude, "trips", where, {}, zoom,
+                bbox
+            ))
+            for kind, (latitude, longitude) in TRIP_POINTS.items()
+        ))
+
+
+# Clusters businesses in bbox at a map zoom, filtered like the business data
+# page. A cluster of one business also has its name, address, promotion and
+# discount, for its marker.
+def business_clusters(zoom, bbox, filters=(), type_="AND", categories=()):
+    zoom = _zoom(zoom)
+    columns = [
+        BUSINESS_FILTERS[name] for name in filters if name in BUSINESS_FILTERS
+    ]
+    type_ = "OR" if type_ == "OR" else "AND"
+    conditions = []
+    parameters = {}
+    if columns:
+        conditions.append(
+            "(" + (" = 1 " + type_ + " ").join(columns) + " = 1)"
+        )
+    if categories:
+        names = [
+            "category{}".format(index) for index in range(len(categories))
+        ]
+        parameters.update(zip(names, categories))
+        conditions.append("category IN ({})".format(
+            ", ".join(":" + name for name in names)
+        ))
+    where = (" " + type_ + " ").join(conditions) or "1"
+    with database.connect(businessdata.BUSINESS_FILE, rows=True) as \
+            connection:
+        generation = rollups.read(connection, ("generation",))["generation"]
+        key = (
+            "businesses", generation, zoom, snap(bbox, cell_size(zoom)),
+            tuple(columns), type_, tuple(categories)
+        )
+        # With one business in a cluster, MAX is just its value.
+        return _cached(key, lambda: _cluster(
+            connection, "latitude", "longitude", "businesses", where,
+            parameters, zoom, bbox,
+            extra=", MAX(name) AS name, MAX(address) AS address, "
+                  "MAX(promotion) AS promotion, MAX(discount) AS discount"
+        ))
@@ -0,0 +1,145 @@
+import os
+import sqlite3
+import threading
+import contextlib
+import collections
+
+# Set on every connection. WAL lets readers and a writer work at the same time
+# instead of waiting on each other's file locks, and with WAL, NORMAL
+# synchronous is still safe against corruption, only the last transactions
+# can be lost in a power cut. cache_size is negative for KiB.
+PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("cache_size", -16 * 1024),
+    ("mmap_size", 256 * 1024 * 1024),
+    ("temp_store", "MEMORY"),
+)
+# Seconds to wait for another writer before giving up.
+TIMEOUT = 10
+# Prepared statements kept per connection. Connections are reused, so the
+# same query is only compiled once per connection.
+CACHED_STATEMENTS = 256
+# Idle connections kept per database.
+POOL_SIZE = 16
+
+# path: list of migrations, each a function given a connection. A database's
+# user_version is how many have run on it.
+MIGRATIONS = collections.defaultdict(list)
+_pools = collections.defaultdict(list)
+_pools_lock = threading.Lock()
+_migrated = set()
+_migrate_lock = threading.Lock()
+# The connection each thread is using, per database, so nested uses in one
+# thread share a connection and a transaction.
+_local = threading.local()
+
+
+# Adds migrations for a database, to run in order the first time it's opened.
+# Each module registers its own, and new ones only ever go on the end.
+def register(path, *migrations):
+    MIGRATIONS[path].extend(migrations)
+
+
+# Returns the migrations for a database. A file somewhere else with the same
+# name, like a copy made for the benchmarks, gets the same ones.
+def migrations_for(path):
+    return MIGRATIONS.get(path) or MIGRATIONS.get(os.path.basename(path), [])
+
+
+# Runs any migrations the database hasn't had yet. Holding a write lock while
+# checking the version means only one process runs each migration.
+def migrate(connection, path):
+    migrations = migrations_for(path)
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(migrations):
+        return
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        for number in range(version, len(migrations)):
+            migrations[number](connection)
+        connection.execute("PRAGMA user_version = {}".format(len(migrations)))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+
+
+# Opens a new connection with the pragmas set and the schema up to date. For
+# holding onto for a long time, like a bulk writer. Otherwise use connect.
+def open_connection(path):
+    connection = sqlite3.connect(
+        path, timeout=TIMEOUT, cached_statements=CACHED_STATEMENTS,
+        check_same_thread=False
+    )
+    for name, value in PRAGMAS:
+        connection.execute("PRAGMA {} = {}".format(name, value))
+    if path not in _migrated:
+        with _migrate_lock:
+            if path not in _migrated:
+                try:
+                    migrate(connection, path)
+                except Exception:
+                    connection.close()
+                    raise
+                _migrated.add(path)
+    return connection
+
+
+# Runs every registered migration now, so the first request doesn't have to.
+def setup():
+    for path in list(MIGRATIONS):
+        with connect(path):
+            pass
+
+
+# Borrows a pooled connection to a database, inside a transaction that's
+# committed at the end of the block, or rolled back on an error. Rows come
+# back as sqlite3.Row if rows is set. Using it again inside the block on the
+# same thread gives the same connection, in the same transaction. Set
+# immediate to take the write lock straight away, for reading something and
+# then writing based on it without another writer getting in between.
+@contextlib.contextmanager
+def connect(path, rows=False, immediate=False):
+    held = _local.__dict__.setdefault("held", {})
+    if path in held:
+        connection = held[path]
+        factory = connection.row_factory
+        connection.row_factory = sqlite3.Row if rows else None
+        try:
+            yield connection
+        finally:
+            connection.row_factory = factory
+        return
+    with _pools_lock:
+        connection = _pools[path].pop() if _pools[path] else None
+    if connection is None:
+        connection = open_connection(path)
+    connection.row_factory = sqlite3.Row if rows else None
+    held[path] = connection
+    try:
+        with connection:
+            if immediate:
+                connection.execute("BEGIN IMMEDIATE")
+            yield connection
+    finally:
+        del held[path]
+        with _pools_lock:
+            if len(_pools[path]) < POOL_SIZE:
+                _pools[path].append(connection)
+                connection = None
+        if connection is not None:
+            connection.close()
+
+
+# Closes every idle connection, like before the files are moved or deleted.
+def close_all():
+    with _pools_lock:
+        for connections in _pools.values():
+            for connection in connections:
+                connection.close()
+        _pools.clear()
+    # The files may be new ones next time, so check their schema again.
+    with _migrate_lock:
+        _migrated.clear()
@@ -0,0 +1,54 @@
+import time
+import concurrent.futures
+
+# Seconds a whole search may take before whatever is left is skipped.
+BUDGET = 6.0
+# The most of the budget, as a share of it, each stage that waits on an
+# upstream service may use. A stage can also never use more than what's left
+# of the whole budget. Geocoding isn't here, since a search can't go on
+# without it, and Coord's slice is only how long it's given before a stale
+# route is used instead, if there is one.
+SLICES = {
+    "transit_near": 0.15,
+    "coord": 0.6,
+    "real_time": 0.2,
+}
+
+
+# Keeps track of how much time is left for a search. Made at the start of a
+# search and passed through it. A budget of False means no deadline at all,
+# for searches nobody is waiting on, like batches.
+class Deadline:
+
+    def __init__(self, budget=None, slices=None):
+        self.budget = BUDGET if budget is None else budget
+        self.unlimited = budget is False
+        self.slices = SLICES if slices is None else slices
+        self.start = time.monotonic()
+
+    # Seconds left in the whole budget, never below 0.
+    def remaining(self):
+        if self.unlimited:
+            return float("inf")
+        return max(self.budget - (time.monotonic() - self.start), 0)
+
+    # Seconds the stage may still wait for, or None for as long as it takes.
+    def allowance(self, stage):
+        if self.unlimited:
+            return None
+        return min(self.budget * self.slices.get(stage, 1), self.remaining())
+
+    # Waits for futures for as long as the stage is allowed, all together.
+    # Returns a (finished, result) pair for each one, with a result of None
+    # for the ones that didn't finish in time. An error in a finished future
+    # is raised as usual. Without a deadline, every future is waited for.
+    def wait(self, futures, stage):
+        if self.unlimited:
+            return [(True, future.result()) for future in futures]
+        done, pending = concurrent.futures.wait(
+            futures, timeout=self.allowance(stage)
+        )
+        return [
+            (True, future.result()) if future in done else (False, None)
+            for future in futures
+        ]
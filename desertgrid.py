@@ -0,0 +1,472 @@
+import os
+import sys
+import json
+import math
+import time
+import hashlib
+import threading
+import numpy
+import stations
+import accessibility
+import bikes
+
+GRID_FILE = "desertgrid.npz"
+# Corners of the grid, (south, west) and (north, east), a little past the
+# city limits.
+BOUNDS = ((40.49, -74.27), (40.92, -73.68))
+# Size of a cell, in km.
+CELL_KM = 0.1
+# Distances are only worked out this far from each station. Anything further
+# is stored as infinity, which is a desert for any radius that matters.
+REACH_KM = 3.0
+# Walking radii that each cell is classified for, in km: a quarter, half,
+# three quarters and a whole mile.
+RADII = (0.4, 0.8, 1.2, 1.6)
+# What a cell is classified as for each radius, as bits of its flags. Each
+# radius gets its own group of bits, in the order of RADII.
+SUBWAY_DESERT = 1
+ADA_DESERT = 2
+TRANSIT_DESERT = 4
+BITS_PER_RADIUS = 3
+# How often, in seconds, to check whether the source files have changed.
+CHECK_INTERVAL = 5
+# Km in a degree of latitude, and of longitude at the equator.
+KM_PER_LAT = 110.574
+KM_PER_LON = 111.320
+LAYERS = ("subway", "ada", "bike")
+
+_grid = None
+_checked = 0
+_building = False
+_grid_lock = threading.Lock()
+# The last bike index seen and the hash of its stations, so the stations are
+# only hashed again when the snapshot is refreshed.
+_bike_hash = (None, None)
+
+
+# Returns the sha1 of a file, to tell whether it really changed when its
+# modification time does.
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+# The points each layer is built from, as sorted lists of (lat, lon). The
+# bike layer is left out if there's no bike snapshot.
+def layer_points():
+    subways = stations.get_index().items
+    ada_stop_ids = accessibility.get_index().ada_stop_ids
+    points = {
+        "subway": sorted({
+            (station.latitude, station.longitude) for station in subways
+        }),
+        "ada": sorted({
+            (station.latitude, station.longitude) for station in subways
+            if station.stop_id in ada_stop_ids
+        }),
+    }
+    bike_index = bikes.get_index()
+    if bike_index is not None:
+        points["bike"] = sorted({
+            (station.latitude, station.longitude)
+            for station in bike_index.items
+        })
+    return points
+
+
+# Distances, in km, from every cell center to the nearest point of each layer,
+# and the desert classifications that come from them. Lookups are an array
+# index, so checking a search is constant time.
+class DesertGrid:
+
+    def __init__(self, bounds=BOUNDS, cell_km=CELL_KM):
+        (self.south, self.west), (self.north, self.east) = bounds
+        self.bounds = bounds
+        self.cell_km = cell_km
+        middle = math.radians((self.south + self.north) / 2)
+        self.lat_step = cell_km / KM_PER_LAT
+        self.lon_step = cell_km / (KM_PER_LON * math.cos(middle))
+        self.rows = int(math.ceil((self.north - self.south) / self.lat_step))
+        self.columns = int(math.ceil((self.east - self.west) / self.lon_step))
+        self.latitudes = self.south + (
+            numpy.arange(self.rows) + 0.5
+        ) * self.lat_step
+        self.longitudes = self.west + (
+            numpy.arange(self.columns) + 0.5
+        ) * self.lon_step
+        # A degree of longitude is shorter further north, so each row has
+        # its own km per degree.
+        self.km_per_lon = KM_PER_LON * numpy.cos(
+            numpy.radians(self.latitudes)
+        )
+        self.distances = {}
+        self.points = {}
+        self.flags = numpy.zeros((self.rows, self.columns), numpy.uint16)
+        self.sources = {}
+        # Any point in a cell is at most this far from its center, so a
+        # distance looked up from the grid is off by no more than this.
+        self.error_km = cell_km * math.sqrt(2) / 2
+
+    # Gives the (row, column) a coordinate falls in, or None if it's off the
+    # grid.
+    def cell(self, lat, lon):
+        row = int((float(lat) - self.south) / self.lat_step)
+        column = int((float(lon) - self.west) / self.lon_step)
+        if 0 <= row < self.rows and 0 <= column < self.columns:
+            return (row, column)
+        return None
+
+    # The rows and columns within REACH_KM of a point, as slices.
+    def window(self, lat, lon):
+        row_reach = int(REACH_KM / self.cell_km) + 1
+        column_reach = int(
+            REACH_KM / (KM_PER_LON * math.cos(math.radians(lat))) /
+            self.lon_step
+        ) + 1
+        row = int((lat - self.south) / self.lat_step)
+        column = int((lon - self.west) / self.lon_step)
+        return (
+            slice(max(row - row_reach, 0), max(row + row_reach + 1, 0)),
+            slice(max(column - column_reach, 0),
+                  max(column + column_reach + 1, 0))
+        )
+
+    # Lowers the distances in the window around a point to the distance to
+    # that point, where it's closer. Distances are worked out on a flat
+    # projection, which is well within a cell's size at these distances.
+    def stamp(self, distances, lat, lon):
+        rows, columns = self.window(lat, lon)
+        if rows.start >= rows.stop or columns.start >= columns.stop:
+            return
+        north_south = (self.latitudes[rows] - lat) * KM_PER_LAT
+        east_west = (
+            (self.longitudes[columns] - lon)[numpy.newaxis, :] *
+            self.km_per_lon[rows][:, numpy.newaxis]
+        )
+        numpy.minimum(
+            distances[rows, columns],
+            numpy.sqrt(north_south[:, numpy.newaxis] ** 2 + east_west ** 2),
+            out=distances[rows, columns]
+        )
+
+    # Brings a layer up to date with a new list of points. Only the cells
+    # around points that were added or removed are touched, so a changed
+    # station or two is quick.
+    def update(self, layer, points):
+        old = set(self.points.get(layer, ()))
+        new = set(points)
+        if layer not in self.distances:
+            self.distances[layer] = numpy.full(
+                (self.rows, self.columns), numpy.inf, numpy.float32
+            )
+            old = set()
+        distances = self.distances[layer]
+        removed = old - new
+        if removed:
+            # Forget everything near a removed point, then stamp the points
+            # that could have been closest there again.
+            for lat, lon in removed:
+                distances[self.window(lat, lon)] = numpy.inf
+            near = 2 * (REACH_KM + self.cell_km)
+            added = {
+                point for point in new
+                if point not in old or any(
+                    abs(point[0] - lat) * KM_PER_LAT <= near and
+                    abs(point[1] - lon) * KM_PER_LON *
+                    math.cos(math.radians(lat)) <= near
+                    for lat, lon in removed
+                )
+            }
+        else:
+            added = new - old
+        for lat, lon in added:
+            self.stamp(distances, lat, lon)
+        self.points[layer] = sorted(new)
+        return len(added) + len(removed)
+
+    # Works out every cell's desert classifications from its distances.
+    def classify(self):
+        flags = numpy.zeros((self.rows, self.columns), numpy.uint16)
+        nowhere = numpy.full((self.rows, self.columns), numpy.inf)
+        subway = self.distances.get("subway", nowhere)
+        ada = self.distances.get("ada", nowhere)
+        bike = self.distances.get("bike", nowhere)
+        for index, radius in enumerate(RADII):
+            shift = index * BITS_PER_RADIUS
+            flags |= (subway > radius).astype(numpy.uint16) * \
+                (SUBWAY_DESERT << shift)
+            flags |= (ada > radius).astype(numpy.uint16) * \
+                (ADA_DESERT << shift)
+            flags |= ((subway > radius) & (bike > radius)).astype(
+                numpy.uint16
+            ) * (TRANSIT_DESERT << shift)
+        self.flags = flags
+
+    # Returns the distance in km from a coordinate to the nearest point of a
+    # layer, as (distance, error), or None if the grid can't say.
+    def distance(self, layer, lat, lon):
+        cell = self.cell(lat, lon)
+        if cell is None or layer not in self.distances:
+            return None
+        return (float(self.distances[layer][cell]), self.error_km)
+
+    # Returns whether a layer has a point within km of a coordinate, or None
+    # if the coordinate is too close to the edge of the radius for the grid
+    # to be sure. Then the caller should check exactly.
+    def is_near(self, layer, lat, lon, km):
+        found = self.distance(layer, lat, lon)
+        if found is None:
+            return None
+        distance, error = found
+        km = float(km)
+        if distance == numpy.inf:
+            # Nothing within REACH_KM of the center.
+            return False if km < REACH_KM - error else None
+        # The flat distances are off by far less than a percent at this
+        # scale, but leave room for it anyway.
+        error += distance * 0.005
+        if distance + error <= km:
+            return True
+        if distance - error > km:
+            return False
+        return None
+
+    # Returns the flags of the cell a coordinate falls in, or None.
+    def classification(self, lat, lon):
+        cell = self.cell(lat, lon)
+        if cell is None:
+            return None
+        return int(self.flags[cell])
+
+    # Returns the cells that are deserts for a radius, as [south, west,
+    # north, east] rectangles. Neighbouring cells in a row are joined into one
+    # rectangle, and step cells are merged into one each way to keep the map
+    # light. kind is "subway", "ada" or "transit".
+    def desert_cells(self, radius, kind="transit", step=1):
+        if kind == "transit":
+            nowhere = numpy.full((self.rows, self.columns), numpy.inf)
+            desert = (self.distances["subway"] > radius) & (
+                self.distances.get("bike", nowhere) > radius
+            )
+        else:
+            desert = self.distances[kind] > radius
+        step = max(int(step), 1)
+        rows = self.rows // step * step
+        columns = self.columns // step * step
+        # A merged cell is a desert if most of it is.
+        desert = desert[:rows, :columns].reshape(
+            rows // step, step, columns // step, step
+        ).mean(axis=(1, 3)) > 0.5
+        lat_step = self.lat_step * step
+        lon_step = self.lon_step * step
+        rectangles = []
+        for row in range(desert.shape[0]):
+            line = desert[row]
+            changes = numpy.flatnonzero(numpy.diff(
+                numpy.concatenate(([0], line.astype(numpy.int8), [0]))
+            ))
+            for start, stop in zip(changes[::2], changes[1::2]):
+                rectangles.append([
+                    round(self.south + row * lat_step, 5),
+                    round(self.west + start * lon_step, 5),
+                    round(self.south + (row + 1) * lat_step, 5),
+                    round(self.west + stop * lon_step, 5),
+                ])
+        return rectangles
+
+    # Saves the grid to a file, replacing the old one all at once.
+    def save(self, path=GRID_FILE):
+        meta = {
+            "bounds": self.bounds, "cell_km": self.cell_km,
+            "reach_km": REACH_KM, "radii": RADII,
+            "points": self.points, "sources": self.sources,
+        }
+        arrays = {
+            "layer_" + layer: distances
+            for layer, distances in self.distances.items()
+        }
+        # Named for the process and thread, so saves running at the same
+        # time never write into each other's file.
+        temporary = "{}.{}.{}.tmp".format(
+            path, os.getpid(), threading.get_ident()
+        )
+        with open(temporary, "wb") as f:
+            numpy.savez_compressed(
+                f, meta=numpy.array(json.dumps(meta)), flags=self.flags,
+                **arrays
+            )
+        os.replace(temporary, path)
+
+    # Loads a saved grid, or returns None if it was made with different
+    # settings and has to be built again.
+    @classmethod
+    def load(cls, path=GRID_FILE):
+        with numpy.load(path) as saved:
+            meta = json.loads(str(saved["meta"]))
+            if (
+                [list(corner) for corner in meta["bounds"]] !=
+                [list(corner) for corner in BOUNDS] or
+                meta["cell_km"] != CELL_KM or
+                meta["reach_km"] != REACH_KM or
+                list(meta["radii"]) != list(RADII)
+            ):
+                return None
+            grid = cls()
+            grid.flags = saved["flags"]
+            for layer in LAYERS:
+                if "layer_" + layer in saved:
+                    grid.distances[layer] = saved["layer_" + layer]
+        grid.points = {
+            layer: [tuple(point) for point in points]
+            for layer, points in meta["points"].items()
+        }
+        grid.sources = meta["sources"]
+        return grid
+
+    # Returns a copy that can be updated while this one is still being read.
+    def copy(self):
+        grid = DesertGrid(self.bounds, self.cell_km)
+        grid.distances = {
+            layer: distances.copy()
+            for layer, distances in self.distances.items()
+        }
+        grid.points = dict(self.points)
+        grid.flags = self.flags
+        grid.sources = dict(self.sources)
+        return grid
+
+
+# The version of each source the grid depends on, as file hashes, plus a hash
+# of the bike stations. Files are only hashed again if their modification
+# time has changed since previous.
+def current_sources(previous=None):
+    global _bike_hash
+    sources = {}
+    for path in (stations.STATIONS_FILE, accessibility.ACCESS_FILE):
+        mtime = os.stat(path).st_mtime
+        old = (previous or {}).get(path)
+        if old and old["mtime"] == mtime:
+            sources[path] = old
+        else:
+            sources[path] = {"mtime": mtime, "sha1": file_hash(path)}
+    bike_index = bikes.get_index()
+    if bike_index is not None:
+        if _bike_hash[0] is not bike_index:
+            _bike_hash = (bike_index, hashlib.sha1(json.dumps(sorted(
+                (station.latitude, station.longitude)
+                for station in bike_index.items
+            )).encode()).hexdigest())
+        sources["bikes"] = {"sha1": _bike_hash[1]}
+    return sources
+
+
+# Whether anything the grid was built from has changed. A file that's only
+# been touched, with the same hash, doesn't count.
+def is_stale(grid, sources):
+    for path in (stations.STATIONS_FILE, accessibility.ACCESS_FILE):
+        if grid.sources.get(path, {}).get("sha1") != sources[path]["sha1"]:
+            return True
+    return sources.get("bikes") != grid.sources.get("bikes")
+
+
+# Brings a grid up to date with the sources, or builds a new one. Returns the
+# new grid, which is a separate copy so the old one can keep being used.
+def build(grid=None):
+    grid = grid.copy() if grid is not None else DesertGrid()
+    grid.sources = current_sources(previous=grid.sources)
+    for layer, points in layer_points().items():
+        grid.update(layer, points)
+    grid.classify()
+    return grid
+
+
+# Updates the grid in the background and saves it, swapping it in when it's
+# done.
+def _rebuild(grid):
+    global _grid, _building
+    try:
+        new_grid = build(grid)
+        new_grid.save()
+        with _grid_lock:
+            _grid = new_grid
+    except Exception:
+        pass
+    finally:
+        _building = False
+
+
+def _start_rebuild(grid):
+    global _building
+    with _grid_lock:
+        if _building:
+            return
+        _building = True
+    threading.Thread(target=_rebuild, args=(grid,), daemon=True).start()
+
+
+# Returns the desert grid, or None while there isn't one yet. The saved grid
+# is loaded the first time. Every CHECK_INTERVAL the source files are checked,
+# and if they've changed the grid is updated in the background while the old
+# one keeps being used.
+def get_grid():
+    global _grid, _checked
+    now = time.time()
+    if _grid is not None and now - _checked < CHECK_INTERVAL:
+        return _grid
+    with _grid_lock:
+        if _grid is not None and now - _checked < CHECK_INTERVAL:
+            return _grid
+        _checked = now
+        if _grid is None and os.path.exists(GRID_FILE):
+            try:
+                _grid = DesertGrid.load()
+            except Exception:
+                _grid = None
+        grid = _grid
+    try:
+        previous = grid.sources if grid is not None else None
+        if grid is None or is_stale(grid, current_sources(previous)):
+            _start_rebuild(grid)
+    except Exception:
+        pass
+    return grid
+
+
+# Returns whether a subway ("subway" or "ada") or bike station ("bike") is
+# within km of a coordinate, or None if the grid can't tell for sure.
+def is_near(layer, lat, lon, km):
+    grid = get_grid()
+    if grid is None:
+        return None
+    if layer == "bike" and not bikes.covers(lat, lon, km):
+        return None
+    return grid.is_near(layer, lat, lon, km)
+
+
+# Whether there's a subway or bike station within km, the same as
+# api.is_transit_near, or None if the grid can't tell for sure.
+def is_transit_near(lat, lon, km):
+    subway = is_near("subway", lat, lon, km)
+    if subway:
+        return True
+    bike = is_near("bike", lat, lon, km)
+    if bike:
+        return True
+    if subway is False and bike is False:
+        return False
+    return None
+
+
+if __name__ == "__main__":
+    # Builds the grid, or updates the saved one, like
+    # python desertgrid.py
+    start = time.time()
+    grid = None
+    if os.path.exists(GRID_FILE) and "--full" not in sys.argv:
+        grid = DesertGrid.load()
+    grid = build(grid)
+    grid.save()
+    print("{}x{} cells, layers {}, in {:.1f}s".format(
+        grid.rows, grid.columns, ", ".join(sorted(grid.distances)),
+        time.time() - start
+    ))
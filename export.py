@@ -0,0 +1,260 @@
+import os
+import sys
+import csv
+import json
+import zlib
+import argparse
+import database
+import statistics
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    # Parquet and Arrow need pyarrow. Without it, exports are gzipped CSV.
+    pyarrow = None
+
+# Exports the trips table for analysis, like in pandas or DuckDB, a chunk of
+# rows at a time so memory stays the same however big the table is. Each
+# chunk is read in its own short transaction, so searches writing trips are
+# never held up. Trips are read in the order they were written, by batch and
+# then ROWID, which means an export can pick up where the last one stopped.
+
+# Rows read at a time.
+CHUNK_ROWS = 10000
+# Rows in each file of an export to a folder. Each file is finished before
+# the next starts, so a stopped export loses at most one file's worth.
+PART_ROWS = 1000000
+STATE_FILE = "export.json"
+FORMATS = ("parquet", "arrow", "csv")
+DEFAULT_FORMAT = "parquet" if pyarrow else "csv"
+EXTENSIONS = {"parquet": ".parquet", "arrow": ".arrow", "csv": ".csv.gz"}
+
+FLAGS = statistics.TRIP_FLAGS + ("chosen",)
+# (column, SQL to read it, Arrow type name), in the order exported. Flags are
+# 0 or 1, so they fit in a byte. trip_object is left out, it's only a hash.
+COLUMNS = [
+    ("row_id", "ROWID", "int64"),
+    ("batch", "batch", "int64"),
+    ("trip_id", "trip_id", "int64"),
+    ("user_id", "user_id", "int64"),
+    ("time", "time_epoch", "timestamp"),
+    ("time_now", "time_now", "string"),
+    ("origin", "origin", "string"),
+    ("destination", "destination", "string"),
+] + [
+    (name, "CAST({} AS REAL)".format(name), "float64") for name in (
+        "origin_latitude", "origin_longitude",
+        "destination_latitude", "destination_longitude",
+    )
+] + [
+    (flag, "CAST({} AS INTEGER)".format(flag), "int8") for flag in FLAGS
+]
+# Columns that say who searched and the addresses they typed in. They're
+# left out unless asked for.
+PRIVATE = ("user_id", "origin", "destination")
+PUBLIC_COLUMNS = [column for column in COLUMNS if column[0] not in PRIVATE]
+# A chunk is the rest of the batch it starts in, then the batches after it.
+# Done as two queries, each can jump straight to where it starts in the batch
+# index, however many trips a batch has. row_id and batch have to be the first
+# two columns, to know where a chunk ended.
+SELECT_SAME_BATCH = '''SELECT {} FROM trips
+                        WHERE batch = ? AND ROWID > ?
+                        ORDER BY ROWID
+                        LIMIT ?'''
+SELECT_LATER_BATCHES = '''SELECT {} FROM trips
+                            WHERE batch > ?
+                            ORDER BY batch, ROWID
+                            LIMIT ?'''
+
+
+# Returns the Arrow schema of an export with columns.
+def schema(columns=PUBLIC_COLUMNS):
+    types = {
+        "int64": pyarrow.int64(), "int8": pyarrow.int8(),
+        "float64": pyarrow.float64(), "string": pyarrow.string(),
+        "timestamp": pyarrow.timestamp("s", tz="UTC"),
+    }
+    return pyarrow.schema(
+        [(name, types[kind]) for name, _, kind in columns]
+    )
+
+
+# Yields lists of rows, each up to chunk_rows long, for every trip written
+# after position, which is the (batch, ROWID) of the last trip exported. Stops
+# after limit rows, if given.
+def read_chunks(position=(0, 0), chunk_rows=CHUNK_ROWS, limit=None,
+                path=statistics.STATISTICS_FILE, columns=PUBLIC_COLUMNS):
+    select = ", ".join(sql for _, sql, _ in columns)
+    same_batch = SELECT_SAME_BATCH.format(select)
+    later_batches = SELECT_LATER_BATCHES.format(select)
+    batch, row_id = position
+    while limit is None or limit > 0:
+        size = chunk_rows if limit is None else min(chunk_rows, limit)
+        with database.connect(path) as connection:
+            rows = connection.execute(
+                same_batch, (batch, row_id, size)
+            ).fetchall()
+            if len(rows) < size:
+                rows += connection.execute(
+                    later_batches, (batch, size - len(rows))
+                ).fetchall()
+        if not rows:
+            return
+        yield rows
+        row_id, batch = rows[-1][0], rows[-1][1]
+        if limit is not None:
+            limit -= len(rows)
+
+
+# Turns rows into an Arrow record batch.
+def to_record_batch(rows, arrow_schema):
+    return pyarrow.RecordBatch.from_arrays(
+        [
+            pyarrow.array([row[index] for row in rows], field.type)
+            for index, field in enumerate(arrow_schema)
+        ],
+        schema=arrow_schema
+    )
+
+
+# Collects what's written to it, text or bytes, until it's taken, for
+# streaming a format that's written to a file.
+class Pending:
+
+    def __init__(self):
+        self.parts = []
+        self.closed = False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+# Yields an export of the rows in chunks, which have columns, as bytes, for
+# streaming. Parquet can't be streamed, so it's only for export_to.
+def stream(chunks, format_=DEFAULT_FORMAT, columns=PUBLIC_COLUMNS):
+    if format_ == "csv":
+        # wbits of 31 makes a gzip file.
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        lines = Pending()
+        writer = csv.writer(lines)
+        writer.writerow([name for name, _, _ in columns])
+        for rows in chunks:
+            writer.writerows(rows)
+            yield compressor.compress(lines.take())
+        yield compressor.compress(lines.take()) + compressor.flush()
+    elif format_ == "arrow":
+        sink = Pending()
+        arrow_schema = schema(columns)
+        with pyarrow.ipc.new_stream(sink, arrow_schema) as writer:
+            for rows in chunks:
+                writer.write_batch(to_record_batch(rows, arrow_schema))
+                yield sink.take()
+        yield sink.take()
+    else:
+        raise ValueError("Can't stream " + format_)
+
+
+# Writes the rows to a file in the format.
+def write_part(chunks, path, format_, columns=PUBLIC_COLUMNS):
+    if format_ == "parquet":
+        arrow_schema = schema(columns)
+        with pyarrow.parquet.ParquetWriter(path, arrow_schema) as writer:
+            for rows in chunks:
+                writer.write_batch(to_record_batch(rows, arrow_schema))
+    else:
+        with open(path, "wb") as f:
+            for data in stream(chunks, format_, columns):
+                f.write(data)
+
+
+def read_state(directory):
+    try:
+        with open(os.path.join(directory, STATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"batch": 0, "row_id": 0}
+
+
+def write_state(directory, state):
+    path = os.path.join(directory, STATE_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+# Exports every trip written since the last export to directory, as files of
+# up to part_rows trips. Where it got to is kept in export.json there, so the
+# next export starts after it. Each file is named after the first trip in it,
+# so one that was stopped partway is just written again. Returns how many
+# trips were exported. With private on, who searched and the addresses are
+# exported too.
+def export_to(directory, format_=DEFAULT_FORMAT, chunk_rows=CHUNK_ROWS,
+              part_rows=PART_ROWS, path=statistics.STATISTICS_FILE,
+              private=False):
+    if format_ not in FORMATS or (format_ != "csv" and not pyarrow):
+        raise ValueError("Can't export " + format_)
+    os.makedirs(directory, exist_ok=True)
+    columns = COLUMNS if private else PUBLIC_COLUMNS
+    state = read_state(directory)
+    exported = 0
+    while True:
+        last = {}
+
+        def chunks():
+            for rows in read_chunks(
+                (state["batch"], state["row_id"]), chunk_rows, part_rows,
+                path, columns
+            ):
+                last["position"] = (rows[-1][1], rows[-1][0])
+                last["rows"] = last.get("rows", 0) + len(rows)
+                yield rows
+
+        name = "trips-{:012d}-{:012d}{}".format(
+            state["batch"], state["row_id"], EXTENSIONS[format_]
+        )
+        temporary = os.path.join(directory, "." + name + ".tmp")
+        write_part(chunks(), temporary, format_, columns)
+        if not last:
+            os.remove(temporary)
+            return exported
+        os.replace(temporary, os.path.join(directory, name))
+        state["batch"], state["row_id"] = last["position"]
+        write_state(directory, state)
+        exported += last["rows"]
+
+
+if __name__ == "__main__":
+    # Like python export.py exports/ --format parquet
+    parser = argparse.ArgumentParser(
+        description="Export the trips table, carrying on from last time."
+    )
+    parser.add_argument("directory", help="where the files and state go")
+    parser.add_argument("--format", choices=FORMATS, default=DEFAULT_FORMAT)
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    parser.add_argument("--part-rows", type=int, default=PART_ROWS)
+    parser.add_argument(
+        "--private", action="store_true",
+        help="include user_id, origin and destination"
+    )
+    args = parser.parse_args()
+    count = export_to(
+        args.directory, args.format, args.chunk_rows, args.part_rows,
+        private=args.private
+    )
+    print("Exported", count, "trips to", args.directory, file=sys.stderr)
@@ -0,0 +1,91 @@
+import os
+import json
+import hashlib
+import geocache
+
+FIXTURE_DIR = "fixtures"
+# Every upstream endpoint that can be recorded and stood in for, by path.
+ENDPOINTS = {
+    "/nominatim/v1/search.php": "search",
+    "/v1/routing/route": "route",
+    "/v1/bike/location": "bike",
+    "/mta_esi.php": "feed",
+}
+# Parameters that are api keys, and never end up in a fixture.
+SECRET_PARAMS = ("key", "access_key")
+
+
+# Returns the name a request's response is saved under. It only depends on the
+# parameters that change the answer, so the same search finds the same file.
+def fixture_key(endpoint, params):
+    params = {
+        key: str(value) for key, value in (params or {}).items()
+        if key not in SECRET_PARAMS
+    }
+    if endpoint == "search":
+        params = {"q": geocache.normalize(params.get("q", ""))}
+    elif endpoint == "route":
+        # Rounded like the route cache does, so nearby searches match.
+        params = {
+            key: (
+                "{:.3f}".format(float(value)) if key.endswith("itude")
+                else value
+            )
+            for key, value in params.items()
+        }
+    elif endpoint == "feed":
+        return "feed_" + params.get("feed_id", "")
+    text = json.dumps(params, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+# Saves a response to the fixture directory. path is the request path, like
+# "/v1/routing/route".
+def record(path, params, status, content_type, body, directory=None):
+    endpoint = ENDPOINTS.get(path)
+    if not endpoint:
+        return None
+    folder = os.path.join(directory or FIXTURE_DIR, endpoint)
+    os.makedirs(folder, exist_ok=True)
+    key = fixture_key(endpoint, params)
+    with open(os.path.join(folder, key + ".bin"), "wb") as f:
+        f.write(body)
+    with open(os.path.join(folder, key + ".json"), "w") as f:
+        json.dump({
+            "path": path,
+            "params": {
+                name: str(value) for name, value in (params or {}).items()
+                if name not in SECRET_PARAMS
+            },
+            "status": status,
+            "content_type": content_type,
+        }, f, indent=4, sort_keys=True)
+    return key
+
+
+# Loads a recorded response as (status, content_type, body), or None if there
+# isn't one. If strict is off and there's no exact match, any recording of the
+# same endpoint is used instead, so made up searches still get an answer.
+def load(path, params, directory=None, strict=False):
+    endpoint = ENDPOINTS.get(path)
+    if not endpoint:
+        return None
+    folder = os.path.join(directory or FIXTURE_DIR, endpoint)
+    key = fixture_key(endpoint, params)
+    if not os.path.exists(os.path.join(folder, key + ".bin")):
+        if strict or not os.path.isdir(folder):
+            return None
+        recorded = sorted(
+            name[:-4] for name in os.listdir(folder) if name.endswith(".bin")
+        )
+        if not recorded:
+            return None
+        # Pick the same stand-in for the same request every time.
+        key = recorded[
+            int(hashlib.sha1(key.encode()).hexdigest(), 16) % len(recorded)
+        ]
+    with open(os.path.join(folder, key + ".json")) as f:
+        meta = json.load(f)
+    with open(os.path.join(folder, key + ".bin"), "rb") as f:
+        body = f.read()
+    return (meta["status"], meta["content_type"], body)
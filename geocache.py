@@ -0,0 +1,131 @@
+import re
+import time
+import threading
+import collections
+import database
+
+CACHE_FILE = "geocode.db"
+# How long found coordinates are kept, in seconds. Addresses don't move.
+TTL = 30 * 24 * 60 * 60
+# How long an address that couldn't be found is remembered, in seconds. This
+# is shorter, in case the geocoder learns about it.
+NEGATIVE_TTL = 24 * 60 * 60
+# Most addresses kept in memory.
+MEMORY_SIZE = 1024
+
+# Common spellings that mean the same thing in an address.
+ABBREVIATIONS = {
+    "street": "st", "avenue": "ave", "av": "ave", "road": "rd",
+    "boulevard": "blvd", "place": "pl", "drive": "dr", "lane": "ln",
+    "parkway": "pkwy", "square": "sq", "east": "e", "west": "w",
+    "north": "n", "south": "s", "nyc": "new york",
+}
+
+_memory = collections.OrderedDict()
+_memory_lock = threading.Lock()
+# Hit and miss counts, for seeing how well the cache does. Only changed
+# through count, since lookups run on many threads at once.
+counters = collections.Counter()
+
+
+# Adds one to each of the counters named.
+def count(*names):
+    with _memory_lock:
+        for name in names:
+            counters[name] += 1
+
+
+# Turns an address into the key it's cached under, so that small differences
+# in how people type it don't matter.
+def normalize(address):
+    words = re.sub(r"[^a-z0-9#/-]+", " ", str(address).lower()).split()
+    return " ".join(ABBREVIATIONS.get(word, word) for word in words)
+
+
+# Creates the geocodes table. Run once, as the database's first migration.
+def create_geocode_table(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS geocodes (
+                        address TEXT PRIMARY KEY,
+                        latitude TEXT DEFAULT NULL,
+                        longitude TEXT DEFAULT NULL,
+                        expires REAL DEFAULT 0)
+                   ''')
+
+
+database.register(CACHE_FILE, create_geocode_table)
+
+
+# Puts a value in memory, dropping the least recently used if it's full.
+def _remember(key, value, expires):
+    with _memory_lock:
+        _memory[key] = (value, expires)
+        _memory.move_to_end(key)
+        while len(_memory) > MEMORY_SIZE:
+            _memory.popitem(last=False)
+
+
+# Returns the cached (lat, lon) for an address, (False, False) if it's known
+# that it can't be found, or None if it isn't cached.
+def get(address):
+    key = normalize(address)
+    now = time.time()
+    with _memory_lock:
+        cached = _memory.get(key)
+        if cached and cached[1] > now:
+            _memory.move_to_end(key)
+    if cached and cached[1] > now:
+        if cached[0][0]:
+            count("hits", "memory_hits")
+        else:
+            count("hits", "memory_hits", "negative_hits")
+        return cached[0]
+    with database.connect(CACHE_FILE) as connection:
+        row = connection.execute(
+            '''SELECT latitude, longitude, expires FROM geocodes
+                WHERE address = ? AND expires > ?''',
+            (key, now)
+        ).fetchone()
+    if not row:
+        count("misses")
+        return None
+    value = (row[0] or False, row[1] or False)
+    _remember(key, value, row[2])
+    if value[0]:
+        count("hits", "disk_hits")
+    else:
+        count("hits", "disk_hits", "negative_hits")
+    return value
+
+
+# Caches the result of geocoding an address. Give (False, False) to remember
+# that it couldn't be found.
+def put(address, latitude, longitude):
+    key = normalize(address)
+    value = (latitude or False, longitude or False)
+    expires = time.time() + (TTL if latitude else NEGATIVE_TTL)
+    _remember(key, value, expires)
+    with database.connect(CACHE_FILE) as connection:
+        connection.execute(
+            '''INSERT OR REPLACE INTO geocodes
+                (address, latitude, longitude, expires)
+                VALUES (?, ?, ?, ?)''',
+            (key, latitude or None, longitude or None, expires)
+        )
+
+
+# Removes expired addresses from the database.
+def purge():
+    with database.connect(CACHE_FILE) as connection:
+        connection.execute(
+            '''DELETE FROM geocodes WHERE expires <= ?''', (time.time(),)
+        )
+
+
+# Returns the hit and miss counts, along with the hit rate.
+def get_counters():
+    with _memory_lock:
+        stats = dict(counters)
+        stats["memory_size"] = len(_memory)
+    lookups = stats.get("hits", 0) + stats.get("misses", 0)
+    stats["hit_rate"] = (stats.get("hits", 0) / lookups) if lookups else 0
+    return stats
@@ -0,0 +1,168 @@
+import time
+import bisect
+import threading
+import contextlib
+import collections
+
+# Upper bounds, in seconds, of the histogram buckets. Cover everything from a
+# cache hit to a slow Coord route.
+BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+_lock = threading.Lock()
+# Histograms are {(name, labels): [bucket counts..., sum, count]}, and
+# counters are {(name, labels): value}. labels is a sorted tuple of pairs.
+_histograms = {}
+_counters = collections.Counter()
+# Help text for each metric, for the /metrics page.
+_help = {}
+# The stages timed so far in the current request, per thread.
+_local = threading.local()
+
+
+# Gives a metric its help text.
+def describe(name, text):
+    _help[name] = text
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+# Records an observation, in seconds, in a histogram.
+def observe(name, value, **labels):
+    key = (name, _labels(labels))
+    index = bisect.bisect_left(BUCKETS, value)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        if index < len(BUCKETS):
+            histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+# Adds to a counter.
+def count(name, value=1, **labels):
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] += value
+
+
+# Starts keeping the stage timings of a new request on this thread.
+def start_request():
+    _local.stages = []
+
+
+# Returns the [(stage, seconds)] timed so far in this thread's request.
+def request_stages():
+    return getattr(_local, "stages", [])
+
+
+# Times the block as a stage of a search, like "geocode". It goes into the
+# stage histogram and, if a request is being timed, its Server-Timing.
+@contextlib.contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe("save_stage_seconds", elapsed, stage=name)
+        stages = getattr(_local, "stages", None)
+        if stages is not None:
+            stages.append((name, elapsed))
+
+
+# Returns the current request's stages as a Server-Timing header value, so
+# browser dev tools show where a slow search spent its time.
+def server_timing():
+    return ", ".join(
+        "{};dur={:.1f}".format(name, seconds * 1000)
+        for name, seconds in request_stages()
+    )
+
+
+def _format_labels(labels, extra=()):
+    labels = labels + tuple(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(
+            key, str(value).replace("\\", "\\\\").replace('"', '\\"')
+        )
+        for key, value in labels
+    ) + "}"
+
+
+# Returns every metric in the Prometheus text format. gauges and counters are
+# lists of (name, labels dictionary, value) for values kept elsewhere and only
+# read when asked, like feed ages and cache hits.
+def render(gauges=(), counters=()):
+    with _lock:
+        histograms = {key: list(value) for key, value in _histograms.items()}
+        totals = dict(_counters)
+    totals.update(
+        ((name, _labels(labels)), value) for name, labels, value in counters
+    )
+    lines = []
+    described = set()
+
+    def header(name, kind):
+        if name not in described:
+            described.add(name)
+            if name in _help:
+                lines.append("# HELP {} {}".format(name, _help[name]))
+            lines.append("# TYPE {} {}".format(name, kind))
+
+    for (name, labels), histogram in sorted(histograms.items()):
+        header(name, "histogram")
+        total = 0
+        for bound, bucket in zip(BUCKETS, histogram):
+            total += bucket
+            lines.append("{}_bucket{} {}".format(
+                name, _format_labels(labels, [("le", bound)]), total
+            ))
+        lines.append("{}_bucket{} {}".format(
+            name, _format_labels(labels, [("le", "+Inf")]), histogram[-1]
+        ))
+        lines.append("{}_sum{} {}".format(
+            name, _format_labels(labels), histogram[-2]
+        ))
+        lines.append("{}_count{} {}".format(
+            name, _format_labels(labels), histogram[-1]
+        ))
+    for (name, labels), value in sorted(totals.items()):
+        header(name, "counter")
+        lines.append("{}{} {}".format(name, _format_labels(labels), value))
+    for name, labels, value in gauges:
+        header(name, "gauge")
+        lines.append("{}{} {}".format(
+            name, _format_labels(_labels(labels)), value
+        ))
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+describe("save_stage_seconds", "Time spent in each stage of a search.")
+describe("save_request_seconds", "Time spent handling each route.")
+describe("save_requests_total", "Responses by route and status code.")
+describe("save_upstream_seconds", "Time spent waiting on upstream services.")
+describe("save_upstream_responses_total",
+         "Upstream responses by service and status code.")
+describe("save_cache_lookups_total", "Cache lookups by cache and result.")
+describe("save_cache_hit_ratio", "Share of cache lookups that were hits.")
+describe("save_feed_age_seconds", "How old each MTA feed snapshot is.")
+describe("save_feed_errors_total", "Failed refreshes of each MTA feed.")
+describe("save_degraded_total",
+         "Searches where a stage ran out of time, by stage.")
+describe("save_trip_writes_total",
+         "Trips written, dropped or failed by the write queue.")
+describe("save_trip_queue_length", "Trips waiting to be written.")
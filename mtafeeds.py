@@ -0,0 +1,268 @@
+import time
+import array
+import bisect
+import threading
+import collections
+import concurrent.futures
+import upstream
+from google.transit import gtfs_realtime_pb2
+
+MTA_URL = "/mta_esi.php"
+# This is a list of every feed_id attached to MTA subway line
+FEED_ID = {
+    "1": "1", "2": "1", "3": "1", "4": "1", "5": "1", "6": "1",
+    "A": "26", "C": "26", "E": "26", "H": "26",
+    "N": "16", "Q": "16", "R": "16", "W": "16",
+    "B": "21", "D": "21", "F": "21", "M": "21",
+    "L": "2",
+    "G": "31",
+    "J": "36", "Z": "36",
+    "7": "51",
+}
+# Seconds between polls of each feed. The MTA updates them about every 30
+# seconds. Individual feeds can be given their own interval in INTERVALS.
+DEFAULT_INTERVAL = 30
+INTERVALS = {}
+# How old, in seconds, a snapshot may get before it's no longer served when
+# refreshing it keeps failing.
+MAX_STALE = 120
+# Feeds that nobody has asked for in this many seconds stop being polled.
+IDLE_TIMEOUT = 600
+
+# The latest decoded copy of a feed. data is its ArrivalIndex, fetched is the
+# time.time() it was downloaded, and timestamp is the time the MTA says it was
+# generated.
+Snapshot = collections.namedtuple(
+    "Snapshot", ["feed_id", "data", "fetched", "timestamp"]
+)
+
+
+# Every arrival and departure time in a feed, as sorted arrays of epochs keyed
+# by (route_id, stop_id). Built once per version of a feed, so requests only
+# do a dictionary lookup and maybe a slice.
+class ArrivalIndex:
+
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return len(self.table)
+
+    # Returns the sorted times trains on the route stop at the station, only
+    # the ones at or after the epoch after if it's given.
+    def times(self, route_id, stop_id, after=None):
+        times = self.table.get((route_id, stop_id), ())
+        if after is None or not times:
+            return times
+        return times[bisect.bisect_left(times, after):]
+
+    # Returns the set of route_ids in the feed.
+    def routes(self):
+        return {route_id for route_id, stop_id in self.table}
+
+
+# Builds an ArrivalIndex straight from a FeedMessage, without turning it into
+# dictionaries first. Both arrival and departure times are kept, like before.
+def build_arrivals(feed):
+    table = collections.defaultdict(list)
+    for entity in feed.entity:
+        if not entity.HasField("trip_update"):
+            continue
+        route_id = entity.trip_update.trip.route_id
+        for update in entity.trip_update.stop_time_update:
+            times = table[(route_id, update.stop_id)]
+            if update.HasField("arrival") and update.arrival.HasField("time"):
+                times.append(update.arrival.time)
+            if (
+                update.HasField("departure") and
+                update.departure.HasField("time")
+            ):
+                times.append(update.departure.time)
+    return ArrivalIndex({
+        key: array.array("q", sorted(times))
+        for key, times in table.items() if times
+    })
+
+
+# How many seconds old a snapshot is.
+def snapshot_age(snapshot, now=None):
+    return (now or time.time()) - snapshot.fetched
+
+
+# Downloads and decodes a feed into a Snapshot. If the feed hasn't changed
+# since the previous snapshot, that snapshot's index is reused.
+def fetch_feed(feed_id, previous=None):
+    response = upstream.get("mta", MTA_URL, params={
+        "key": upstream.credential("mta"), "feed_id": feed_id
+    })
+    response.raise_for_status()
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(response.content)
+    if previous and previous.timestamp == feed.header.timestamp:
+        return previous._replace(fetched=time.time())
+    return Snapshot(
+        feed_id, build_arrivals(feed), time.time(), feed.header.timestamp
+    )
+
+
+# Keeps the latest snapshot of every feed that's been asked for, polling each
+# one in the background on its own interval. fetch(feed_id, previous) is what
+# downloads and decodes a feed into a Snapshot, given the last one if any.
+class FeedManager:
+
+    def __init__(self, fetch=fetch_feed, max_stale=None, workers=4):
+        self.fetch = fetch
+        self.max_stale = max_stale
+        self.snapshots = {}
+        self.errors = collections.Counter()
+        # feed_id: time.time() it was last asked for.
+        self.requested = {}
+        self.attempted = {}
+        # feed_id: Future for the download of it that's under way, so
+        # anything else wanting it then waits for that one.
+        self.refreshing = {}
+        # Feeds that are always polled, whether anyone asks for them or not.
+        self.pinned = set()
+        # Called as listener(snapshot, previous) whenever a feed is
+        # refreshed, previous being the snapshot it replaces, if any.
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def interval(self, feed_id):
+        return INTERVALS.get(feed_id, DEFAULT_INTERVAL)
+
+    def stale_limit(self):
+        return MAX_STALE if self.max_stale is None else self.max_stale
+
+    # Starts the polling thread, if it isn't running already.
+    def start(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.stopped.clear()
+            self.thread = threading.Thread(
+                target=self.run, name="mta-feeds", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    # Polls every feed that's due, until stopped.
+    def run(self):
+        while not self.stopped.is_set():
+            now = time.time()
+            with self.lock:
+                due = [
+                    feed_id for feed_id in
+                    self.pinned.union(self.requested)
+                    if (
+                        feed_id in self.pinned or
+                        now - self.requested[feed_id] < IDLE_TIMEOUT
+                    ) and
+                    now - self.attempted.get(feed_id, 0) >=
+                    self.interval(feed_id)
+                ]
+            if due:
+                self.refresh(due)
+            self.stopped.wait(1)
+
+    # Starts downloading each feed that isn't being downloaded already.
+    # Returns feed_id: Future of its new snapshot. Called with the lock held.
+    def submit(self, feed_ids):
+        now = time.time()
+        futures = {}
+        for feed_id in feed_ids:
+            if feed_id not in self.refreshing:
+                self.attempted[feed_id] = now
+                self.refreshing[feed_id] = self.pool.submit(
+                    self.download, feed_id, self.snapshots.get(feed_id)
+                )
+            futures[feed_id] = self.refreshing[feed_id]
+        return futures
+
+    # Downloads and decodes a feed, keeps it and tells the listeners.
+    def download(self, feed_id, previous):
+        try:
+            snapshot = self.fetch(feed_id, previous)
+        except Exception:
+            with self.lock:
+                self.errors[feed_id] += 1
+                del self.refreshing[feed_id]
+            raise
+        with self.lock:
+            self.snapshots[feed_id] = snapshot
+            del self.refreshing[feed_id]
+        for listener in self.listeners:
+            try:
+                listener(snapshot, previous)
+            except Exception:
+                with self.lock:
+                    self.errors[feed_id] += 1
+        return snapshot
+
+    # Downloads and decodes the given feeds in parallel. A feed that fails
+    # keeps its last good snapshot. Returns the set of feed_ids that failed.
+    def refresh(self, feed_ids):
+        with self.lock:
+            futures = self.submit(feed_ids)
+        return {
+            feed_id for feed_id, future in futures.items()
+            if future.exception() is not None
+        }
+
+    # Returns a dictionary of feed_id: Snapshot for the given feeds. Anything
+    # that hasn't been polled recently enough is fetched now. If that fails,
+    # the last good snapshot is used as long as it's no older than the
+    # staleness limit, and otherwise a LookupError is raised.
+    def get(self, feed_ids):
+        self.start()
+        now = time.time()
+        with self.lock:
+            for feed_id in feed_ids:
+                self.requested[feed_id] = now
+            snapshots = {
+                feed_id: self.snapshots.get(feed_id) for feed_id in feed_ids
+            }
+            # The poller should keep everything fresh, so this is mostly for
+            # feeds nobody has asked for yet. A feed that's missing or gone
+            # stale is only tried here once per interval, so a broken feed
+            # doesn't get hit by every request, and a download that's under
+            # way is waited for rather than started again.
+            futures = self.submit([
+                feed_id for feed_id, snapshot in snapshots.items()
+                if (
+                    snapshot is None or
+                    snapshot_age(snapshot, now) > self.interval(feed_id) * 2
+                ) and (
+                    feed_id in self.refreshing or
+                    now - self.attempted.get(feed_id, 0) >=
+                    self.interval(feed_id)
+                )
+            ])
+        for feed_id, future in futures.items():
+            if future.exception() is None:
+                snapshots[feed_id] = future.result()
+        for feed_id, snapshot in snapshots.items():
+            if (
+                snapshot is None or
+                snapshot_age(snapshot) > self.stale_limit()
+            ):
+                raise LookupError("No recent copy of feed " + feed_id)
+        return snapshots
+
+    # Returns feed_id: seconds old, for every feed with a snapshot.
+    def ages(self):
+        now = time.time()
+        with self.lock:
+            return {
+                feed_id: snapshot_age(snapshot, now)
+                for feed_id, snapshot in self.snapshots.items()
+            }
+
+
+# One manager per process, shared by every request.
+manager = FeedManager()
@@ -0,0 +1,54 @@
+import collections
+
+# Running totals kept in a rollups table next to the rows they count, so the
+# dashboards read a few counters instead of summing whole tables. Whatever
+# changes the rows adds to the totals in the same transaction, so they can't
+# drift apart. python rollups.py recounts them all from scratch anyway.
+
+
+# Creates the rollups table in a database.
+def create_table(connection):
+    connection.execute('''CREATE TABLE IF NOT EXISTS rollups (
+                            name TEXT PRIMARY KEY,
+                            value INTEGER DEFAULT 0)''')
+
+
+# Adds to the totals. counts is name: amount, and amounts of 0 are skipped.
+def add(connection, counts):
+    connection.executemany(
+        '''INSERT INTO rollups (name, value) VALUES (?, ?)
+            ON CONFLICT (name) DO UPDATE SET value = value + excluded.value''',
+        [(name, value) for name, value in counts.items() if value]
+    )
+
+
+# Returns the totals for names, as an ordered name: value, with 0 for any
+# that haven't been counted yet.
+def read(connection, names):
+    found = dict(connection.execute(
+        '''SELECT name, value FROM rollups WHERE name IN ({})'''.format(
+            ", ".join("?" * len(names))
+        ), names
+    ).fetchall())
+    return collections.OrderedDict(
+        (name, found.get(name) or 0) for name in names
+    )
+
+
+# Replaces every total with counts, recounted from the rows.
+def replace(connection, counts):
+    connection.execute('''DELETE FROM rollups''')
+    add(connection, counts)
+
+
+if __name__ == "__main__":
+    # Recounts every total, like after the tables were changed by hand.
+    import database
+    import statistics
+    import users
+    for path, rebuild in (
+        (statistics.STATISTICS_FILE, statistics.rebuild_rollups),
+        (users.USERS_FILE, users.rebuild_rollups),
+    ):
+        with database.connect(path, immediate=True) as connection:
+            print(path, dict(rebuild(connection)))
@@ -0,0 +1,101 @@
+import json
+import time
+import threading
+import collections
+
+# Coordinates are rounded to this many degrees before being used as a key,
+# about 100 meters in NYC, so that nearby searches share an entry.
+QUANTUM = 0.001
+# Departure times are grouped into buckets of this many seconds, since a route
+# planned now is no good in an hour.
+BUCKET = 5 * 60
+# How long an entry is kept, in seconds, and the most entries kept.
+TTL = 10 * 60
+SIZE = 512
+
+_entries = collections.OrderedDict()
+_lock = threading.Lock()
+# Hit and miss counts, for seeing how well the cache does. Only changed
+# through count, since lookups run on many threads at once.
+counters = collections.Counter()
+
+
+# Adds one to each of the counters named.
+def count(*names):
+    with _lock:
+        for name in names:
+            counters[name] += 1
+
+
+# Returns the cache key for a route. modes is what's sent to Coord, like
+# "metro" or "metro,bike".
+def make_key(
+    origin_latitude, origin_longitude, destination_latitude,
+    destination_longitude, modes, now=None
+):
+    return tuple(
+        int(round(float(value) / QUANTUM)) for value in (
+            origin_latitude, origin_longitude,
+            destination_latitude, destination_longitude
+        )
+    ) + (modes, int((now or time.time()) // BUCKET))
+
+
+# Returns a fresh copy of the cached trip, or None. The entry is stored as
+# JSON text, so every caller gets its own copy to add rideshares and real
+# time to without changing what's cached.
+def get(key):
+    now = time.time()
+    with _lock:
+        entry = _entries.get(key)
+        if entry and entry[1] > now:
+            _entries.move_to_end(key)
+        else:
+            entry = None
+    if entry is None:
+        count("misses")
+        return None
+    count("hits")
+    return json.loads(entry[0])
+
+
+# Returns a copy of the most recently cached trip between the same places with
+# the same modes, even an expired one or one from an earlier departure bucket,
+# or None. For when Coord is too slow and an old route beats no route.
+def latest(key):
+    found = None
+    with _lock:
+        for other in reversed(_entries):
+            if other[:-1] == key[:-1]:
+                found = _entries[other]
+                break
+    if found is None:
+        return None
+    count("stale_hits")
+    return json.loads(found[0])
+
+
+# Caches a trip under key, dropping the least recently used entries if the
+# cache is full.
+def put(key, trip):
+    text = json.dumps(trip, separators=(",", ":"))
+    with _lock:
+        _entries[key] = (text, time.time() + TTL)
+        _entries.move_to_end(key)
+        while len(_entries) > SIZE:
+            _entries.popitem(last=False)
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+
+
+# Returns the hit and miss counts, along with the hit rate.
+def get_counters():
+    with _lock:
+        stats = dict(counters)
+    stats["size"] = len(_entries)
+    lookups = stats.get("hits", 0) + stats.get("misses", 0)
+    stats["hit_rate"] = (stats.get("hits", 0) / lookups) if lookups else 0
+    return stats
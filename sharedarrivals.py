@@ -0,0 +1,245 @@
+import os
+import sys
+import mmap
+import time
+import array
+import bisect
+import struct
+import tempfile
+import threading
+import collections
+import mtafeeds
+
+# Lets several worker processes share one copy of the decoded MTA feeds. One
+# process, the poller, decodes every feed and publishes it to a file that the
+# others, the readers, memory-map instead of decoding it themselves. Set
+# SAVE_REALTIME_ROLE to "poller" or "reader" to choose, or leave it unset to
+# have each process poll for itself like before. The poller can also be run on
+# its own, with python sharedarrivals.py.
+ROLE = os.environ.get("SAVE_REALTIME_ROLE")
+# Where the published feeds go. /dev/shm keeps them in memory on Linux.
+DIRECTORY = os.environ.get("SAVE_REALTIME_DIR") or os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+    "save-realtime"
+)
+# How often, in seconds, a reader checks whether a feed has been republished.
+CHECK_INTERVAL = 1
+
+# Each file starts with a header, then:
+#     offsets: uint32 * (keys + 1), where key i's epochs are
+#         epochs[offsets[i]:offsets[i + 1]]
+#     keys: "route\0stop" for every key, sorted, separated by "\n"
+#     epochs: int64 * offsets[keys], sorted for each key
+# Every section starts on an 8 byte boundary. version goes up by one every
+# time the feed's data changes, and timestamp is the MTA's. When the data
+# hasn't changed the file is only touched, so its modification time is always
+# when the feed was last fetched.
+MAGIC = b"SAVEARR\0"
+LAYOUT = 1
+HEADER = struct.Struct("=8sIIQqQQ")
+
+
+def _padding(size):
+    return -size % 8
+
+
+# Returns the path a feed is published at.
+def feed_path(feed_id, directory=None):
+    return os.path.join(directory or DIRECTORY, "feed_{}.bin".format(feed_id))
+
+
+# Turns an ArrivalIndex into the file layout, as bytes.
+def encode(arrival_index, version, timestamp):
+    keys = sorted(arrival_index.table)
+    offsets = array.array("I", [0])
+    epochs = array.array("q")
+    for key in keys:
+        epochs.extend(arrival_index.table[key])
+        offsets.append(len(epochs))
+    names = "\n".join(
+        route_id + "\0" + stop_id for route_id, stop_id in keys
+    ).encode()
+    parts = [
+        HEADER.pack(
+            MAGIC, LAYOUT, len(keys), version, timestamp, len(names),
+            len(epochs)
+        ),
+        offsets.tobytes(), b"\0" * _padding(len(offsets) * offsets.itemsize),
+        names, b"\0" * _padding(len(names)),
+        epochs.tobytes(),
+    ]
+    return b"".join(parts)
+
+
+# Reads the version of a published feed, or 0 if there isn't one.
+def published_version(path):
+    try:
+        with open(path, "rb") as f:
+            header = HEADER.unpack(f.read(HEADER.size))
+    except (OSError, struct.error):
+        return 0
+    return header[3] if header[0] == MAGIC else 0
+
+
+# Publishes a snapshot, replacing the old file all at once so readers only
+# ever see a whole one. If the data is the same as previous, the file is only
+# touched to show it's still fresh.
+def publish(snapshot, previous=None, directory=None):
+    directory = directory or DIRECTORY
+    os.makedirs(directory, exist_ok=True)
+    path = feed_path(snapshot.feed_id, directory)
+    if (
+        previous is not None and previous.data is snapshot.data and
+        os.path.exists(path)
+    ):
+        os.utime(path, (snapshot.fetched, snapshot.fetched))
+        return
+    content = encode(
+        snapshot.data, published_version(path) + 1, snapshot.timestamp
+    )
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "wb") as f:
+        f.write(content)
+    os.utime(temporary, (snapshot.fetched, snapshot.fetched))
+    os.replace(temporary, path)
+
+
+# An ArrivalIndex read straight out of a published file. The epochs are never
+# copied, only the keys are read into a dictionary when the file is mapped.
+class SharedArrivalIndex:
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.inode = os.fstat(f.fileno()).st_ino
+        view = memoryview(self.map)
+        magic, layout, count, self.version, self.timestamp, names_size, \
+            epochs_size = HEADER.unpack_from(view)
+        if magic != MAGIC or layout != LAYOUT:
+            raise ValueError("Not a published feed: " + path)
+        start = HEADER.size
+        end = start + (count + 1) * 4
+        self.offsets = view[start:end].cast("I")
+        start = end + _padding(end - start)
+        names = bytes(view[start:start + names_size])
+        start += names_size + _padding(names_size)
+        self.epochs = view[start:start + epochs_size * 8].cast("q")
+        self.positions = {
+            tuple(name.decode().split("\0")): position
+            for position, name in enumerate(
+                names.split(b"\n") if names else []
+            )
+        }
+
+    def __len__(self):
+        return len(self.positions)
+
+    # Same as ArrivalIndex.times, but the times are a memoryview into the
+    # file.
+    def times(self, route_id, stop_id, after=None):
+        position = self.positions.get((route_id, stop_id))
+        if position is None:
+            return ()
+        times = self.epochs[
+            self.offsets[position]:self.offsets[position + 1]
+        ]
+        if after is None or not times:
+            return times
+        return times[bisect.bisect_left(times, after):]
+
+    def routes(self):
+        return {route_id for route_id, stop_id in self.positions}
+
+
+# Reads the feeds a poller publishes, with the same get and ages as a
+# FeedManager, so it can be used in its place.
+class SharedReader:
+
+    def __init__(self, directory=None, max_stale=None):
+        self.directory = directory or DIRECTORY
+        self.max_stale = max_stale
+        self.snapshots = {}
+        # feed_id: (inode, version) of the file its snapshot was mapped from.
+        self.mapped = {}
+        self.checked = {}
+        self.errors = collections.Counter()
+        self.lock = threading.Lock()
+
+    def stale_limit(self):
+        return mtafeeds.MAX_STALE if self.max_stale is None \
+            else self.max_stale
+
+    # Maps the feed again if it's been republished, which is a new file with
+    # a new version, and otherwise just picks up when it was last fetched.
+    def check(self, feed_id):
+        path = feed_path(feed_id, self.directory)
+        try:
+            stat = os.stat(path)
+            snapshot = self.snapshots.get(feed_id)
+            if snapshot is None or self.mapped[feed_id] != (
+                stat.st_ino, published_version(path)
+            ):
+                data = SharedArrivalIndex(path)
+                snapshot = mtafeeds.Snapshot(
+                    feed_id, data, os.stat(path).st_mtime, data.timestamp
+                )
+                self.mapped[feed_id] = (data.inode, data.version)
+            else:
+                snapshot = snapshot._replace(fetched=stat.st_mtime)
+            self.snapshots[feed_id] = snapshot
+        except Exception:
+            self.errors[feed_id] += 1
+
+    # Returns feed_id: Snapshot for the given feeds, raising LookupError if
+    # any of them hasn't been published recently enough.
+    def get(self, feed_ids):
+        now = time.time()
+        snapshots = {}
+        with self.lock:
+            for feed_id in feed_ids:
+                if now - self.checked.get(feed_id, 0) >= CHECK_INTERVAL:
+                    self.checked[feed_id] = now
+                    self.check(feed_id)
+                snapshots[feed_id] = self.snapshots.get(feed_id)
+        for feed_id, snapshot in snapshots.items():
+            if (
+                snapshot is None or
+                mtafeeds.snapshot_age(snapshot, now) > self.stale_limit()
+            ):
+                raise LookupError("No recent copy of feed " + feed_id)
+        return snapshots
+
+    def ages(self):
+        now = time.time()
+        with self.lock:
+            return {
+                feed_id: mtafeeds.snapshot_age(snapshot, now)
+                for feed_id, snapshot in self.snapshots.items()
+            }
+
+
+# Returns where this process should get decoded feeds from, given every feed
+# there is. A poller keeps all of them fresh and publishes each one as it's
+# refreshed, a reader reads what's published, and otherwise the process polls
+# what it needs for itself.
+def source(feed_ids, role=None):
+    role = role or ROLE
+    if role == "reader":
+        return SharedReader()
+    if role == "poller":
+        manager = mtafeeds.manager
+        if publish not in manager.listeners:
+            manager.listeners.append(publish)
+        manager.pinned.update(feed_ids)
+        manager.start()
+        return manager
+    return mtafeeds.manager
+
+
+if __name__ == "__main__":
+    # Runs a poller on its own, for workers started with
+    # SAVE_REALTIME_ROLE=reader.
+    source(set(mtafeeds.FEED_ID.values()), "poller")
+    print("Publishing feeds to", DIRECTORY, file=sys.stderr)
+    while True:
+        time.sleep(60)
@@ -0,0 +1,152 @@
+import math
+import collections
+import vincenty
+
+# Kilometers in a degree of latitude, rounded down so that cell sizes are never
+# overestimated.
+KM_PER_DEGREE = 110.5
+# If a query is more than this many rings of cells away from the nearest
+# occupied cell, it just scans every point.
+MAX_RINGS = 40
+
+
+# Buckets points into a grid of roughly cell_km sized cells, so that nearest
+# and radius queries only need to look at a handful of cells instead of every
+# point. items is any iterable, and key(item) gives its (lat, lon).
+class GridIndex:
+
+    def __init__(self, items, key, cell_km=0.5):
+        self.items = list(items)
+        self.key = key
+        self.cell_km = cell_km
+        self.cells = collections.defaultdict(list)
+        points = [key(item) for item in self.items]
+        # The longitude cell size is worked out at the latitude furthest from
+        # the equator, where a degree of longitude is shortest. This way a
+        # cell is at least cell_km wide everywhere in the index.
+        widest = max([abs(lat) for lat, lon in points] or [0])
+        self.lat_step = cell_km / KM_PER_DEGREE
+        self.lon_step = cell_km / (
+            KM_PER_DEGREE * max(math.cos(math.radians(widest)), 0.01)
+        )
+        for item, (lat, lon) in zip(self.items, points):
+            self.cells[self.cell(lat, lon)].append((lat, lon, item))
+        rows = [row for row, column in self.cells] or [0]
+        columns = [column for row, column in self.cells] or [0]
+        self.bounds = (min(rows), max(rows), min(columns), max(columns))
+
+    def __len__(self):
+        return len(self.items)
+
+    # Gives the cell a coordinate falls in.
+    def cell(self, lat, lon):
+        return (
+            int(math.floor(lat / self.lat_step)),
+            int(math.floor(lon / self.lon_step))
+        )
+
+    # The most rings that could ever need searching from the center cell
+    # before every cell in the index has been covered.
+    def rings_needed(self, center):
+        row, column = center
+        low_row, high_row, low_column, high_column = self.bounds
+        return max(
+            abs(row - low_row), abs(row - high_row),
+            abs(column - low_column), abs(column - high_column)
+        )
+
+    # How many rings out the first occupied cell could be, which is 0 if the
+    # center cell is inside the index.
+    def rings_outside(self, center):
+        row, column = center
+        low_row, high_row, low_column, high_column = self.bounds
+        return max(
+            low_row - row, row - high_row,
+            low_column - column, column - high_column, 0
+        )
+
+    # Yields every point in the ring of cells exactly ring cells away from
+    # the center cell.
+    def ring(self, center, ring):
+        row, column = center
+        if ring == 0:
+            cells = [center]
+        else:
+            # Top and bottom rows of the ring, then the sides between them.
+            cells = [
+                (i, j) for i in (row - ring, row + ring)
+                for j in range(column - ring, column + ring + 1)
+            ] + [
+                (i, j) for i in range(row - ring + 1, row + ring)
+                for j in (column - ring, column + ring)
+            ]
+        for cell in cells:
+            for point in self.cells.get(cell, ()):
+                yield point
+
+    # Every point in the index, in no particular order.
+    def all_points(self):
+        for points in self.cells.values():
+            for point in points:
+                yield point
+
+    # Returns the k nearest items as a sorted list of (distance_km, item).
+    # k=None returns every item. predicate can be used to skip items.
+    def nearest(self, lat, lon, k=1, predicate=None):
+        lat, lon = float(lat), float(lon)
+        center = self.cell(lat, lon)
+        found = []
+        # Far outside the index it's cheaper to check everything than to walk
+        # out through empty rings, and the same goes for asking for every
+        # item.
+        if (not k) or self.rings_outside(center) > MAX_RINGS:
+            rings = [self.all_points()]
+        else:
+            rings = (
+                self.ring(center, ring)
+                for ring in range(self.rings_needed(center) + 1)
+            )
+        for ring, points in enumerate(rings):
+            for point_lat, point_lon, item in points:
+                if predicate and not predicate(item):
+                    continue
+                found.append((
+                    vincenty.vincenty((point_lat, point_lon), (lat, lon)),
+                    item
+                ))
+            # Anything outside of the rings searched so far is at least ring
+            # cells away. The small margin covers the difference between the
+            # flat grid and the ellipsoid vincenty works on.
+            if k and len(found) >= k:
+                found.sort(key=lambda pair: pair[0])
+                if found[k - 1][0] <= ring * self.cell_km * 0.99:
+                    break
+        found.sort(key=lambda pair: pair[0])
+        return found[:k] if k else found
+
+    # Returns every item within km of the coordinate, as a sorted list of
+    # (distance_km, item).
+    def within(self, lat, lon, km, predicate=None):
+        lat, lon = float(lat), float(lon)
+        center = self.cell(lat, lon)
+        found = []
+        rings = min(
+            int(math.ceil(float(km) / self.cell_km)),
+            self.rings_needed(center)
+        )
+        # A big enough radius covers more cells than the index has in it.
+        if (2 * rings + 1) ** 2 > len(self.cells):
+            points = self.all_points()
+        else:
+            points = (
+                point for ring in range(rings + 1)
+                for point in self.ring(center, ring)
+            )
+        for point_lat, point_lon, item in points:
+            if predicate and not predicate(item):
+                continue
+            dist = vincenty.vincenty((point_lat, point_lon), (lat, lon))
+            if dist <= km:
+                found.append((dist, item))
+        found.sort(key=lambda pair: pair[0])
+        return found
@@ -0,0 +1,73 @@
+import time
+import random
+import argparse
+from flask import Flask, Response, request
+import fixtures
+
+# Stands in for Nominatim, Coord and the MTA by serving recorded responses,
+# so the whole app can be run and benchmarked with no network. Point the app
+# at it with SAVE_UPSTREAM_URL. Record fixtures by running the app normally
+# with SAVE_RECORD_DIR set.
+app = Flask(__name__)
+app.config.setdefault("FIXTURE_DIR", fixtures.FIXTURE_DIR)
+app.config.setdefault("STRICT", False)
+# Seconds added to every response, plus up to JITTER more at random. Each
+# endpoint, like "route" or "feed", can have its own in ENDPOINT_LATENCY.
+app.config.setdefault("LATENCY", 0)
+app.config.setdefault("JITTER", 0)
+app.config.setdefault("ENDPOINT_LATENCY", {})
+
+
+# Sleeps for the configured latency of an endpoint.
+def delay(endpoint):
+    latency = app.config["ENDPOINT_LATENCY"].get(
+        endpoint, app.config["LATENCY"]
+    )
+    jitter = app.config["JITTER"]
+    time.sleep(max(latency + random.uniform(0, jitter), 0))
+
+
+@app.route("/nominatim/v1/search.php")
+@app.route("/v1/routing/route")
+@app.route("/v1/bike/location")
+@app.route("/mta_esi.php")
+def stand_in():
+    delay(fixtures.ENDPOINTS[request.path])
+    recorded = fixtures.load(
+        request.path, request.args.to_dict(), app.config["FIXTURE_DIR"],
+        app.config["STRICT"]
+    )
+    if recorded is None:
+        return Response("No fixture recorded", status=404)
+    status, content_type, body = recorded
+    return Response(body, status=status, content_type=content_type)
+
+
+# Parses "route=0.3" into ("route", 0.3).
+def endpoint_latency(text):
+    endpoint, seconds = text.split("=")
+    return (endpoint, float(seconds))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve recorded upstream responses."
+    )
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--fixtures", default=fixtures.FIXTURE_DIR)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0,
+                        help="up to this many more seconds, at random")
+    parser.add_argument("--endpoint-latency", type=endpoint_latency,
+                        action="append", default=[],
+                        help="like route=0.3, overrides --latency")
+    parser.add_argument("--strict", action="store_true",
+                        help="404 instead of using another recording")
+    args = parser.parse_args()
+    app.config.update(
+        FIXTURE_DIR=args.fixtures, STRICT=args.strict,
+        LATENCY=args.latency, JITTER=args.jitter,
+        ENDPOINT_LATENCY=dict(args.endpoint_latency)
+    )
+    app.run(port=args.port, threaded=True)
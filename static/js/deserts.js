@@ -0,0 +1,36 @@
+// Draws the cells of the desert grid that are deserts, as rectangles.
+const loadDeserts = function(){
+
+    L.mapquest.open = true;
+    const baseLayer = L.mapquest.tileLayer('map');
+    let map = L.mapquest.map('map', {
+        // Centered in NYC.
+        center: [40.7128, -74.0060],
+        layers: baseLayer,
+        zoom: 11,
+        preferCanvas: true,
+    });
+    let myRenderer = L.canvas({ padding: 0.5 });
+    const myScript = document.getElementById('desertjs');
+    fetch(myScript.getAttribute("data-url")).then((resp)=>resp.json()).then((resp)=>{
+        // Each cell is [south, west, north, east].
+        for (let i = 0; i < resp.cells.length; i += 1) {
+            const cell = resp.cells[i];
+            L.rectangle([[cell[0], cell[1]], [cell[2], cell[3]]], {
+                stroke: false,
+                renderer: myRenderer,
+                fillOpacity: 0.35,
+                fillColor: "red",
+            }).addTo(map);
+        }
+    });
+
+    L.control.layers({
+            'Map': baseLayer
+    }).addTo(map);
+};
+
+fetch('http://localhost:5000/secret').then((resp)=>resp.json()).then((resp)=>{
+    L.mapquest.key=resp["mapquest"];
+    loadDeserts();
+})
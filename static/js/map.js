@@ -26,9 +26,8 @@ const loadAll=function(){
         document.getElementById('dest').value = e.target.options.address;
     }
     let myRenderer = L.canvas({ padding: 0.5 });
-    // Getting list of locations from template.
+    // Getting list of locations, or where to get clusters, from template.
     const myScript = document.getElementById('mapjs');
-    let locations = JSON.parse(myScript.getAttribute("data"));
 
     const greenIcon = new L.Icon({
     iconUrl: 'https://cdn.rawgit.com/pointhi/leaflet-color-markers/master/img/marker-icon-green.png',
@@ -54,43 +53,104 @@ const loadAll=function(){
     popupAnchor: [1, -34],
     shadowSize: [41, 41]
     });
-    let currentIcon = greyIcon;
-    let currentText = "";
-    // L.marker([51.5, -0.09], {icon: greenIcon}).addTo(map);
-    if (myScript.getAttribute("businessmap")){
-        // Use markers for businesses.
-        for (let i = 0; i < locations.length; i += 1) {
-            currentIcon = greyIcon;
-            currentText = locations[i].name;
-            if (locations[i].discount){
-                currentIcon = blueIcon;
-                currentText = (
-                    locations[i].name +
-                    "<br>This location has discounted rates of " +
-                    locations[i].discount + "% off."
-                );
-            }
-            if (locations[i].promotion){
-                currentIcon = greenIcon;
-                currentText = (
-                    locations[i].name +
-                    '<br><span style="color:red">LIMITED TIME ONLY</span><br>' +
-                    locations[i].promotion +
-                    "% off when traveling to this location!"
-                );
+    // Makes a marker for a business, colored by its offers.
+    function businessMarker(location){
+        let currentIcon = greyIcon;
+        let currentText = location.name;
+        if (location.discount){
+            currentIcon = blueIcon;
+            currentText = (
+                location.name +
+                "<br>This location has discounted rates of " +
+                location.discount + "% off."
+            );
+        }
+        if (location.promotion){
+            currentIcon = greenIcon;
+            currentText = (
+                location.name +
+                '<br><span style="color:red">LIMITED TIME ONLY</span><br>' +
+                location.promotion +
+                "% off when traveling to this location!"
+            );
 
+        }
+        return L.marker([location.latitude,location.longitude],
+            {
+                title: location.name,
+                address: location.address,
+                icon: currentIcon,
             }
-            L.marker([locations[i].latitude,locations[i].longitude],
-                {
-                    title: locations[i].name,
-                    address: locations[i].address,
-                    icon: currentIcon,
+        ).on('click', addressToDest).bindPopup(currentText);
+    }
+    // Makes a circle for a cluster, bigger the more it has in it.
+    function clusterCircle(cluster, color){
+        return L.circleMarker([cluster.latitude, cluster.longitude],
+            {
+                color: color,
+                opacity: .4,
+                radius: 6 + 3 * Math.log2(cluster.count),
+                renderer: myRenderer,
+                fillOpacity: 0.3,
+                fillColor: color,
+            }).bindTooltip(String(cluster.count));
+    }
+    const clusterUrl = myScript.getAttribute("data-clusters");
+    if (clusterUrl){
+        // Get clusters for wherever the map is showing, again every time
+        // it's moved, instead of every location at once.
+        const clusterLayer = L.layerGroup().addTo(map);
+        let latest = 0;
+        const loadClusters = function(){
+            const bounds = map.getBounds();
+            const url = (
+                clusterUrl + (clusterUrl.includes("?") ? "&" : "?") +
+                "zoom=" + map.getZoom() + "&bbox=" + [
+                    bounds.getSouth(), bounds.getWest(),
+                    bounds.getNorth(), bounds.getEast()
+                ].join(",")
+            );
+            const request = latest += 1;
+            fetch(url).then((resp)=>resp.json()).then((resp)=>{
+                // Skip it if the map has moved again since.
+                if (request != latest){
+                    return;
+                }
+                clusterLayer.clearLayers();
+                if (resp.businesses){
+                    for (let i = 0; i < resp.businesses.length; i += 1) {
+                        const cluster = resp.businesses[i];
+                        if (cluster.count == 1){
+                            businessMarker(cluster).addTo(clusterLayer);
+                        } else {
+                            clusterCircle(cluster, "grey").addTo(clusterLayer);
+                        }
+                    }
+                    return;
+                }
+                // Origins are blue and destinations red.
+                for (let i = 0; i < resp.origins.length; i += 1) {
+                    clusterCircle(resp.origins[i], "blue").addTo(clusterLayer);
+                }
+                for (let i = 0; i < resp.destinations.length; i += 1) {
+                    clusterCircle(resp.destinations[i], "red")
+                        .addTo(clusterLayer);
                 }
-            ).addTo(map).on('click', addressToDest).bindPopup(currentText);
+            });
+        };
+        map.on('moveend', loadClusters);
+        loadClusters();
+    }
+    else if (myScript.getAttribute("businessmap")){
+        // Use markers for businesses.
+        let locations = JSON.parse(myScript.getAttribute("data"));
+        for (let i = 0; i < locations.length; i += 1) {
+            businessMarker(locations[i]).addTo(map);
         }
     }
     else {
         // Use circles if they're user rides.
+        let locations = JSON.parse(myScript.getAttribute("data"));
         for (let i = 0; i < locations.length; i += 1) {
             L.circle([locations[i].origin_latitude,locations[i].origin_longitude],
                 {
@@ -0,0 +1,57 @@
+// Charts trip counts over time, as bars, for the bucket and flag chosen.
+const loadTrends = function(){
+
+    const myScript = document.getElementById('trendsjs');
+    const form = document.getElementById('trends-form');
+    const chart = document.getElementById('trends');
+    const width = chart.getAttribute("width");
+    const height = chart.getAttribute("height");
+    const svg = "http://www.w3.org/2000/svg";
+    const bucket = form.elements["bucket"].value;
+    const flag = form.elements["flag"].value;
+    const url = myScript.getAttribute("data-url") + "?bucket=" + bucket;
+    fetch(url).then((resp)=>resp.json()).then((resp)=>{
+        while (chart.firstChild) {
+            chart.removeChild(chart.firstChild);
+        }
+        const trends = resp.trends;
+        let most = 1;
+        for (let i = 0; i < trends.length; i += 1) {
+            most = Math.max(most, trends[i][flag] || 0);
+        }
+        const barWidth = width / Math.max(trends.length, 1);
+        for (let i = 0; i < trends.length; i += 1) {
+            const value = trends[i][flag] || 0;
+            const barHeight = (height - 20) * value / most;
+            const bar = document.createElementNS(svg, "rect");
+            bar.setAttribute("x", i * barWidth);
+            bar.setAttribute("y", height - 20 - barHeight);
+            bar.setAttribute("width", Math.max(barWidth - 1, 1));
+            bar.setAttribute("height", barHeight);
+            bar.setAttribute("fill", "steelblue");
+            const title = document.createElementNS(svg, "title");
+            title.textContent = new Date(trends[i].time * 1000)
+                .toLocaleString() + ": " + value;
+            bar.appendChild(title);
+            chart.appendChild(bar);
+        }
+        // Label the first and last buckets, and the tallest bar.
+        const labels = [
+            [0, "start", new Date(resp.start * 1000).toLocaleDateString()],
+            [width, "end", new Date(resp.end * 1000).toLocaleDateString()],
+            [width / 2, "middle", "Most: " + most],
+        ];
+        for (let i = 0; i < labels.length; i += 1) {
+            const label = document.createElementNS(svg, "text");
+            label.setAttribute("x", labels[i][0]);
+            label.setAttribute("y", height - 4);
+            label.setAttribute("text-anchor", labels[i][1]);
+            label.setAttribute("font-size", "12");
+            label.textContent = labels[i][2];
+            chart.appendChild(label);
+        }
+    });
+};
+
+document.getElementById('trends-form').addEventListener("change", loadTrends);
+loadTrends();
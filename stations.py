@@ -0,0 +1,63 @@
+import csv
+import collections
+import threading
+import spatial
+
+STATIONS_FILE = "stations.csv"
+
+# Slim record for a subway station. dist is the distance in km from whatever
+# point the station was looked up from, and 0 otherwise.
+Station = collections.namedtuple(
+    "Station", [
+        "stop_id", "complex_id", "name", "borough", "routes",
+        "latitude", "longitude", "dist"
+    ]
+)
+
+_index = None
+_index_lock = threading.Lock()
+
+
+# Reads stations.csv into a list of Station records.
+def load_stations(path=STATIONS_FILE):
+    with open(path) as f:
+        return [
+            Station(
+                row["GTFS Stop ID"], row["Complex ID"], row["Stop Name"],
+                row["Borough"], tuple(row["Daytime Routes"].split()),
+                float(row["GTFS Latitude"]), float(row["GTFS Longitude"]), 0
+            )
+            for row in csv.DictReader(f)
+        ]
+
+
+# Returns the station index, loading it the first time it's asked for. The
+# stations don't change while the app runs, so one per process is enough.
+def get_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = spatial.GridIndex(
+                    load_stations(),
+                    lambda station: (station.latitude, station.longitude)
+                )
+    return _index
+
+
+# Returns the k nearest stations to the coordinate, closest first, with dist
+# filled in. k=None returns every station. predicate can be used to only look
+# at some stations, like accessible ones.
+def nearest(lat, lon, k=1, predicate=None):
+    return [
+        station._replace(dist=dist) for dist, station in
+        get_index().nearest(lat, lon, k, predicate)
+    ]
+
+
+# Returns every station within km of the coordinate, closest first.
+def within(lat, lon, km, predicate=None):
+    return [
+        station._replace(dist=dist) for dist, station in
+        get_index().within(lat, lon, float(km), predicate)
+    ]
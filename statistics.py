@@ -1,93 +1,343 @@
-import sqlite3
+import os
 import json
 import time
+import atexit
+import datetime
+import threading
 import collections
+import database
+import metrics
+import tripstore
+import rollups
 
+STATISTICS_FILE = "statistics.db"
+# Trips are written in the background, in batches, so a search never waits on
+# the database. A batch is written once it has BATCH_SIZE trips, or
+# FLUSH_INTERVAL seconds after its first one was queued.
+BATCH_SIZE = 100
+FLUSH_INTERVAL = 1.0
+# Most trips kept waiting. Past this the oldest are dropped, so a database
+# that can't be written to doesn't use up all the memory.
+MAX_PENDING = 10000
+# How many ids a process reserves from the database at a time.
+ID_BLOCK = 100
+# SQL for the local start of the trend bucket a trip is in, as seconds since
+# the epoch. Each trip's own local time is used, so buckets stay on local
+# hours and midnights when the clocks change.
+TREND_BUCKETS = collections.OrderedDict([
+    ("hour", "time_epoch - CAST(strftime('%s', time_epoch, 'unixepoch', "
+             "'localtime') AS INTEGER) % 3600"),
+    ("day", "CAST(strftime('%s', time_epoch, 'unixepoch', 'localtime', "
+            "'start of day', 'utc') AS INTEGER)"),
+    ("week", "CAST(strftime('%s', time_epoch, 'unixepoch', 'localtime', "
+             "'-6 days', 'weekday 1', 'start of day', 'utc') AS INTEGER)"),
+])
+# Most buckets one trend query returns.
+MAX_TREND_BUCKETS = 1000
 
-# Inserts trip data into database.
+# Columns written for each trip option, after its ROWID.
+TRIP_COLUMNS = (
+    "origin_latitude", "origin_longitude",
+    "destination_latitude", "destination_longitude",
+    "ada", "low_income",
+    "senior", "student",
+    "ada_desert", "transit_desert",
+    "walk", "bike",
+    "metro", "train",
+    "trip_object", "time_now",
+    "rideshare", "user_id",
+    "trip_id", "origin",
+    "destination", "time_epoch",
+)
+# Flags counted in the rollups, for the dashboard.
+TRIP_FLAGS = (
+    "ada", "student", "low_income", "senior", "ada_desert", "transit_desert",
+    "walk", "bike", "metro", "train", "rideshare",
+)
+# Where trip_object is in a queued row. It's queued encoded, and saved to the
+# trip store when the row is written.
+TRIP_OBJECT = 1 + TRIP_COLUMNS.index("trip_object")
+# Rows are written with the batch they were written in last.
+INSERT_TRIP = '''INSERT INTO trips (ROWID, {}, batch)
+                    VALUES (?, {}, ?)'''.format(
+    ", ".join(TRIP_COLUMNS), ", ".join("?" * len(TRIP_COLUMNS))
+)
+
+
+# Hands out ids from a counter in the database's sequences table. Ids are
+# reserved a block at a time, so every process gets its own and the database
+# is only written to once per block. Ids left in a block when a process stops
+# are skipped.
+class Sequence:
+
+    def __init__(self, path, name, block=ID_BLOCK):
+        self.path = path
+        self.name = name
+        self.block = block
+        self.next = self.limit = 0
+        self.pid = None
+        self.lock = threading.Lock()
+
+    # Returns the next count ids, in order.
+    def take(self, count=1):
+        with self.lock:
+            # A forked process mustn't use the ids its parent reserved.
+            if self.pid != os.getpid() or self.next + count > self.limit:
+                reserve = max(self.block, count)
+                with database.connect(self.path, immediate=True) as connection:
+                    connection.execute(
+                        '''UPDATE sequences SET value = value + ?
+                            WHERE name = ?''', (reserve, self.name)
+                    )
+                    limit = connection.execute(
+                        '''SELECT value FROM sequences WHERE name = ?''',
+                        (self.name,)
+                    ).fetchone()[0]
+                self.next, self.limit = limit - reserve + 1, limit + 1
+                self.pid = os.getpid()
+            ids = range(self.next, self.next + count)
+            self.next += count
+            return ids
+
+
+# Queues trips and writes them to the database from a background thread.
+class TripQueue:
+
+    def __init__(
+        self, path=STATISTICS_FILE, batch_size=BATCH_SIZE,
+        interval=FLUSH_INTERVAL
+    ):
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.trip_ids = Sequence(path, "trip_id")
+        self.row_ids = Sequence(path, "row_id")
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        # Only one flush at a time, so trips are written in order.
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+
+    def __len__(self):
+        return len(self.pending)
+
+    # Queues rows to be written, each a tuple of ROWID and TRIP_COLUMNS. Once
+    # the queue is closed they're written straight away instead.
+    def put(self, rows):
+        with self.condition:
+            self.pending.extend(rows)
+            while len(self.pending) > MAX_PENDING:
+                self.pending.popleft()
+                metrics.count("save_trip_writes_total", status="dropped")
+            closed = self.closed
+            if not closed and (
+                self.thread is None or not self.thread.is_alive()
+            ):
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+        if closed:
+            self.flush()
+
+    # Writes batches until the queue is closed. Whatever is left then is
+    # written by close.
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                # Give the batch time to fill up, unless it already has.
+                flush_at = time.monotonic() + self.interval
+                while len(self.pending) < self.batch_size and \
+                        not self.closed:
+                    remaining = flush_at - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                if self.closed:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                # The trips are still queued, so try again in a bit.
+                time.sleep(self.interval)
+
+    # Writes everything queued so far in one transaction, and marks any trips
+    # that were chosen before they were written. If writing fails the trips
+    # stay queued and the error is raised.
+    def flush(self):
+        with self.flush_lock:
+            with self.condition:
+                rows = list(self.pending)
+                self.pending.clear()
+            if not rows:
+                return 0
+            try:
+                with database.connect(self.path, immediate=True) as connection:
+                    batch = next_batch(connection)
+                    connection.executemany(INSERT_TRIP, [
+                        row[:TRIP_OBJECT] +
+                        (tripstore.save(connection, row[TRIP_OBJECT]),) +
+                        row[TRIP_OBJECT + 1:] + (batch,)
+                        for row in rows
+                    ])
+                    counts = collections.Counter(trips=len(rows))
+                    for flag in TRIP_FLAGS:
+                        index = 1 + TRIP_COLUMNS.index(flag)
+                        counts[flag] = sum(row[index] or 0 for row in rows)
+                    counts["chosen"] = mark_pending_chosen(connection)
+                    rollups.add(connection, counts)
+            except Exception:
+                with self.condition:
+                    self.pending.extendleft(reversed(rows))
+                metrics.count(
+                    "save_trip_writes_total", len(rows), status="error"
+                )
+                raise
+            metrics.count(
+                "save_trip_writes_total", len(rows), status="written"
+            )
+            return len(rows)
+
+    # Stops the background thread and writes whatever is left, like when the
+    # process is exiting. Trips put after this are written as they come.
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+            thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        if self.pending:
+            self.flush()
+
+
+trip_queue = TripQueue()
+atexit.register(trip_queue.close)
+
+
+# Turns a time_now, which is a time.asctime() string, into seconds since the
+# epoch, so trips can be sorted and grouped by time. Returns None if it isn't
+# one.
+def parse_time(time_now):
+    try:
+        return int(time.mktime(time.strptime(time_now)))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+# Queues trip data to be written to the database. The trip's id and each
+# option's id are given out straight away, so they can be put on the page and
+# chosen, even before they are written. Trips go on trip_queue, unless another
+# queue is given.
 def write_trip(
     origin_latitude, origin_longitude, destination_latitude,
     destination_longitude, trips, preferences, time_now, user_id,
-    origin, destination
+    origin, destination, queue=None
 ):
     input_dictionary = collections.defaultdict(lambda: 0, locals())
     del input_dictionary["trips"]
     del input_dictionary["preferences"]
+    del input_dictionary["queue"]
+    if queue is None:
+        queue = trip_queue
     input_dictionary.update(preferences)
-    connection = sqlite3.connect('statistics.db')
-    with connection:
-        cursor = connection.cursor()
-        create_trips_table(cursor)
-        input_dictionary["trip_id"] = cursor.execute(
-                '''SELECT MAX(trip_id) FROM trips'''
-        ).fetchone()[0]
-        # Getting a single trip_id for all the returned results for a search.
-        if (not input_dictionary["trip_id"]):
-            input_dictionary["trip_id"] = 1
-        else:
-            input_dictionary["trip_id"] += 1
-        trips["id"] = input_dictionary["trip_id"]
-        for trip in trips["trips"]:
-            input_dictionary["trip"] = trip
-            for leg in trip["legs"]:
-                input_dictionary[leg["mode"]] = 1
-            cursor.execute(
-                    '''INSERT INTO trips (
-                            origin_latitude, origin_longitude,
-                            destination_latitude, destination_longitude,
-                            ada, low_income,
-                            senior, student,
-                            ada_desert, transit_desert,
-                            walk, bike,
-                            metro, train,
-                            trip_object, time_now,
-                            rideshare, user_id,
-                            trip_id, origin,
-                            destination)
-                            VALUES (
-                            :origin_latitude, :origin_longitude,
-                            :destination_latitude,
-                            :destination_longitude,
-                            :ada, :low_income,
-                            :senior, :student,
-                            :ada_desert, :transit_desert,
-                            :walk, :bike,
-                            :metro, :train,
-                            :trip_object, :time_now,
-                            :rideshare, :user_id,
-                            :trip_id, :origin,
-                            :destination)
-                    ''', input_dictionary)
-            trip["id"] = cursor.lastrowid
-        trips["chosen"] = 0
-        return True
+    input_dictionary["time_epoch"] = parse_time(time_now)
+    # Getting a single trip_id for all the returned results for a search.
+    input_dictionary["trip_id"] = queue.trip_ids.take()[0]
+    trips["id"] = input_dictionary["trip_id"]
+    rows = []
+    for trip, row_id in zip(
+        trips["trips"], queue.row_ids.take(len(trips["trips"]))
+    ):
+        input_dictionary["trip"] = trip
+        input_dictionary["trip_object"] = tripstore.encode(trip)
+        for leg in trip["legs"]:
+            input_dictionary[leg["mode"]] = 1
+        rows.append((row_id,) + tuple(
+            input_dictionary[column] for column in TRIP_COLUMNS
+        ))
+        trip["id"] = row_id
+    queue.put(rows)
+    trips["chosen"] = 0
+    return True
+
+
+# Numbers a batch of trips being written. Batches are written one at a time,
+# so they're always in the database in the order they're numbered, which
+# ROWIDs aren't, as each process has its own block of them. Called in the
+# batch's transaction.
+def next_batch(connection):
+    connection.execute(
+        '''UPDATE sequences SET value = value + 1 WHERE name = ?''',
+        ("batch",)
+    )
+    return connection.execute(
+        '''SELECT value FROM sequences WHERE name = ?''', ("batch",)
+    ).fetchone()[0]
+
+
+# Marks trips chosen before they were written, now that they have been.
+# Returns how many were marked.
+def mark_pending_chosen(connection):
+    marked = connection.execute(
+        '''UPDATE trips SET chosen = 1
+            WHERE ROWID IN (SELECT row_id FROM pending_chosen)
+                AND chosen = 0'''
+    ).rowcount
+    connection.execute(
+        '''DELETE FROM pending_chosen
+            WHERE row_id IN (SELECT ROWID FROM trips)'''
+    )
+    return marked
 
 
 # Choose a trip by the narrower trip_id, corresponding to ROWID.
 def choose_trip(trip_id):
-    connection = sqlite3.connect('statistics.db')
-    with connection:
-        connection.execute(
-            '''UPDATE trips SET chosen=1 WHERE ROWID=?''',
+    # The trip may still be queued here.
+    trip_queue.flush()
+    with database.connect(STATISTICS_FILE) as connection:
+        if connection.execute(
+            '''UPDATE trips SET chosen=1 WHERE ROWID=? AND chosen=0''',
             (trip_id,)
-        )
+        ).rowcount:
+            rollups.add(connection, {"chosen": 1})
+        elif not connection.execute(
+            '''SELECT 1 FROM trips WHERE ROWID=?''', (trip_id,)
+        ).fetchone():
+            # Or queued in another process, which marks it when it's written.
+            connection.execute(
+                '''INSERT OR IGNORE INTO pending_chosen (row_id)
+                    VALUES (?)''', (trip_id,)
+            )
     return True
 
 
 # This is to get the chosen trip by the broader trip_id. Currently has no use.
 def get_chosen(trip_id):
-    connection = sqlite3.connect('statistics.db')
-    # connection.row_factory = sqlite3.Row
-    with connection:
+    with database.connect(STATISTICS_FILE) as connection:
         chosen = connection.execute('''SELECT * FROM trips
                                         WHERE chosen=1 AND trip_id=?''',
-                                    (trip_id,))
+                                    (trip_id,)).fetchall()
     if not chosen:
         return False
     return chosen[0]
 
 
-# Made a function for this instead of cluttering every other function with it.
+# Get the Coord trip saved for a trip option by its ROWID, or None if it
+# wasn't saved. Only this decodes trip objects, the other queries never read
+# them.
+def get_trip_object(trip_id):
+    with database.connect(STATISTICS_FILE) as connection:
+        row = connection.execute(
+            '''SELECT trip_object FROM trips WHERE ROWID = ?''', (trip_id,)
+        ).fetchone()
+        return tripstore.load(connection, row[0]) if row else None
+
+
+# Creates the trips table. Run once, as the database's first migration.
 def create_trips_table(cursor):
     query = '''CREATE TABLE IF NOT EXISTS trips (
                     origin TEXT DEFAULT NULL,
@@ -116,56 +366,95 @@ def create_trips_table(cursor):
     cursor.execute(query)
 
 
+# Adds the counters trip ids and ROWIDs are given out from, starting after
+# the trips already written, and the table for trips chosen before they've
+# been written.
+def add_sequences(connection):
+    connection.execute('''CREATE TABLE IF NOT EXISTS sequences (
+                            name TEXT PRIMARY KEY,
+                            value INTEGER DEFAULT 0)''')
+    connection.execute(
+        '''INSERT OR IGNORE INTO sequences (name, value) VALUES
+            ('trip_id', (SELECT IFNULL(MAX(trip_id), 0) FROM trips)),
+            ('row_id', (SELECT IFNULL(MAX(ROWID), 0) FROM trips))'''
+    )
+    connection.execute('''CREATE TABLE IF NOT EXISTS pending_chosen (
+                            row_id INTEGER PRIMARY KEY)''')
+    connection.execute(
+        '''CREATE INDEX IF NOT EXISTS trips_trip_id ON trips (trip_id)'''
+    )
+
+
+# Adds time_epoch, which is time_now as seconds since the epoch, filled in
+# for the trips already written, and indexed for time ranges.
+def add_time_epoch(connection):
+    connection.execute('''ALTER TABLE trips ADD COLUMN time_epoch INTEGER''')
+    connection.executemany(
+        '''UPDATE trips SET time_epoch = ? WHERE ROWID = ?''',
+        (
+            (parse_time(time_now), row_id) for row_id, time_now in
+            connection.execute('''SELECT ROWID, time_now FROM trips''')
+            .fetchall()
+        )
+    )
+    connection.execute(
+        '''CREATE INDEX trips_time_epoch ON trips (time_epoch)'''
+    )
+
+
+# Adds the batch each trip was written in, for reading trips in the order they
+# were written, like exports do. Trips already written are batch 0.
+def add_batches(connection):
+    connection.execute(
+        '''ALTER TABLE trips ADD COLUMN batch INTEGER DEFAULT 0'''
+    )
+    connection.execute(
+        '''INSERT OR IGNORE INTO sequences (name, value) VALUES ('batch', 0)'''
+    )
+    connection.execute('''CREATE INDEX trips_batch ON trips (batch)''')
+
+
+# Adds the rollups, counted from the trips already written.
+def add_rollups(connection):
+    rollups.create_table(connection)
+    rebuild_rollups(connection)
+
+
+database.register(
+    STATISTICS_FILE, create_trips_table, add_sequences,
+    tripstore.create_tables, add_rollups, add_time_epoch, add_batches
+)
+
+
 # Get the total number of results, and number of trips that have been chosen.
 def get_totals():
-    connection = sqlite3.connect('statistics.db')
-    connection.row_factory = sqlite3.Row
-    totals = {}
-    with connection:
-        cursor = connection.cursor()
-        create_trips_table(cursor)
-        fetched = cursor.execute('''SELECT COUNT(trip_id),
-                                    SUM(chosen) FROM trips''').fetchone()
-        return fetched
+    with database.connect(STATISTICS_FILE) as connection:
+        return tuple(rollups.read(connection, ("trips", "chosen")).values())
 
 
 # Get all stats listed as a dictionary.
 def get_trip_statistics():
-    connection = sqlite3.connect('statistics.db')
-    connection.row_factory = sqlite3.Row
-    with connection:
-        cursor = connection.cursor()
-        create_trips_table(cursor)
-        # Select sum because it's easier than writing SELECT all_the_stuff
-        # where all_the_stuff = 1 .
-        count_fetch = cursor.execute('''SELECT
-                                        SUM(ada) as ada,
-                                        SUM(student) as student,
-                                        SUM(low_income) as low_income,
-                                        SUM(senior) as senior,
-                                        SUM(ada_desert) as ada_desert,
-                                        SUM(transit_desert) as transit_desert,
-                                        SUM(walk) as walk,
-                                        SUM(bike) as bike,
-                                        SUM(metro) as metro,
-                                        SUM(train) as train,
-                                        SUM(rideshare) as rideshare
-                                        FROM trips''').fetchone()
-        # If it's empty, return False. This may not be handled on other end.
-        if (not count_fetch):
-            return False
-        return dict(count_fetch)
+    with database.connect(STATISTICS_FILE) as connection:
+        return dict(rollups.read(connection, TRIP_FLAGS))
+
+
+# Recounts the rollups from every trip. Returns the new totals.
+def rebuild_rollups(connection):
+    counts = dict(zip(("trips", "chosen") + TRIP_FLAGS, connection.execute(
+        '''SELECT COUNT(trip_id), SUM(chosen), {} FROM trips'''.format(
+            ", ".join("SUM({})".format(flag) for flag in TRIP_FLAGS)
+        )
+    ).fetchone()))
+    rollups.replace(connection, counts)
+    return counts
 
 
 # Gets a count of a statistic, like ada or transit_desert. statistics is a
 # list, so it accepts multiple like ["ada", "transit_desert"]. Then type_ sets
 # it as either an OR or AND query.
 def get_statistic(statistics, type_):
-    connection = sqlite3.connect('statistics.db')
-    connection.row_factory = sqlite3.Row
-    with connection:
+    with database.connect(STATISTICS_FILE, rows=True) as connection:
         cursor = connection.cursor()
-        create_trips_table(cursor)
         # Will query like "WHERE statistics[0] = 1 type_ statistics[1] = 1".
         # type_ will be AND or OR.
         query = ('''SELECT
@@ -185,12 +474,83 @@ def get_statistic(statistics, type_):
         return count_fetch
 
 
+# Returns the local midnight starting the day epoch is in, days days later.
+def local_day(epoch, days=0):
+    date = datetime.date.fromtimestamp(epoch) + datetime.timedelta(days)
+    return int(time.mktime(date.timetuple()))
+
+
+# Returns the start of every hour, day or week bucket from start to end, in
+# local time, so a day can be 23 or 25 hours long. Weeks start on Monday.
+def trend_buckets(bucket, start, end):
+    starts = []
+    if bucket == "hour":
+        moment = start
+        while True:
+            bucket_start = moment - (
+                moment + time.localtime(moment).tm_gmtoff
+            ) % 3600
+            if bucket_start >= end:
+                break
+            starts.append(bucket_start)
+            moment = bucket_start + 3600
+            if len(starts) > MAX_TREND_BUCKETS:
+                raise ValueError("Too many buckets")
+    else:
+        days = 7 if bucket == "week" else 1
+        offset = -datetime.date.fromtimestamp(start).weekday() \
+            if bucket == "week" else 0
+        while True:
+            bucket_start = local_day(start, offset + len(starts) * days)
+            if bucket_start >= end:
+                break
+            starts.append(bucket_start)
+            if len(starts) > MAX_TREND_BUCKETS:
+                raise ValueError("Too many buckets")
+    return starts
+
+
+# Gets counts of trips, chosen trips and each flag for every hour, day or
+# week from start to end, which are seconds since the epoch, in one grouped
+# query on the time_epoch index. Buckets are local, and weeks start on
+# Monday. Returns a list of dictionaries in time order, with "time" the
+# start of the bucket, including buckets with no trips.
+def get_trends(bucket, start, end, flags=TRIP_FLAGS):
+    flags = [flag for flag in flags if flag in TRIP_FLAGS]
+    starts = trend_buckets(bucket, start, end)
+    if not starts:
+        return []
+    query = '''SELECT
+                    {} AS time,
+                    COUNT(trip_id) AS trips, SUM(chosen) AS chosen{}
+                    FROM trips
+                    WHERE time_epoch >= :first AND time_epoch < :end
+                    GROUP BY time
+                    ORDER BY time'''.format(
+        TREND_BUCKETS[bucket],
+        "".join(", SUM({0}) AS {0}".format(flag) for flag in flags)
+    )
+    with database.connect(STATISTICS_FILE, rows=True) as connection:
+        found = {
+            row["time"]: dict(row) for row in connection.execute(
+                query, {"first": starts[0], "end": end}
+            )
+        }
+    empty = dict.fromkeys(["trips", "chosen"] + flags, 0)
+    trends = []
+    for bucket_start in starts:
+        counts = dict(empty, time=bucket_start)
+        counts.update(
+            (key, value or 0)
+            for key, value in found.get(bucket_start, {}).items()
+        )
+        trends.append(counts)
+    return trends
+
+
 # Returns a dictionary of all lat/lon for origins and destinations.
 def get_all_latitude_longitude():
-    connection = sqlite3.connect('statistics.db')
-    connection.row_factory = sqlite3.Row
-    with connection:
-        create_trips_table(connection)
+    with database.connect(STATISTICS_FILE, rows=True) as connection:
         locations = connection.execute('''SELECT DISTINCT
                                             origin_latitude,
                                             origin_longitude,
@@ -202,10 +562,7 @@ def get_all_latitude_longitude():
 
 # Returns a dictionary of filtered lat/lon for origins and destinations.
 def get_filtered_latitude_longitude(statistics, type_):
-    connection = sqlite3.connect('statistics.db')
-    connection.row_factory = sqlite3.Row
-    with connection:
-        create_trips_table(connection)
+    with database.connect(STATISTICS_FILE, rows=True) as connection:
         query = ('''SELECT DISTINCT
                     origin_latitude,
                     origin_longitude,
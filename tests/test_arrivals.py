@@ -0,0 +1,24 @@
+import arrivals
+
+NOW = 1000000
+
+
+def test_minutes_are_floored_sorted_and_unique():
+    trains = [NOW + 61, NOW + 59, NOW + 60, NOW - 30, NOW + 119]
+    assert arrivals.to_minutes(sorted(trains), NOW) == [-1, 0, 1]
+
+
+def test_trains_before_reaching_the_station_are_skipped():
+    trains = [NOW + 30, NOW + 90, NOW + 150, NOW + 400]
+    # Reaching the station 100 seconds from now is minute 1, so the train at
+    # 90 seconds, also in minute 1, still counts.
+    assert arrivals.minutes_from_now([(trains, NOW + 100)], NOW) == [
+        [1, 2, 6]
+    ]
+
+
+def test_legs_sharing_trains():
+    trains = [NOW + 200, NOW + 20]
+    assert arrivals.minutes_from_now(
+        [(trains, NOW), (trains, NOW + 180), (trains, NOW + 600)], NOW
+    ) == [[0, 3], [3], []]
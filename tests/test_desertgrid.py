@@ -0,0 +1,50 @@
+import numpy
+import desertgrid
+
+BOUNDS = ((40.70, -74.00), (40.76, -73.92))
+FIRST = [(40.71, -73.99), (40.73, -73.95), (40.75, -73.93), (40.72, -73.97)]
+SECOND = [(40.71, -73.99), (40.74, -73.96), (40.75, -73.93)]
+
+
+def built(points):
+    grid = desertgrid.DesertGrid(BOUNDS)
+    grid.update("subway", points)
+    grid.classify()
+    return grid
+
+
+def test_update_matches_a_full_build():
+    grid = built(FIRST)
+    changed = grid.update("subway", SECOND)
+    grid.classify()
+    fresh = built(SECOND)
+    assert changed > 0
+    assert numpy.array_equal(
+        grid.distances["subway"], fresh.distances["subway"]
+    )
+    assert numpy.array_equal(grid.flags, fresh.flags)
+    assert grid.points["subway"] == sorted(SECOND)
+
+
+def test_update_with_nothing_changed():
+    grid = built(FIRST)
+    before = grid.distances["subway"].copy()
+    assert grid.update("subway", list(reversed(FIRST))) == 0
+    assert numpy.array_equal(grid.distances["subway"], before)
+
+
+def test_copy_is_updated_separately():
+    grid = built(FIRST)
+    before = grid.distances["subway"].copy()
+    copy = grid.copy()
+    copy.update("subway", SECOND)
+    assert numpy.array_equal(grid.distances["subway"], before)
+
+
+def test_is_near_is_only_sure_away_from_the_edge():
+    grid = built([(40.73, -73.95)])
+    assert grid.is_near("subway", 40.73, -73.95, 0.8) is True
+    assert grid.is_near("subway", 40.71, -73.99, 0.8) is False
+    # About 0.8 km north of the point.
+    assert grid.is_near("subway", 40.7372, -73.95, 0.8) is None
+    assert grid.is_near("subway", 41.5, -73.95, 0.8) is None
@@ -0,0 +1,113 @@
+import time
+import threading
+import pytest
+import mtafeeds
+
+
+def snapshot(feed_id, fetched=None):
+    fetched = time.time() if fetched is None else fetched
+    return mtafeeds.Snapshot(feed_id, None, fetched, 0)
+
+
+# A FeedManager whose polling thread never starts, so only get fetches.
+def make_manager(fetch, monkeypatch):
+    manager = mtafeeds.FeedManager(fetch=fetch)
+    monkeypatch.setattr(manager, "start", lambda: None)
+    return manager
+
+
+def test_missing_feed_is_fetched_once(monkeypatch):
+    calls = []
+
+    def fetch(feed_id, previous):
+        calls.append(feed_id)
+        return snapshot(feed_id)
+
+    manager = make_manager(fetch, monkeypatch)
+    for _ in range(3):
+        assert manager.get({"1"})["1"].feed_id == "1"
+    assert calls == ["1"]
+
+
+def test_failing_feed_is_only_tried_once_per_interval(monkeypatch):
+    calls = []
+
+    def fetch(feed_id, previous):
+        calls.append(feed_id)
+        raise IOError("down")
+
+    manager = make_manager(fetch, monkeypatch)
+    for _ in range(5):
+        with pytest.raises(LookupError):
+            manager.get({"1"})
+    assert calls == ["1"]
+    assert manager.errors["1"] == 1
+    manager.attempted["1"] -= manager.interval("1")
+    with pytest.raises(LookupError):
+        manager.get({"1"})
+    assert calls == ["1", "1"]
+
+
+def test_concurrent_requests_share_one_download(monkeypatch):
+    calls = []
+    release = threading.Event()
+
+    def fetch(feed_id, previous):
+        calls.append(feed_id)
+        release.wait(5)
+        return snapshot(feed_id)
+
+    manager = make_manager(fetch, monkeypatch)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(manager.get({"1"})))
+        for _ in range(10)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert calls == ["1"]
+    assert len(results) == 10
+
+
+def test_stale_snapshot_is_served_until_the_limit(monkeypatch):
+    def fetch(feed_id, previous):
+        raise IOError("down")
+
+    manager = make_manager(fetch, monkeypatch)
+    old = snapshot("1", time.time() - manager.interval("1") * 3)
+    manager.snapshots["1"] = old
+    assert manager.get({"1"})["1"] is old
+    manager.snapshots["1"] = snapshot(
+        "1", time.time() - manager.stale_limit() - 1
+    )
+    with pytest.raises(LookupError):
+        manager.get({"1"})
+
+
+def test_fresh_snapshot_is_not_fetched_again(monkeypatch):
+    calls = []
+
+    def fetch(feed_id, previous):
+        calls.append(feed_id)
+        return snapshot(feed_id)
+
+    manager = make_manager(fetch, monkeypatch)
+    manager.snapshots["1"] = snapshot("1")
+    manager.get({"1"})
+    assert calls == []
+
+
+def test_listeners_hear_about_refreshes(monkeypatch):
+    heard = []
+    manager = make_manager(
+        lambda feed_id, previous: snapshot(feed_id), monkeypatch
+    )
+    manager.listeners.append(
+        lambda new, previous: heard.append((new.feed_id, previous))
+    )
+    assert manager.refresh(["1", "2"]) == set()
+    assert sorted(heard) == [("1", None), ("2", None)]
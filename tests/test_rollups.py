@@ -0,0 +1,32 @@
+import sqlite3
+import rollups
+
+
+def make_connection():
+    connection = sqlite3.connect(":memory:")
+    rollups.create_table(connection)
+    return connection
+
+
+def test_add_and_read():
+    connection = make_connection()
+    rollups.add(connection, {"trips": 3, "chosen": 0})
+    rollups.add(connection, {"trips": 2, "chosen": 1})
+    assert list(rollups.read(connection, ("chosen", "trips", "ada")).items()) \
+        == [("chosen", 1), ("trips", 5), ("ada", 0)]
+
+
+def test_zero_amounts_are_skipped():
+    connection = make_connection()
+    rollups.add(connection, {"trips": 0})
+    assert connection.execute("SELECT COUNT(*) FROM rollups").fetchone() \
+        == (0,)
+
+
+def test_replace():
+    connection = make_connection()
+    rollups.add(connection, {"trips": 3, "ada": 2})
+    rollups.replace(connection, {"trips": 1})
+    assert dict(rollups.read(connection, ("trips", "ada"))) == {
+        "trips": 1, "ada": 0
+    }
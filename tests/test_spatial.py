@@ -0,0 +1,54 @@
+import random
+import vincenty
+import spatial
+
+
+def make_points(count, seed):
+    generator = random.Random(seed)
+    return [
+        (generator.uniform(40.5, 40.9), generator.uniform(-74.2, -73.7))
+        for _ in range(count)
+    ]
+
+
+def brute_force(points, lat, lon):
+    return sorted(
+        (vincenty.vincenty(point, (lat, lon)), point) for point in points
+    )
+
+
+def test_nearest_matches_brute_force():
+    points = make_points(300, 1)
+    index = spatial.GridIndex(points, key=lambda point: point)
+    for lat, lon in make_points(50, 2):
+        for k in (1, 5, 20):
+            assert index.nearest(lat, lon, k=k) == \
+                brute_force(points, lat, lon)[:k]
+
+
+def test_nearest_far_outside_the_index():
+    points = make_points(100, 3)
+    index = spatial.GridIndex(points, key=lambda point: point)
+    assert index.nearest(45.0, -70.0, k=3) == \
+        brute_force(points, 45.0, -70.0)[:3]
+
+
+def test_nearest_with_predicate():
+    points = make_points(200, 4)
+    index = spatial.GridIndex(points, key=lambda point: point)
+    kept = points[::3]
+    found = index.nearest(
+        40.7, -73.9, k=5, predicate=lambda point: point in kept
+    )
+    assert found == brute_force(kept, 40.7, -73.9)[:5]
+
+
+def test_within_matches_brute_force():
+    points = make_points(300, 5)
+    index = spatial.GridIndex(points, key=lambda point: point)
+    for lat, lon in make_points(30, 6):
+        for km in (0.5, 2, 50):
+            assert index.within(lat, lon, km) == [
+                pair for pair in brute_force(points, lat, lon)
+                if pair[0] <= km
+            ]
@@ -0,0 +1,173 @@
+import os
+import time
+import threading
+import pytest
+import database
+import statistics
+
+
+def make_trip(legs=("walk",)):
+    return {
+        "trips": [
+            {"legs": [{"mode": mode} for mode in legs], "statistics": {}}
+        ]
+    }
+
+
+def write(queue, time_now="Mon Jan  1 12:00:00 2024", legs=("walk",)):
+    trip = make_trip(legs)
+    statistics.write_trip(
+        40.7, -73.9, 40.8, -73.95, trip, {"ada": 1}, time_now, 0,
+        "origin", "destination", queue=queue
+    )
+    return trip
+
+
+@pytest.fixture
+def path(tmp_path, monkeypatch):
+    # Migrations are found by the file's name.
+    path = str(tmp_path / os.path.basename(statistics.STATISTICS_FILE))
+    monkeypatch.setattr(statistics, "STATISTICS_FILE", path)
+    return path
+
+
+@pytest.fixture
+def local_time():
+    old = os.environ.get("TZ")
+    os.environ["TZ"] = "America/New_York"
+    time.tzset()
+    yield
+    if old is None:
+        del os.environ["TZ"]
+    else:
+        os.environ["TZ"] = old
+    time.tzset()
+
+
+def count_trips(path):
+    with database.connect(path) as connection:
+        return connection.execute("SELECT COUNT(*) FROM trips").fetchone()[0]
+
+
+def test_sequences_never_hand_out_the_same_id(path):
+    first = statistics.Sequence(path, "trip_id", block=3)
+    second = statistics.Sequence(path, "trip_id", block=3)
+    taken = [
+        list(first.take(2)), list(second.take()), list(first.take(2)),
+        list(second.take(5))
+    ]
+    ids = [id_ for ids in taken for id_ in ids]
+    assert len(set(ids)) == len(ids) == 10
+    # Each sequence hands its ids out in order.
+    assert taken[0] + taken[2] == sorted(taken[0] + taken[2])
+
+
+def test_queue_writes_on_flush_and_close(path):
+    queue = statistics.TripQueue(path, batch_size=1000, interval=3600)
+    for _ in range(3):
+        write(queue)
+    assert len(queue) == 3
+    assert queue.flush() == 3
+    assert count_trips(path) == 3
+    write(queue)
+    queue.close()
+    assert count_trips(path) == 4
+    assert not queue.thread.is_alive()
+
+
+def test_closed_queue_writes_straight_away(path):
+    queue = statistics.TripQueue(path)
+    queue.close()
+    write(queue)
+    assert len(queue) == 0
+    assert count_trips(path) == 1
+
+
+def test_closing_stops_every_thread(path):
+    before = threading.active_count()
+    for _ in range(5):
+        queue = statistics.TripQueue(path, batch_size=2)
+        for _ in range(3):
+            write(queue)
+        queue.close()
+    assert threading.active_count() == before
+    assert count_trips(path) == 15
+
+
+def test_totals_are_rolled_up(path):
+    queue = statistics.TripQueue(path)
+    trip = write(queue, legs=("walk", "metro"))
+    write(queue)
+    queue.close()
+    statistics.choose_trip(trip["trips"][0]["id"])
+    statistics.choose_trip(trip["trips"][0]["id"])
+    assert statistics.get_totals() == (2, 1)
+    stats = statistics.get_trip_statistics()
+    assert (stats["ada"], stats["walk"], stats["metro"]) == (2, 2, 1)
+    # Recounting from the rows comes to the same totals.
+    with database.connect(path, immediate=True) as connection:
+        statistics.rebuild_rollups(connection)
+    assert statistics.get_totals() == (2, 1)
+    assert statistics.get_trip_statistics() == stats
+
+
+def test_choosing_a_trip_before_it_is_written(path):
+    queue = statistics.TripQueue(path, batch_size=1000, interval=3600)
+    trip = write(queue)
+    statistics.choose_trip(trip["trips"][0]["id"])
+    assert statistics.get_totals() == (0, 0)
+    queue.close()
+    assert statistics.get_totals() == (1, 1)
+
+
+def local(text):
+    return int(time.mktime(time.strptime(text, "%Y-%m-%d %H:%M")))
+
+
+def trend_counts(bucket, start, end):
+    return [
+        (time.strftime("%m-%d %H:%M", time.localtime(row["time"])),
+         row["trips"])
+        for row in statistics.get_trends(bucket, local(start), local(end))
+        if row["trips"]
+    ]
+
+
+def test_trend_days_follow_clock_changes(path, local_time):
+    queue = statistics.TripQueue(path)
+    for moment in (
+        "2024-03-09 23:30", "2024-03-10 00:10", "2024-03-10 03:30",
+        "2024-03-10 23:50", "2024-03-11 00:05",
+        "2024-11-03 00:30", "2024-11-03 23:30", "2024-11-04 00:30",
+    ):
+        write(queue, time.asctime(time.localtime(local(moment))))
+    queue.close()
+    assert trend_counts("day", "2024-03-08 00:00", "2024-03-13 00:00") == [
+        ("03-09 00:00", 1), ("03-10 00:00", 3), ("03-11 00:00", 1)
+    ]
+    assert trend_counts("day", "2024-11-01 00:00", "2024-11-06 00:00") == [
+        ("11-03 00:00", 2), ("11-04 00:00", 1)
+    ]
+    assert trend_counts("week", "2024-10-28 00:00", "2024-11-11 00:00") == [
+        ("10-28 00:00", 2), ("11-04 00:00", 1)
+    ]
+
+
+def test_trend_buckets_are_local(local_time):
+    days = statistics.trend_buckets(
+        "day", local("2024-03-09 12:00"), local("2024-03-12 00:00")
+    )
+    assert [later - earlier for earlier, later in zip(days, days[1:])] == [
+        24 * 3600, 23 * 3600
+    ]
+    # The hour from 1am happens twice when the clocks go back.
+    hours = statistics.trend_buckets(
+        "hour", local("2024-11-03 00:00"), local("2024-11-03 03:00")
+    )
+    assert len(hours) == 4
+    weeks = statistics.trend_buckets(
+        "week", local("2024-03-06 12:00"), local("2024-03-20 00:00")
+    )
+    assert [time.localtime(week).tm_wday for week in weeks] == [0, 0, 0]
+    with pytest.raises(ValueError):
+        statistics.trend_buckets("hour", 0, 10 ** 8)
@@ -0,0 +1,117 @@
+import json
+import zlib
+import hashlib
+
+# Stores Coord trips compactly. Each leg and each trip is saved once, by the
+# hash of its contents, in the trip_legs and trip_objects tables, and the
+# trips table only holds the trip's hash in trip_object. A trip is saved with
+# its legs swapped for their hashes, so the same walk to the same station in
+# two searches is one row. Nothing is decoded until load is asked for it.
+
+# Blobs start with a byte for how they were compressed, so that can change
+# later without breaking the ones already saved. 1 is zlib with DICTIONARY.
+FORMAT = 1
+# Words Coord trips are mostly made of, for zlib to refer back to, since a leg
+# on its own is too short to compress well. Never change this, add a new
+# FORMAT instead.
+DICTIONARY = (
+    b'{"geometry": {"coordinates": [[-73.9, 40.7], [-73.9, 40.7]], '
+    b'"type": "LineString"}, "mode": "walk", "statistics": '
+    b'{"distance_km": 0.1, "duration_s": 600, "end_time": '
+    b'"2019-01-01T00:00:00+00:00", "start_time": "2019-01-01T00:00:00+00:00"}'
+    b', "station_end": {"id": "N", "name": ""}, "station_start": {"id": "N", '
+    b'"name": ""}, "transit_route": "", "mode": "metro", "mode": "bike", '
+    b'"mode": "train", "legs": ["'
+)
+HASH_SIZE = 16
+
+
+# Creates the tables legs and trips are saved in. A migration for the
+# statistics database.
+def create_tables(connection):
+    connection.execute('''CREATE TABLE IF NOT EXISTS trip_legs (
+                            hash BLOB PRIMARY KEY,
+                            leg BLOB)''')
+    connection.execute('''CREATE TABLE IF NOT EXISTS trip_objects (
+                            hash BLOB PRIMARY KEY,
+                            trip BLOB)''')
+
+
+def _dumps(value):
+    return json.dumps(value, sort_keys=True, separators=(",", ":")).encode()
+
+
+def _hash(content):
+    return hashlib.blake2b(content, digest_size=HASH_SIZE).digest()
+
+
+def compress(content):
+    compressor = zlib.compressobj(9, zdict=DICTIONARY)
+    return bytes([FORMAT]) + compressor.compress(content) + compressor.flush()
+
+
+def decompress(blob):
+    if blob[0] != FORMAT:
+        raise ValueError("Unknown trip format {}".format(blob[0]))
+    decompressor = zlib.decompressobj(zdict=DICTIONARY)
+    return decompressor.decompress(blob[1:]) + decompressor.flush()
+
+
+# Turns a trip into what save needs, as (trip hash, trip content, [(leg hash,
+# leg content)]). This is a copy, so the trip can change afterwards, and is
+# quick enough to do while a search waits. Compressing is left to save.
+def encode(trip):
+    legs = []
+    for leg in trip.get("legs", ()):
+        content = _dumps(leg)
+        legs.append((_hash(content), content))
+    skeleton = dict(trip)
+    skeleton["legs"] = [leg_hash.hex() for leg_hash, content in legs]
+    content = _dumps(skeleton)
+    return _hash(content), content, legs
+
+
+# Saves content under its hash in table, unless it's there already. Only new
+# content is compressed, filled in by the same transaction that claimed its
+# hash.
+def _save(connection, table, column, content_hash, content):
+    if connection.execute(
+        '''INSERT OR IGNORE INTO {} (hash) VALUES (?)'''.format(table),
+        (content_hash,)
+    ).rowcount:
+        connection.execute(
+            '''UPDATE {} SET {} = ? WHERE hash = ?'''.format(table, column),
+            (compress(content), content_hash)
+        )
+
+
+# Saves an encoded trip, and any of its legs that aren't saved yet. Returns
+# the trip's hash, for trip_object. Needs to be in a transaction.
+def save(connection, encoded):
+    trip_hash, content, legs = encoded
+    for leg_hash, leg in legs:
+        _save(connection, "trip_legs", "leg", leg_hash, leg)
+    _save(connection, "trip_objects", "trip", trip_hash, content)
+    return trip_hash
+
+
+# Returns the trip saved under a hash, with its legs, or None if there isn't
+# one, like for trips written before trips were saved.
+def load(connection, trip_hash):
+    if not isinstance(trip_hash, bytes):
+        return None
+    row = connection.execute(
+        '''SELECT trip FROM trip_objects WHERE hash = ?''', (trip_hash,)
+    ).fetchone()
+    if not row:
+        return None
+    trip = json.loads(decompress(row[0]))
+    legs = []
+    for leg_hash in trip["legs"]:
+        leg = connection.execute(
+            '''SELECT leg FROM trip_legs WHERE hash = ?''',
+            (bytes.fromhex(leg_hash),)
+        ).fetchone()
+        legs.append(json.loads(decompress(leg[0])) if leg else None)
+    trip["legs"] = legs
+    return trip
@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import threading
+import requests
+import metrics
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+SECRET_FILE = "secret.json"
+# How often, in seconds, to check whether secret.json has changed on disk.
+CHECK_INTERVAL = 5
+
+# Every upstream service. timeout is (connect, read) in seconds, retries is how
+# many times a failed connection or a 429/5xx response is retried, and backoff
+# is the urllib3 backoff factor between those retries.
+SERVICES = {
+    "mapquest": {
+        "base": "http://open.mapquestapi.com",
+        "timeout": (3.05, 5), "retries": 2, "backoff": 0.3,
+    },
+    "coord": {
+        "base": "https://api.coord.co",
+        "timeout": (3.05, 10), "retries": 1, "backoff": 0.5,
+    },
+    "mta": {
+        "base": "http://datamine.mta.info",
+        "timeout": (3.05, 10), "retries": 2, "backoff": 0.5,
+    },
+}
+# Connections kept open per service. Should be at least as many as the
+# threads that call it at once.
+POOL_SIZE = 32
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# If set, every service is called at this base instead, like
+# "http://localhost:5001" for the stand-ins in standins.py.
+UPSTREAM_URL = os.environ.get("SAVE_UPSTREAM_URL")
+# If set, every response is saved here as a fixture for the stand-ins.
+RECORD_DIR = os.environ.get("SAVE_RECORD_DIR")
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_secrets = None
+_secrets_mtime = None
+_checked = 0
+_secrets_lock = threading.Lock()
+
+
+# Returns the dictionary in secret.json. It's read once, then only again if
+# the file changes.
+def secrets():
+    global _secrets, _secrets_mtime, _checked
+    now = time.time()
+    if _secrets is not None and now - _checked < CHECK_INTERVAL:
+        return _secrets
+    with _secrets_lock:
+        if _secrets is None or now - _checked >= CHECK_INTERVAL:
+            _checked = now
+            mtime = os.stat(SECRET_FILE).st_mtime
+            if _secrets is None or mtime != _secrets_mtime:
+                with open(SECRET_FILE) as f:
+                    _secrets = json.load(f)
+                _secrets_mtime = mtime
+    return _secrets
+
+
+# Returns the api key for a service, like "coord".
+def credential(name):
+    return secrets()[name]
+
+
+# Returns the keep-alive session for a service, making it the first time.
+def session(service):
+    if service in _sessions:
+        return _sessions[service]
+    with _sessions_lock:
+        if service not in _sessions:
+            settings = SERVICES[service]
+            retry = Retry(
+                total=settings["retries"],
+                backoff_factor=settings["backoff"],
+                status_forcelist=RETRY_STATUSES,
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retry
+            )
+            new_session = requests.Session()
+            new_session.mount("http://", adapter)
+            new_session.mount("https://", adapter)
+            _sessions[service] = new_session
+    return _sessions[service]
+
+
+# Makes a GET request to a path on a service, with that service's session,
+# timeout and retries. Returns the requests Response.
+def get(service, path, params=None, **kwargs):
+    settings = SERVICES[service]
+    kwargs.setdefault("timeout", settings["timeout"])
+    start = time.perf_counter()
+    try:
+        response = session(service).get(
+            (UPSTREAM_URL or settings["base"]) + path, params=params, **kwargs
+        )
+    except Exception:
+        metrics.count(
+            "save_upstream_responses_total", service=service, status="error"
+        )
+        raise
+    finally:
+        metrics.observe(
+            "save_upstream_seconds", time.perf_counter() - start,
+            service=service
+        )
+    metrics.count(
+        "save_upstream_responses_total", service=service,
+        status=response.status_code
+    )
+    if RECORD_DIR:
+        import fixtures
+        fixtures.record(
+            path, params, response.status_code,
+            response.headers.get("Content-Type"), response.content, RECORD_DIR
+        )
+    return response
@@ -1,20 +1,47 @@
 import json
-import sqlite3
+import database
+import rollups
+
+USERS_FILE = "users.db"
+# Preferences counted in the rollups, for the dashboard.
+PREFERENCE_FLAGS = ("ada", "student", "senior")
+
+
+# Creates the users table. Run once, as the database's first migration.
+def create_users_table(connection):
+    connection.execute('''CREATE TABLE IF NOT EXISTS users(
+                            username TEXT DEFAULT NULL,
+                            password TEXT DEFAULT NULL,
+                            ada INTEGER DEFAULT 0,
+                            student INTEGER DEFAULT 0,
+                            senior INTEGER DEFAULT 0,
+                            income REAL DEFAULT 0,
+                            id INTEGER PRIMARY KEY AUTOINCREMENT)''')
+
+
+# Recounts the rollups from every user. Returns the new totals.
+def rebuild_rollups(connection):
+    counts = dict(zip(("users",) + PREFERENCE_FLAGS, connection.execute(
+        '''SELECT COUNT(username), SUM(ada), SUM(student), SUM(senior)
+            FROM users'''
+    ).fetchone()))
+    rollups.replace(connection, counts)
+    return counts
+
+
+# Adds the rollups, counted from the users already there.
+def add_rollups(connection):
+    rollups.create_table(connection)
+    rebuild_rollups(connection)
+
+
+database.register(USERS_FILE, create_users_table, add_rollups)
 
 
 # Adds user, give username and password. Should just work, even if username
 # is taken.
 def add_user(username, password):
-    connection = sqlite3.connect('users.db')
-    with connection:
-        connection.execute('''CREATE TABLE IF NOT EXISTS users(
-                                username TEXT DEFAULT NULL,
-                                password TEXT DEFAULT NULL,
-                                ada INTEGER DEFAULT 0,
-                                student INTEGER DEFAULT 0,
-                                senior INTEGER DEFAULT 0,
-                                income REAL DEFAULT 0,
-                                id INTEGER PRIMARY KEY AUTOINCREMENT)''')
+    with database.connect(USERS_FILE, immediate=True) as connection:
         # If username exists already.
         if (
             connection.execute(
@@ -29,23 +56,13 @@ def add_user(username, password):
             INSERT INTO users (username, password) VALUES (?,?)
             ''', (username, password,)
         )
+        rollups.add(connection, {"users": 1})
     return True
 
 
 # Checks if password matches username. Currently in plaintext, so please fix.
 def verify_user(username, password):
-    connection = sqlite3.connect('users.db')
-    with connection:
-        connection.execute(
-            '''CREATE TABLE IF NOT EXISTS users(
-                    username TEXT DEFAULT NULL,
-                    password TEXT DEFAULT NULL,
-                    ada INTEGER DEFAULT 0,
-                    student INTEGER DEFAULT 0,
-                    senior INTEGER DEFAULT 0,
-                    income REAL DEFAULT 0,
-                    id INTEGER PRIMARY KEY AUTOINCREMENT)'''
-        )
+    with database.connect(USERS_FILE) as connection:
         password_check = connection.execute(
             '''
             SELECT password FROM users WHERE username = ?
@@ -60,8 +77,13 @@ def verify_user(username, password):
 def save_preference(user_id, preferences):
     # Unify the dictionary.
     input_dictionary = {**dict(user_id=user_id), **preferences}
-    connection = sqlite3.connect('users.db')
-    with connection:
+    with database.connect(USERS_FILE, immediate=True) as connection:
+        previous = connection.execute(
+            '''SELECT ada, student, senior FROM users WHERE id = ?''',
+            (user_id,)
+        ).fetchone()
+        if not previous:
+            return True
         connection.execute('''UPDATE users SET
                                 ada = :ada,
                                 student = :student,
@@ -69,13 +91,16 @@ def save_preference(user_id, preferences):
                                 income = :income
                                 WHERE
                                     id = :user_id''', input_dictionary)
+        rollups.add(connection, {
+            flag: (input_dictionary[flag] or 0) - (old or 0)
+            for flag, old in zip(PREFERENCE_FLAGS, previous)
+        })
     return True
 
 
 # Get the user id given username.
 def get_user_id(username):
-    connection = sqlite3.connect('users.db')
-    with connection:
+    with database.connect(USERS_FILE) as connection:
         return connection.execute(
             '''
             SELECT id FROM users WHERE username = ?
@@ -85,9 +110,7 @@ def get_user_id(username):
 
 # Get a dictionary of preferences.
 def get_preference(user_id):
-    connection = sqlite3.connect('users.db')
-    connection.row_factory = sqlite3.Row
-    with connection:
+    with database.connect(USERS_FILE, rows=True) as connection:
         preferences = connection.execute(
             '''
             SELECT ada, student, senior, income FROM users WHERE id = ?
@@ -98,22 +121,9 @@ def get_preference(user_id):
 
 # Get sums of preferences.
 def get_all_preferences():
-    connection = sqlite3.connect('users.db')
-    connection.row_factory = sqlite3.Row
-    with connection:
-        count_fetch = connection.execute('''SELECT
-                                            SUM(ada) as ada,
-                                            SUM(student) as student,
-                                            SUM(senior) as senior
-                                            FROM users''').fetchone()
-        if (not count_fetch):
-            return False
-        count_dict = dict(count_fetch)
-        count = connection.execute(
-            '''
-            SELECT COUNT(username) FROM users
-            '''
-        ).fetchone()
-        if (count):
-            count_dict["Total"] = count[0]
-        return count_dict
+    with database.connect(USERS_FILE) as connection:
+        count_dict = dict(
+            rollups.read(connection, PREFERENCE_FLAGS + ("users",))
+        )
+    count_dict["Total"] = count_dict.pop("users")
+    return count_dict